@@ -0,0 +1,457 @@
+'''
+    Async versions of the note retrieve/create/update/share/history views.
+
+    Served through `notes_management.asgi`, these views run on the event
+    loop: authentication, validation, rendering and the reads go through
+    Django's async ORM, so a waiting request does not hold a worker
+    thread. The parts that have to stay synchronous (`Note.save()` with its
+    History transaction, the m2m `add()` with its signals, History
+    decoding and the note cache fill, which query in a transaction or
+    several times) run in a bounded thread pool sized by
+    `NOTES_ASYNC_THREAD_POOL_SIZE`.
+
+    Responses, status codes, permissions and caching behave like the
+    synchronous views in `notes.views`.
+
+    `AsyncNoteEventsView` has no synchronous counterpart: it pushes the
+    changes of the user's notes as server-sent events, or long-polls.
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.db.models import Max
+from django.dispatch import receiver
+from django.http import StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.views import exception_handler
+
+from notes.cache import get_note_cache
+from notes.conditional import match, none_match
+from notes.events import events_settings, get_event_hub
+from notes.history_writer import wait_for_history
+from notes.models import History, Note, NoteChange, StaleVersionError
+from notes.pagination import HistoryPagination
+from notes.permissions import IsOwner, IsOwnerOrSharedUser
+from notes.renderers import FastJSONRenderer
+from notes.renderers import dumps
+from notes.serializers import (
+    HistoryFilterSerializer,
+    HistorySerializer,
+    NoteEventsSerializer,
+    NotePatchSerializer,
+    NoteShareSerializer,
+    NoteUpdateSerializer,
+    NotesSerializer,
+    parse_fields,
+)
+from notes.streaming import ndjson_line
+from notes.transactions import atomic_with_retry
+from notes.versions import HistoryNotWritten, check_history_written, decode_history
+from notes.views import NotesRetrieveUpdateView, NoteVersionHistoryView
+from users.authentication import CachedJWTAuthentication
+
+_executor = None
+
+
+def get_executor():
+    '''
+        Returns the process wide pool running the synchronous parts.
+    '''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'NOTES_ASYNC_THREAD_POOL_SIZE', 8),
+            thread_name_prefix='notes-sync',
+        )
+    return _executor
+
+
+@receiver(setting_changed)
+def reset_executor(setting, **kwargs):
+    global _executor
+    if setting == 'NOTES_ASYNC_THREAD_POOL_SIZE' and _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def run_sync(func, *args, **kwargs):
+    '''
+        Awaitable running `func(*args, **kwargs)` in the bounded pool. The
+        pool threads keep their own database connections, which are
+        recycled like request threads recycle theirs.
+    '''
+    def call():
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(call, thread_sensitive=False, executor=get_executor())()
+
+
+class AsyncAPIView(View):
+    '''
+        Async counterpart of the DRF views used in `notes.views`: bearer
+        token authentication with `CachedJWTAuthentication`, JSON request
+        parsing, object permissions, DRF exception handling and rendering.
+        Handlers return DRF `Response` objects.
+    '''
+    permission_classes = [IsOwnerOrSharedUser]
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Only bearer tokens are accepted, as with the DRF views
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.request = Request(request, parsers=[JSONParser()])
+        try:
+            authenticated = await CachedJWTAuthentication().aauthenticate(request)
+            if authenticated is None:
+                raise exceptions.NotAuthenticated()
+            self.request.user, self.request.auth = authenticated
+            handler = getattr(self, request.method.lower(), None)
+            if handler is None or request.method.lower() not in self.http_method_names:
+                raise exceptions.MethodNotAllowed(request.method)
+            response = await handler(self.request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        return self.finalize_response(response)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            exc.auth_header = CachedJWTAuthentication().authenticate_header(self.request)
+        response = exception_handler(exc, {'view': self, 'request': self.request})
+        if response is None:
+            raise exc
+        if getattr(exc, 'auth_header', None):
+            response['WWW-Authenticate'] = exc.auth_header
+        elif response.status_code == status.HTTP_401_UNAUTHORIZED:
+            response.status_code = status.HTTP_403_FORBIDDEN
+        return response
+
+    def finalize_response(self, response):
+        if isinstance(response, Response):
+            response.accepted_renderer = FastJSONRenderer()
+            response.accepted_media_type = FastJSONRenderer.media_type
+            response.renderer_context = {'view': self, 'request': self.request}
+        return response
+
+    def check_object_permissions(self, obj):
+        for permission in self.permission_classes:
+            if not permission().has_object_permission(self.request, self, obj):
+                raise exceptions.PermissionDenied()
+
+    async def aget_object(self, note_id, queryset=None):
+        if queryset is None:
+            queryset = Note.objects.with_share_flag(self.request.user)
+        try:
+            note = await queryset.aget(pk=note_id)
+        except Note.DoesNotExist:
+            raise exceptions.NotFound()
+        self.check_object_permissions(note)
+        return note
+
+
+class AsyncCreateNoteView(AsyncAPIView):
+    '''
+        Async version of `CreateNotes`.
+    '''
+    async def post(self, request):
+        serializer = NotesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        await run_sync(serializer.save, created_by=request.user, updated_by=request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class AsyncNoteDetailView(AsyncAPIView):
+    '''
+        Async version of the `GET`, `PUT` and `PATCH` of
+        `NotesRetrieveUpdateView`, with the same note cache, `ETag`,
+        `If-None-Match`, `If-Match` and `base_version` handling.
+    '''
+    async def get(self, request, id):
+        fields = parse_fields(request.query_params.get('fields'), NotesSerializer.Meta.fields)
+        cache = get_note_cache()
+        cached = cache.get(id)
+        if cached is not None:
+            self.check_object_permissions(cached.for_user(request.user))
+            if none_match(request.headers.get('If-None-Match'), cached.etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': cached.etag})
+            return Response(cached.subset(fields), headers={'ETag': cached.etag})
+
+        epoch = cache.epoch(id)
+        queryset = Note.objects.with_share_flag(request.user)
+        if fields is not None:
+            queryset = queryset.only(*NotesRetrieveUpdateView.required_columns, *fields)
+        if 'If-None-Match' in request.headers:
+            queryset = queryset.defer('description')
+        note = await self.aget_object(id, queryset)
+        if none_match(request.headers.get('If-None-Match'), note.etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': note.etag})
+        if 'If-None-Match' in request.headers and (fields is None or 'description' in fields):
+            await note.arefresh_from_db(fields=['description'])
+        data = NotesSerializer(note, context={'fields': fields}).data
+        if fields is None:
+            await run_sync(cache.set, note, data, epoch)
+        return Response(data, headers={'ETag': note.etag})
+
+    async def put(self, request, id):
+        note = await self.aget_object(id)
+        if_match = request.headers.get('If-Match')
+        if not match(if_match, note.etag):
+            return self.precondition_failed()
+        serializer = NoteUpdateSerializer(note, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            await run_sync(
+                serializer.save,
+                updated_by=request.user,
+                expected_version=note.version if if_match is not None else None,
+            )
+        except StaleVersionError:
+            return self.precondition_failed()
+        return Response(serializer.data, headers={'ETag': note.etag})
+
+    async def patch(self, request, id):
+        note = await self.aget_object(id)
+        if not match(request.headers.get('If-Match'), note.etag):
+            return self.precondition_failed()
+        serializer = NotePatchSerializer(note, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if serializer.validated_data['base_version'] != note.version:
+            return self.version_conflict(note.version)
+        try:
+            await run_sync(serializer.save, updated_by=request.user)
+        except StaleVersionError:
+            return self.version_conflict(await Note.objects.filter(pk=note.pk).values_list('version', flat=True).afirst())
+        return Response(serializer.data, headers={'ETag': note.etag})
+
+    def precondition_failed(self):
+        return Response(
+            {"error": "The note has been modified since it was read."},
+            status=status.HTTP_412_PRECONDITION_FAILED,
+        )
+
+    def version_conflict(self, version):
+        return Response(
+            {"error": "The note is no longer at base_version.", "version": version},
+            status=status.HTTP_409_CONFLICT,
+        )
+
+
+class AsyncNoteShareView(AsyncAPIView):
+    '''
+        Async version of `NoteShareView`.
+    '''
+    permission_classes = [IsOwner]
+
+    async def post(self, request):
+        serializer = NoteShareSerializer(data=request.data)
+        # Validating the user ids runs a query
+        await run_sync(serializer.is_valid, raise_exception=True)
+        try:
+            note = await Note.objects.only('id', 'created_by').aget(id=serializer.validated_data['note_id'])
+        except Note.DoesNotExist:
+            return Response({"message": "Note does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        self.check_object_permissions(note)
+        await run_sync(atomic_with_retry, note.accessible_users.add, *serializer.validated_data['users'])
+        return Response({"message": "Note shared successfully"}, status=status.HTTP_200_OK)
+
+
+class AsyncNoteVersionHistoryView(AsyncAPIView):
+    '''
+        Async version of `NoteVersionHistoryView`, with the same filters,
+        keyset pagination and `?stream=ndjson` streaming.
+    '''
+    pagination_class = HistoryPagination
+    stream_chunk_size = NoteVersionHistoryView.stream_chunk_size
+    value_columns = NoteVersionHistoryView.value_columns
+    filter_history = NoteVersionHistoryView.filter_history
+    needs_values = NoteVersionHistoryView.needs_values
+    history_not_written = NoteVersionHistoryView.history_not_written
+
+    async def get(self, request, id):
+        fields = parse_fields(request.query_params.get('fields'), HistorySerializer.Meta.fields)
+        values = self.needs_values(fields)
+        queryset = Note.objects.with_share_flag(request.user)
+        if not values:
+            queryset = queryset.defer('description')
+        note = await self.aget_object(id, queryset)
+        filters = HistoryFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        await run_sync(wait_for_history)
+        history_entries = History.objects.filter(note=note, version__lte=note.version)
+        history_entries = self.filter_history(history_entries, filters.validated_data)
+        if values:
+            try:
+                await run_sync(check_history_written, note)
+            except HistoryNotWritten as e:
+                return self.history_not_written(e)
+        else:
+            history_entries = history_entries.defer(*self.value_columns)
+
+        if filters.validated_data.get('stream') == 'ndjson':
+            return StreamingHttpResponse(
+                self.stream_history(note, history_entries, fields),
+                content_type='application/x-ndjson',
+            )
+
+        paginator = self.pagination_class()
+        page = await paginator.apaginate_queryset(history_entries, request, self)
+        if values:
+            await run_sync(decode_history, note, page)
+        return paginator.get_paginated_response(HistorySerializer(page, many=True, context={'fields': fields}).data)
+
+    async def stream_history(self, note, history_entries, fields=None):
+        rows = history_entries.order_by(*self.pagination_class.ordering).aiterator(chunk_size=self.stream_chunk_size)
+        chunk = []
+        async for row in rows:
+            chunk.append(row)
+            if len(chunk) == self.stream_chunk_size:
+                for line in await self.encode_chunk(note, chunk, fields):
+                    yield line
+                chunk = []
+        for line in await self.encode_chunk(note, chunk, fields):
+            yield line
+
+    async def encode_chunk(self, note, chunk, fields=None):
+        def encode():
+            if self.needs_values(fields):
+                decode_history(note, chunk)
+            return [ndjson_line(record) for record in HistorySerializer(chunk, many=True, context={'fields': fields}).data]
+        return await run_sync(encode) if chunk else []
+
+
+class AsyncNoteEventsView(AsyncAPIView):
+    '''
+        Pushes the changes of the notes the user can access, the entries
+        of their change feed (see `/notes/sync/` and `notes.events`), as
+        they are committed.
+
+        With `Accept: text/event-stream`, as sent by `EventSource`, the
+        response is a server-sent event stream with one event per change
+        (`id:` its `seq`) and a comment every `HEARTBEAT` seconds. The
+        changes after `Last-Event-ID` (sent when the browser reconnects)
+        or `?since=` are sent first, read from the change feed. Behind
+        `notes_management.asgi` the streams are served by
+        `EventStreamApplication` before they reach this view.
+
+        Otherwise, and always when served over WSGI, the request
+        long-polls: the changes after `?since=` are returned at once, or
+        if there are none the first ones committed within `?timeout=`
+        seconds (at most `POLL_TIMEOUT`), as `{"cursor": <seq>,
+        "results": [...]}` where `cursor` is the `since` of the next poll.
+        Without `since` only the changes from now on are returned.
+
+        The change feed is read in the bounded pool, so an open stream
+        holds no thread or connection of its own.
+    '''
+    permission_classes = []
+    replay_batch_size = 500
+
+    async def get(self, request):
+        params = NoteEventsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        config = events_settings()
+        since = params.validated_data.get('since')
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        if since is None and last_event_id.isdigit():
+            since = int(last_event_id)
+        if since is None:
+            since = await self.feed_head()
+
+        if self.wants_stream(request):
+            return StreamingHttpResponse(
+                self.event_stream(request.user.pk, since, config['HEARTBEAT']),
+                content_type='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+            )
+
+        timeout = params.validated_data.get('timeout', config['POLL_TIMEOUT'])
+        if not timeout <= config['POLL_TIMEOUT']:
+            # Also catches NaN
+            timeout = config['POLL_TIMEOUT']
+        hub = get_event_hub()
+        subscriber = hub.subscribe(request.user.pk, since)
+        try:
+            events = await self.changes_since(request.user.pk, since)
+            if not events and timeout:
+                events, resync = await subscriber.wait(timeout)
+                if resync:
+                    events = await self.changes_since(request.user.pk, since)
+        finally:
+            hub.unsubscribe(subscriber)
+        events = sorted((event for event in events if event['seq'] > since), key=lambda event: event['seq'])
+        return Response({'cursor': events[-1]['seq'] if events else since, 'results': events})
+
+    def wants_stream(self, request):
+        return (
+            'text/event-stream' in request.headers.get('Accept', '')
+            and isinstance(request._request, ASGIRequest)
+        )
+
+    async def feed_head(self):
+        return await run_sync(lambda: NoteChange.objects.aggregate(head=Max('seq'))['head'] or 0)
+
+    async def changes_since(self, user_id, since):
+        rows = (
+            NoteChange.objects.for_user(user_id).filter(seq__gt=since).order_by('seq')
+            .values('seq', 'note_id', 'action', 'version')[:self.replay_batch_size]
+        )
+        return await run_sync(list, rows)
+
+    async def event_stream(self, user_id, since, heartbeat):
+        '''
+            Yields the server-sent events of the changes of `user_id` after
+            `since`, forever.
+        '''
+        hub = get_event_hub()
+        subscriber = hub.subscribe(user_id, since)
+        # The events of the last replay, which may be pushed as well
+        last, replayed = since, set()
+
+        def encode(events):
+            nonlocal last
+            messages = []
+            for event in events:
+                if event['seq'] <= since or event['seq'] in replayed:
+                    continue
+                last = max(last, event['seq'])
+                messages.append(b'id: %d\ndata: %s\n\n' % (event['seq'], dumps(event, escape_line_separators=False)))
+            return b''.join(messages)
+
+        try:
+            # Sent right away so that the client sees the stream is open
+            yield b': connected\n\n'
+            resync = True
+            while True:
+                if resync:
+                    replayed = set()
+                    while True:
+                        events = await self.changes_since(user_id, last)
+                        if events:
+                            yield encode(events)
+                            replayed.update(event['seq'] for event in events)
+                        if len(events) < self.replay_batch_size:
+                            break
+                events, resync = await subscriber.wait(heartbeat)
+                message = encode(events)
+                if replayed and events and min(event['seq'] for event in events) > max(replayed):
+                    # Pushes have caught up with the replay
+                    replayed = set()
+                if message:
+                    yield message
+                elif not resync:
+                    yield b': keep-alive\n\n'
+        finally:
+            hub.unsubscribe(subscriber)
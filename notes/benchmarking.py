@@ -0,0 +1,535 @@
+'''
+    In-process HTTP load benchmarks of the notes and users endpoints.
+
+    Requests go through the real WSGI or ASGI application of the project
+    (middleware, authentication with real JWTs, views, database) from a
+    pool of concurrent workers, without any network in between. Every
+    endpoint is benchmarked in its own phase, which gives per-endpoint
+    latency percentiles, throughput and SQL queries per request.
+'''
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+from urllib.parse import urlsplit
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.db import connections
+from django.db.backends.signals import connection_created
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from notes.models import Note
+from notes.seeding import random_text, seed
+
+User = get_user_model()
+
+
+@contextmanager
+def temporary_database(alias='default'):
+    '''
+        Runs the block against a freshly migrated throwaway database file,
+        so benchmarks never touch real data. The block gets its own
+        connection object, as an in-memory SQLite connection cannot be
+        closed and re-pointed.
+    '''
+    previous_connection = connections[alias]
+    connection = connections.create_connection(alias)
+    connections[alias] = connection
+    directory = tempfile.mkdtemp(prefix='notes-benchmark-')
+    old_name = connection.settings_dict['NAME']
+    old_test_name = connection.settings_dict['TEST'].get('NAME')
+    connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+    try:
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    finally:
+        connection.settings_dict['TEST']['NAME'] = old_test_name
+        connections[alias] = previous_connection
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class QueryCounter:
+    '''
+        Counts the SQL queries of every database connection, including the
+        ones opened by worker threads while it is installed.
+    '''
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            self._connections.append(connection)
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        self.install(connection)
+
+    def __enter__(self):
+        for connection in connections.all(initialized_only=True):
+            self.install(connection)
+        connection_created.connect(self.on_connection_created)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.on_connection_created)
+        for connection in self._connections:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    def reset(self):
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+
+@dataclass
+class BenchmarkRequest:
+    method: str
+    path: str
+    body: dict = None  # or raw bytes
+    token: str = None
+
+    def encoded_body(self):
+        if isinstance(self.body, bytes):
+            return self.body
+        return json.dumps(self.body).encode() if self.body is not None else b''
+
+
+class WSGIDriver:
+    '''
+        Calls the WSGI application from a thread pool.
+    '''
+    name = 'wsgi'
+
+    def __init__(self, concurrency):
+        from notes_management.wsgi import application
+        self.application = application
+        self.concurrency = concurrency
+
+    def call(self, request):
+        url = urlsplit(request.path)
+        body = request.encoded_body()
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'PATH_INFO': url.path,
+            'QUERY_STRING': url.query,
+            'SERVER_NAME': '127.0.0.1',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if request.token:
+            environ['HTTP_AUTHORIZATION'] = f'Bearer {request.token}'
+        statuses = []
+
+        def start_response(status, headers, exc_info=None):
+            statuses.append(int(status.split()[0]))
+
+        started = time.perf_counter()
+        response = self.application(environ, start_response)
+        try:
+            for _ in response:
+                pass
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        return time.perf_counter() - started, statuses[0]
+
+    def run(self, requests):
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            return list(executor.map(self.call, requests))
+
+
+class ASGIDriver:
+    '''
+        Calls the ASGI application from `concurrency` coroutines.
+    '''
+    name = 'asgi'
+
+    def __init__(self, concurrency):
+        from notes_management.asgi import application
+        self.application = application
+        self.concurrency = concurrency
+
+    async def call(self, request):
+        url = urlsplit(request.path)
+        body = request.encoded_body()
+        headers = [
+            (b'host', b'127.0.0.1'),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ]
+        if request.token:
+            headers.append((b'authorization', f'Bearer {request.token}'.encode()))
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': request.method,
+            'scheme': 'http',
+            'path': url.path,
+            'raw_path': url.path.encode(),
+            'query_string': url.query.encode(),
+            'root_path': '',
+            'headers': headers,
+            'client': ('127.0.0.1', 0),
+            'server': ('127.0.0.1', 80),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        disconnected = asyncio.Event()
+        statuses = []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            # The client stays connected until the response is complete
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+
+        started = time.perf_counter()
+        await self.application(scope, receive, send)
+        elapsed = time.perf_counter() - started
+        disconnected.set()
+        return elapsed, statuses[0]
+
+    def run(self, requests):
+        async def run_all():
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def bounded(request):
+                async with semaphore:
+                    return await self.call(request)
+
+            return await asyncio.gather(*(bounded(request) for request in requests))
+
+        return asyncio.run(run_all())
+
+
+DRIVERS = {driver.name: driver for driver in (WSGIDriver, ASGIDriver)}
+
+
+class Dataset:
+    '''
+        Seeds the benchmark dataset and hands out request targets: users
+        with their access tokens, notes with their owner and notes shared
+        with a user.
+    '''
+    def __init__(self, seed_options, log=None):
+        self.options = seed_options
+        self.password = seed_options.password
+        self.counts = seed(seed_options, log)
+        self.rng = random.Random(seed_options.seed)
+        self.users = list(
+            User.objects.filter(username__startswith=f'{seed_options.prefix}{seed_options.seed}_')
+            .values_list('pk', 'username')
+        )
+        self.tokens = {pk: str(AccessToken.for_user(User(pk=pk))) for pk, _ in self.users}
+        # Every user may use the export endpoint
+        download = Permission.objects.get(content_type__app_label='notes', codename='download_Note')
+        User.user_permissions.through.objects.bulk_create([
+            User.user_permissions.through(user_id=pk, permission=download) for pk, _ in self.users
+        ], ignore_conflicts=True)
+        self.owned = list(Note.objects.values_list('pk', 'created_by_id'))
+        # One share per note, so no note is deleted twice
+        self.shared = list(dict(Note.accessible_users.through.objects.values_list('note_id', 'user_id')).items())
+        self.sequence = 0
+
+    def next_id(self):
+        self.sequence += 1
+        return self.sequence
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def owned_note(self):
+        return self.rng.choice(self.owned)
+
+    def shared_note(self):
+        '''
+            Returns a (note, user) share that was not handed out before.
+            Raises IndexError once every shared note was used.
+        '''
+        if not self.shared:
+            raise IndexError('every shared note was handed out')
+        return self.shared.pop(self.rng.randrange(len(self.shared)))
+
+
+@dataclass
+class Scenario:
+    '''
+        One benchmarked request type. `route` is the `app:url-name` it
+        exercises and `build(dataset)` returns its next request.
+        `hashes_password` marks routes that run the password hasher on
+        every request, which are driven with fewer requests.
+    '''
+    name: str
+    route: str
+    build: callable
+    expected_status: tuple = (200,)
+    hashes_password: bool = False
+
+
+def _note_get(dataset, prefix='/notes/'):
+    note_id, user_id = dataset.owned_note()
+    return BenchmarkRequest('GET', f'{prefix}{note_id}/', token=dataset.tokens[user_id])
+
+
+def _note_put(dataset, prefix='/notes/'):
+    note_id, user_id = dataset.owned_note()
+    body = {'description': random_text(dataset.rng, dataset.options.description_size)}
+    return BenchmarkRequest('PUT', f'{prefix}{note_id}/', body, dataset.tokens[user_id])
+
+
+def _note_delete(dataset):
+    note_id, user_id = dataset.shared_note()
+    return BenchmarkRequest('DELETE', f'/notes/{note_id}/', token=dataset.tokens[user_id])
+
+
+def _history(dataset, prefix='/notes/'):
+    note_id, user_id = dataset.owned_note()
+    return BenchmarkRequest('GET', f'{prefix}version-history/{note_id}/', token=dataset.tokens[user_id])
+
+
+def _as_of(dataset):
+    note_id, user_id = dataset.owned_note()
+    return BenchmarkRequest('GET', f'/notes/{note_id}/as-of/?version=1', token=dataset.tokens[user_id])
+
+
+def _export(dataset):
+    user_id, _ = dataset.user()
+    return BenchmarkRequest('GET', '/notes/export/?history=true', token=dataset.tokens[user_id])
+
+
+def _list(dataset):
+    user_id, _ = dataset.user()
+    return BenchmarkRequest('GET', '/notes/', token=dataset.tokens[user_id])
+
+
+def _sync(dataset):
+    user_id, _ = dataset.user()
+    return BenchmarkRequest('GET', '/notes/sync/?since=0', token=dataset.tokens[user_id])
+
+
+def _events(dataset):
+    # A long-poll that returns at once
+    user_id, _ = dataset.user()
+    return BenchmarkRequest('GET', f'{ASYNC_PREFIX}events/?since=0&timeout=0', token=dataset.tokens[user_id])
+
+
+def _create(dataset, prefix='/notes/'):
+    user_id, _ = dataset.user()
+    body = {'title': 'Benchmark', 'description': random_text(dataset.rng, dataset.options.description_size)}
+    return BenchmarkRequest('POST', f'{prefix}create/', body, dataset.tokens[user_id])
+
+
+def _share(dataset, prefix='/notes/'):
+    note_id, user_id = dataset.owned_note()
+    body = {'note_id': note_id, 'users': [dataset.user()[0] for _ in range(5)]}
+    return BenchmarkRequest('POST', f'{prefix}share/', body, dataset.tokens[user_id])
+
+
+def _bulk_share(dataset):
+    note_id, user_id = dataset.owned_note()
+    body = {'note_ids': [note_id], 'user_ids': [dataset.user()[0] for _ in range(50)]}
+    return BenchmarkRequest('POST', '/notes/share/bulk/', body, dataset.tokens[user_id])
+
+
+def _batch(dataset):
+    note_id, user_id = dataset.owned_note()
+    body = {'operations': [
+        {'op': 'create', 'title': 'Batched', 'description': random_text(dataset.rng, dataset.options.description_size)},
+        {'op': 'update', 'id': note_id, 'title': f'Batched {dataset.next_id()}'},
+    ]}
+    return BenchmarkRequest('POST', '/notes/batch/', body, dataset.tokens[user_id])
+
+
+def _import(dataset):
+    user_id, _ = dataset.user()
+    body = ''.join(
+        json.dumps({'title': 'Imported', 'description': random_text(dataset.rng, dataset.options.description_size)}) + '\n'
+        for _ in range(20)
+    )
+    return BenchmarkRequest('POST', '/notes/import/', body.encode(), dataset.tokens[user_id])
+
+
+def _signup(dataset):
+    username = f'signup{dataset.options.seed}_{dataset.next_id()}'
+    body = {
+        'username': username,
+        'email': f'{username}@example.com',
+        'password': dataset.password,
+        'first_name': 'Bench',
+        'last_name': 'User',
+    }
+    return BenchmarkRequest('POST', '/api/signup/', body)
+
+
+def _token(dataset):
+    _, username = dataset.user()
+    return BenchmarkRequest('POST', '/api/token/', {'username': username, 'password': dataset.password})
+
+
+def _token_refresh(dataset):
+    user_id, _ = dataset.user()
+    return BenchmarkRequest('POST', '/api/token/refresh/', {'refresh': str(RefreshToken.for_user(User(pk=user_id)))})
+
+
+ASYNC_PREFIX = '/notes/async/'
+
+# Ordered so that the scenarios writing to the database run last
+SCENARIOS = [
+    Scenario('note-retrieve', 'notes:get-edit-note', _note_get),
+    Scenario('note-history', 'notes:get-history', _history),
+    Scenario('note-list', 'notes:list-notes', _list),
+    Scenario('note-as-of', 'notes:note-as-of', _as_of),
+    Scenario('note-export', 'notes:note-export', _export),
+    Scenario('note-sync', 'notes:note-sync', _sync),
+    Scenario('async-note-retrieve', 'notes:async-get-edit-note', partial(_note_get, prefix=ASYNC_PREFIX)),
+    Scenario('async-note-history', 'notes:async-get-history', partial(_history, prefix=ASYNC_PREFIX)),
+    Scenario('async-note-events', 'notes:async-note-events', _events),
+    Scenario('token-refresh', 'users:token_refresh', _token_refresh),
+    Scenario('token-obtain', 'users:token_obtain_pair', _token, hashes_password=True),
+    Scenario('note-create', 'notes:create-user', _create, expected_status=(201,)),
+    Scenario('signup', 'users:create-user', _signup, expected_status=(201,), hashes_password=True),
+    Scenario('async-note-create', 'notes:async-create-note', partial(_create, prefix=ASYNC_PREFIX), expected_status=(201,)),
+    Scenario('note-share', 'notes:note-share', _share),
+    Scenario('async-note-share', 'notes:async-note-share', partial(_share, prefix=ASYNC_PREFIX)),
+    Scenario('note-bulk-share', 'notes:note-bulk-share', _bulk_share),
+    # Concurrent batches updating the same note conflict
+    Scenario('note-batch', 'notes:note-batch', _batch, expected_status=(200, 409)),
+    Scenario('note-import', 'notes:note-import', _import),
+    Scenario('note-update', 'notes:get-edit-note', _note_put),
+    Scenario('async-note-update', 'notes:async-get-edit-note', partial(_note_put, prefix=ASYNC_PREFIX)),
+    Scenario('note-delete', 'notes:get-edit-note', _note_delete, expected_status=(204,)),
+]
+
+
+def route_names():
+    '''
+        Returns every named route of the notes and users apps as
+        `app:url-name`. Both apps name a route `create-user`, so the app
+        label is needed to tell them apart.
+    '''
+    from notes.urls import urlpatterns as notes_urls
+    from users.urls import urlpatterns as users_urls
+    return sorted(
+        f'{app}:{pattern.name}'
+        for app, patterns in (('notes', notes_urls), ('users', users_urls))
+        for pattern in patterns
+        if pattern.name
+    )
+
+
+def uncovered_routes(scenarios=SCENARIOS):
+    '''
+        Returns the routes that no scenario benchmarks.
+    '''
+    covered = {scenario.route for scenario in scenarios}
+    return [route for route in route_names() if route not in covered]
+
+
+def percentile(sorted_values, fraction):
+    '''
+        Nearest-rank percentile of an already sorted list.
+    '''
+    if not sorted_values:
+        return 0.0
+    index = math.ceil(fraction * len(sorted_values)) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+def summarize(results, wall_seconds, queries, expected_status):
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status not in expected_status)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'rps': round(len(results) / wall_seconds, 2) if wall_seconds else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'queries_per_request': round(queries / len(results), 2) if results else 0.0,
+    }
+
+
+def run_benchmark(driver, dataset, requests, password_requests, scenarios=SCENARIOS, log=None):
+    '''
+        Runs every scenario in its own phase and returns the per-endpoint
+        summaries.
+    '''
+    log = log or (lambda message: None)
+    report = {}
+    with QueryCounter() as counter:
+        for scenario in scenarios:
+            count = password_requests if scenario.hashes_password else requests
+            batch = []
+            try:
+                while len(batch) < count:
+                    batch.append(scenario.build(dataset))
+            except IndexError:
+                # The dataset ran out of targets, e.g. notes to delete
+                pass
+            counter.reset()
+            started = time.perf_counter()
+            results = driver.run(batch)
+            wall_seconds = time.perf_counter() - started
+            report[scenario.name] = summarize(results, wall_seconds, counter.reset(), scenario.expected_status)
+            log(f"{scenario.name}: {report[scenario.name]}")
+    return report
+
+
+def compare(report, baseline, max_regression):
+    '''
+        Returns the list of regressions of `report` against `baseline`: p95
+        latency or throughput worse by more than `max_regression` (a
+        fraction), more queries per request, or new errors.
+    '''
+    regressions = []
+    for name, current in report.get('endpoints', {}).items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current['rps'] < previous['rps'] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {previous['rps']} -> {current['rps']} req/s")
+        if current['queries_per_request'] > previous['queries_per_request']:
+            regressions.append(f"{name}: queries/request {previous['queries_per_request']} -> {current['queries_per_request']}")
+        if current['errors'] > previous['errors']:
+            regressions.append(f"{name}: errors {previous['errors']} -> {current['errors']}")
+    return regressions
+
@@ -0,0 +1,257 @@
+'''
+    Read-through cache of serialized notes and their ACL.
+
+    The backend is configured with the `NOTES_CACHE` setting:
+
+        NOTES_CACHE = {
+            'BACKEND': 'notes.cache.LRUCacheBackend',
+            'OPTIONS': {'max_entries': 10000},
+        }
+
+    `notes.cache.DjangoCacheBackend` (OPTIONS: `alias`, `timeout`) stores
+    the entries in one of the Django `CACHES` instead, so several processes
+    can share them.
+
+    Entries are invalidated by the signal handlers in `notes.signals` on
+    `Note.save`, on `accessible_users` changes and on delete, and by the
+    bulk code paths that bypass those signals.
+
+    A reader reads the invalidation epoch of a note before loading it from
+    the database and passes it to `set()`, so that a note loaded before an
+    invalidation is never cached after it: the LRU backend checks the
+    epoch and sets the entry under its lock, the Django cache backend
+    stores the epoch in the entry and rejects it on `get()` once the epoch
+    of its note moved on.
+'''
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connection, transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+DEFAULT_NOTES_CACHE = {
+    'BACKEND': 'notes.cache.LRUCacheBackend',
+    'OPTIONS': {},
+}
+
+
+class LRUCacheBackend:
+    '''
+        Bounded in-process LRU cache.
+    '''
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def set(self, key, value, epoch):
+        '''
+            Caches `value` unless an invalidation happened since `epoch`
+            was read. Returns whether it was cached.
+        '''
+        with self._lock:
+            if self._epoch != epoch:
+                return False
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            return True
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+            self._epoch += 1
+
+    def epoch(self, key):
+        # One epoch for all keys
+        return self._epoch
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._epoch += 1
+
+
+class DjangoCacheBackend:
+    '''
+        Stores the entries in a Django cache so they are shared between
+        processes.
+
+        Every key has an epoch of its own, a random token replaced by each
+        invalidation of the key. Entries are stored with the epoch read
+        before their note was loaded and only served while it is current,
+        so an entry set by a reader that raced an invalidation is never
+        served, whichever process set it.
+    '''
+    def __init__(self, alias='default', timeout=300):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def epoch_key(self, key):
+        return f'{key}:epoch'
+
+    def get(self, key):
+        values = self.cache.get_many([key, self.epoch_key(key)])
+        entry = values.get(key)
+        if entry is None or entry[0] != values.get(self.epoch_key(key)):
+            return None
+        return entry[1]
+
+    def set(self, key, value, epoch):
+        self.cache.set(key, (epoch, value), self.timeout)
+        return True
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        # Outlives every entry cached before it; an epoch evicted earlier
+        # only turns the entries of its key into misses
+        self.cache.set_many({self.epoch_key(key): uuid.uuid4().hex for key in keys}, self.timeout)
+        self.cache.delete_many(keys)
+
+    def epoch(self, key):
+        return self.cache.get(self.epoch_key(key))
+
+    def clear(self):
+        self.cache.clear()
+
+
+class CachedNote(namedtuple('CachedNote', ('pk', 'data', 'owner_id', 'shared_ids', 'version'))):
+    '''
+        A cached note: its serialized representation and its ACL.
+    '''
+    @property
+    def etag(self):
+        return f'"{self.pk}-{self.version}"'
+
+    def subset(self, fields):
+        '''
+            The cached representation limited to `fields` (all when None).
+        '''
+        if fields is None:
+            return self.data
+        return {field: self.data[field] for field in fields}
+
+    def for_user(self, user):
+        '''
+            Returns an object the note permission classes can check, as they
+            would a note loaded with `Note.objects.with_share_flag(user)`.
+        '''
+        return SimpleNamespace(
+            pk=self.pk,
+            created_by_id=self.owner_id,
+            is_shared=user.pk in self.shared_ids,
+        )
+
+
+class NoteCache:
+    '''
+        Read-through cache of notes keyed by id, with hit/miss counters.
+    '''
+    key_prefix = 'notes:note:'
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.counters = {'hits': 0, 'misses': 0, 'sets': 0, 'invalidations': 0}
+        self._lock = threading.Lock()
+
+    def key(self, note_id):
+        return f'{self.key_prefix}{note_id}'
+
+    def epoch(self, note_id):
+        '''
+            Returns the invalidation epoch of the note, to be read before
+            loading it from the database and passed back to `set()`.
+        '''
+        return self.backend.epoch(self.key(note_id))
+
+    def get(self, note_id):
+        entry = self.backend.get(self.key(note_id))
+        self.count('hits' if entry is not None else 'misses')
+        return entry
+
+    def set(self, note, data, epoch):
+        '''
+            Caches `data` (the serialized `note`) with the note's ACL, unless
+            an invalidation happened since `epoch` was read or the note was
+            read inside a transaction that may still roll back.
+        '''
+        key = self.key(note.pk)
+        if connection.in_atomic_block or self.backend.epoch(key) != epoch:
+            return None
+        shared_ids = frozenset(
+            note.accessible_users.through.objects.filter(note_id=note.pk).values_list('user_id', flat=True)
+        )
+        entry = CachedNote(note.pk, data, note.created_by_id, shared_ids, note.version)
+        if not self.backend.set(key, entry, epoch):
+            return None
+        self.count('sets')
+        return entry
+
+    def invalidate(self, *note_ids):
+        self.invalidate_many(note_ids)
+
+    def invalidate_many(self, note_ids):
+        '''
+            Drops the cached notes now and again once the current
+            transaction commits, so a concurrent reader cannot re-cache the
+            pre-commit state.
+        '''
+        keys = [self.key(note_id) for note_id in note_ids]
+        if not keys:
+            return
+        self.backend.delete_many(keys)
+        self.count('invalidations', len(keys))
+        transaction.on_commit(lambda: self.backend.delete_many(keys))
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            for counter in self.counters:
+                self.counters[counter] = 0
+
+
+_note_cache = None
+
+
+def get_note_cache():
+    '''
+        Returns the process wide NoteCache built from `NOTES_CACHE`.
+    '''
+    global _note_cache
+    if _note_cache is None:
+        config = getattr(settings, 'NOTES_CACHE', DEFAULT_NOTES_CACHE)
+        backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+        _note_cache = NoteCache(backend)
+    return _note_cache
+
+
+@receiver(setting_changed)
+def reset_note_cache(setting, **kwargs):
+    global _note_cache
+    if setting == 'NOTES_CACHE':
+        _note_cache = None
@@ -0,0 +1,37 @@
+'''
+    Helpers for conditional requests (If-None-Match / If-Match) on notes.
+'''
+
+
+def parse_etags(header):
+    '''
+        Returns the list of entity tags of an If-Match/If-None-Match header
+        value, keeping the `W/` prefix of weak tags.
+    '''
+    return [etag.strip() for etag in header.split(',') if etag.strip()]
+
+
+def none_match(header, etag):
+    '''
+        Weak comparison used by If-None-Match: True when `etag` is one of
+        the listed tags (or the header is `*`).
+    '''
+    if header is None:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in etags)
+
+
+def match(header, etag):
+    '''
+        Comparison used by If-Match: strong, except that the weak form of
+        `etag` matches too. `CompressionMiddleware` weakens the tags of
+        compressed bodies, but a note tag names the note version whatever
+        the content coding, so a client sending back the tag of a gzip
+        response still means that version.
+    '''
+    if header is None:
+        return True
+    etags = parse_etags(header)
+    return '*' in etags or etag in etags or f'W/{etag}' in etags
+
@@ -0,0 +1,151 @@
+'''
+    Compact text deltas used to store description changes in History.
+
+    A delta is a list of operations applied left to right on a source text:
+
+        - a positive int `n` copies the next `n` characters of the source
+        - a negative int `-n` skips the next `n` characters of the source
+        - a str `s` inserts `s`
+
+    A delta always consumes the whole source, so applying it to the wrong
+    base text is detected instead of silently producing garbage.
+'''
+import difflib
+import json
+
+# Above this many character comparisons the changed middle of the two texts
+# is stored as a plain replacement instead of being diffed further.
+MAX_DIFF_COST = 4_000_000
+
+
+def diff(source, target):
+    '''
+        Returns the delta turning `source` into `target`.
+    '''
+    prefix = _common_prefix(source, target)
+    suffix = _common_prefix(source[prefix:][::-1], target[prefix:][::-1])
+    source_middle = source[prefix:len(source) - suffix]
+    target_middle = target[prefix:len(target) - suffix]
+
+    ops = []
+    _append(ops, prefix)
+    if len(source_middle) * len(target_middle) <= MAX_DIFF_COST:
+        matcher = difflib.SequenceMatcher(None, source_middle, target_middle, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                _append(ops, i2 - i1)
+                continue
+            if i2 > i1:
+                _append(ops, i1 - i2)
+            if j2 > j1:
+                _append(ops, target_middle[j1:j2])
+    else:
+        _append(ops, -len(source_middle))
+        _append(ops, target_middle)
+    _append(ops, suffix)
+    return ops
+
+
+def apply(ops, source):
+    '''
+        Applies the delta `ops` to `source` and returns the new text.
+        Raises ValueError if the delta does not fit `source`.
+    '''
+    position = 0
+    parts = []
+    for op in ops:
+        if isinstance(op, str):
+            parts.append(op)
+        elif isinstance(op, int) and not isinstance(op, bool) and op != 0:
+            end = position + abs(op)
+            if end > len(source):
+                raise ValueError("Delta runs past the end of the source text.")
+            if op > 0:
+                parts.append(source[position:end])
+            position = end
+        else:
+            raise ValueError(f"Invalid delta operation: {op!r}")
+    if position != len(source):
+        raise ValueError("Delta does not cover the whole source text.")
+    return ''.join(parts)
+
+
+def invert(ops, source):
+    '''
+        Returns the delta turning the result of applying `ops` to `source`
+        back into `source`, without diffing the two texts.
+        Raises ValueError if the delta does not fit `source`.
+    '''
+    position = 0
+    inverse = []
+    # The changes since the last copy, written as one skip then one insert
+    # like `diff` does
+    skipped, inserted = 0, []
+
+    def flush():
+        _append(inverse, -skipped)
+        _append(inverse, ''.join(inserted))
+
+    for op in ops:
+        if isinstance(op, str):
+            skipped += len(op)
+        elif isinstance(op, int) and not isinstance(op, bool) and op != 0:
+            end = position + abs(op)
+            if end > len(source):
+                raise ValueError("Delta runs past the end of the source text.")
+            if op > 0:
+                flush()
+                skipped, inserted = 0, []
+                _append(inverse, op)
+            else:
+                inserted.append(source[position:end])
+            position = end
+        else:
+            raise ValueError(f"Invalid delta operation: {op!r}")
+    if position != len(source):
+        raise ValueError("Delta does not cover the whole source text.")
+    flush()
+    return inverse
+
+
+def dumps(ops):
+    return json.dumps(ops, ensure_ascii=False, separators=(',', ':'))
+
+
+def loads(text):
+    ops = json.loads(text)
+    if not isinstance(ops, list):
+        raise ValueError("A delta must be a list of operations.")
+    return ops
+
+
+def _common_prefix(a, b):
+    size = min(len(a), len(b))
+    low, high = 0, size
+    # Binary search on slice equality is much faster than a Python loop
+    # over characters for the long texts this is used on.
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _append(ops, op):
+    '''
+        Appends `op`, merging it into the previous operation of the same
+        kind and dropping no-ops.
+    '''
+    if op == 0 or op == '':
+        return
+    if ops:
+        last = ops[-1]
+        if isinstance(op, str) and isinstance(last, str):
+            ops[-1] = last + op
+            return
+        if isinstance(op, int) and isinstance(last, int) and (op > 0) == (last > 0):
+            ops[-1] = last + op
+            return
+    ops.append(op)
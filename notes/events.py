@@ -0,0 +1,347 @@
+'''
+    Push of note changes to connected clients.
+
+    Every entry of the change feed (`NoteChange`, read by `/notes/sync/`)
+    is also published, once its transaction commits, as an event for the
+    users it concerns: the owner of the note and the users it is shared
+    with, or the one user of a share or unshare. `EventHub` hands the
+    events to the subscribers of those users in this process: the `notes/async/events/`
+    connections, which wait on the event loop without holding a thread.
+    How events travel between processes is up to the broker configured
+    with `NOTES_EVENTS`:
+
+        NOTES_EVENTS = {
+            'BACKEND': 'notes.events.LocalBroker',
+            'OPTIONS': {},
+            'MAX_QUEUE': 100,       # events queued per connection
+            'HEARTBEAT': 15,        # seconds between SSE keep-alives
+            'POLL_TIMEOUT': 25,     # longest long-poll wait in seconds
+        }
+
+    `LocalBroker` hands the events straight to the hub of the publishing
+    process, which is enough when one ASGI process serves every request.
+    With `ChangeFeedBroker` (OPTIONS: `interval`, `batch_size`) every
+    process polls the change feed instead, so changes written by any
+    process, WSGI workers included, reach the subscribers of all of them.
+    Other transports subclass `BaseBroker`.
+
+    A subscriber that falls `MAX_QUEUE` events behind is marked for a
+    resync and catches up from the change feed, so no event is lost.
+'''
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('notes.events')
+
+DEFAULT_NOTES_EVENTS = {
+    'BACKEND': 'notes.events.LocalBroker',
+    'OPTIONS': {},
+    'MAX_QUEUE': 100,
+    'HEARTBEAT': 15,
+    'POLL_TIMEOUT': 25,
+}
+
+
+def events_settings():
+    return {**DEFAULT_NOTES_EVENTS, **getattr(settings, 'NOTES_EVENTS', {})}
+
+
+def change_event(entry):
+    '''
+        Returns the `(user id, event)` pair of a NoteChange entry or of its
+        `values()` dict. The user id is None for the changes of a note,
+        which go to every user who can see it.
+    '''
+    if not isinstance(entry, dict):
+        entry = {field: getattr(entry, field) for field in ('seq', 'user_id', 'note_id', 'action', 'version')}
+    return entry['user_id'], {
+        'seq': entry['seq'],
+        'note_id': entry['note_id'],
+        'action': entry['action'],
+        'version': entry['version'],
+    }
+
+
+class Subscriber:
+    '''
+        One connection waiting for the events of a user. Only touched from
+        the event loop it was created on.
+    '''
+    __slots__ = ('user_id', 'loop', 'events', 'max_queue', 'resync', 'waiter')
+
+    def __init__(self, user_id, loop, max_queue):
+        self.user_id = user_id
+        self.loop = loop
+        self.events = deque()
+        self.max_queue = max_queue
+        self.resync = False
+        self.waiter = None
+
+    def push(self, events):
+        for event in events:
+            if len(self.events) >= self.max_queue:
+                self.resync = True
+                break
+            self.events.append(event)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait(self, timeout):
+        '''
+            Waits up to `timeout` seconds for events and returns them with
+            the resync flag, which asks the caller to read the change feed.
+        '''
+        if not self.events and not self.resync:
+            self.waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiter = None
+        events, resync = list(self.events), self.resync
+        self.events.clear()
+        self.resync = False
+        return events, resync
+
+
+class EventHub:
+    '''
+        Process wide registry of the subscribers, by user.
+    '''
+    def __init__(self, broker, max_queue=100):
+        self.broker = broker
+        self.max_queue = max_queue
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        broker.attach(self)
+
+    def subscribe(self, user_id, since):
+        '''
+            Returns a Subscriber of the running event loop for the events
+            of `user_id` after the `since` sequence number. The caller reads
+            the change feed after `since` once subscribed, as events
+            committed before may not be delivered.
+        '''
+        subscriber = Subscriber(user_id, asyncio.get_running_loop(), self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+        self.broker.subscribed(since)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.user_id]
+
+    def publish(self, events):
+        '''
+            Publishes the `(user id, event)` pairs of `events` through the
+            broker.
+        '''
+        if events:
+            self.broker.publish(events)
+
+    def dispatch(self, events):
+        '''
+            Hands the `(user id, event)` pairs of `events` to the local
+            subscribers of their user. The events of a note, with no user,
+            go to the subscribers who own it or that it is shared with,
+            looked up with one query each for the owners and the shares.
+            Safe to call from any thread.
+        '''
+        if not self._subscribers:
+            return
+        by_user = {}
+        by_note = {}
+        for user_id, event in events:
+            if user_id is None:
+                by_note.setdefault(event['note_id'], []).append(event)
+            else:
+                by_user.setdefault(user_id, []).append(event)
+        if by_note:
+            from notes.models import NoteChange
+
+            with self._lock:
+                subscribed = list(self._subscribers)
+            for note_id, user_ids in NoteChange.objects.audience(by_note, subscribed).items():
+                for user_id in user_ids:
+                    by_user.setdefault(user_id, []).extend(by_note[note_id])
+            for user_events in by_user.values():
+                user_events.sort(key=lambda event: event['seq'])
+        with self._lock:
+            targets = [
+                (subscriber, by_user[user_id])
+                for user_id in by_user.keys() & self._subscribers.keys()
+                for subscriber in self._subscribers[user_id]
+            ]
+        for subscriber, user_events in targets:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.push, user_events)
+            except RuntimeError:
+                # The loop of the connection is closed
+                self.unsubscribe(subscriber)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._subscribers),
+                'subscribers': sum(len(subscribers) for subscribers in self._subscribers.values()),
+            }
+
+    def close(self):
+        self.broker.close()
+
+
+class BaseBroker:
+    '''
+        Carries published events to the hub of every process. `attach()`
+        receives the hub of this process, `publish()` the `(user id,
+        event)` pairs of committed changes, to be delivered to every hub
+        with `hub.dispatch()`.
+    '''
+    def attach(self, hub):
+        self.hub = hub
+
+    def publish(self, events):
+        raise NotImplementedError
+
+    def subscribed(self, since):
+        '''
+            Called on every new subscription with its `since`, e.g. to
+            start listening.
+        '''
+
+    def close(self):
+        pass
+
+
+class LocalBroker(BaseBroker):
+    '''
+        Delivers the events to the subscribers of this process only.
+    '''
+    def publish(self, events):
+        self.hub.dispatch(events)
+
+
+class ChangeFeedBroker(BaseBroker):
+    '''
+        Delivers the changes committed by any process: a thread polls the
+        change feed every `interval` seconds while this process has
+        subscribers, starting from the `since` of the first one. Nothing
+        is sent on publish, the feed rows are the messages.
+    '''
+    def __init__(self, interval=1.0, batch_size=1000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_seq = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def publish(self, events):
+        pass
+
+    def subscribed(self, since):
+        with self._lock:
+            if self.last_seq is None:
+                self.last_seq = since
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self.run, name='notes-events', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Could not read the change feed")
+            finally:
+                close_old_connections()
+
+    def poll(self):
+        '''
+            Dispatches the feed entries written since the last poll and
+            returns their number.
+        '''
+        from notes.models import NoteChange
+
+        dispatched = 0
+        while True:
+            with self._lock:
+                if not self.hub.has_subscribers():
+                    # Start again from the `since` of the next subscriber
+                    self.last_seq = None
+                last_seq = self.last_seq
+            if last_seq is None:
+                return dispatched
+            rows = list(
+                NoteChange.objects.filter(seq__gt=last_seq).order_by('seq')
+                .values('seq', 'user_id', 'note_id', 'action', 'version')[:self.batch_size]
+            )
+            if not rows:
+                return dispatched
+            self.hub.dispatch([change_event(row) for row in rows])
+            with self._lock:
+                if self.last_seq is not None:
+                    self.last_seq = max(self.last_seq, rows[-1]['seq'])
+            dispatched += len(rows)
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+
+def publish_changes(entries):
+    '''
+        Publishes the NoteChange `entries` once the current transaction
+        commits (right away outside of one).
+    '''
+    events = [change_event(entry) for entry in entries]
+    if events:
+        transaction.on_commit(lambda: get_event_hub().publish(events))
+
+
+_event_hub = None
+_event_hub_lock = threading.Lock()
+
+
+def get_event_hub():
+    '''
+        Returns the process wide EventHub built from `NOTES_EVENTS`.
+    '''
+    global _event_hub
+    with _event_hub_lock:
+        if _event_hub is None:
+            config = events_settings()
+            broker = import_string(config['BACKEND'])(**config['OPTIONS'])
+            _event_hub = EventHub(broker, max_queue=config['MAX_QUEUE'])
+        return _event_hub
+
+
+@receiver(setting_changed)
+def reset_event_hub(setting, **kwargs):
+    global _event_hub
+    if setting == 'NOTES_EVENTS':
+        with _event_hub_lock:
+            if _event_hub is not None:
+                _event_hub.close()
+            _event_hub = None
@@ -0,0 +1,151 @@
+'''
+    Streaming export of the notes a user can access.
+
+    Notes are read in id order with `.iterator(chunk_size=...)` and the
+    History of every chunk with one more query, so memory depends on the
+    chunk size and not on the number of notes. Every record carries the
+    note id: an interrupted export is resumed with `after=<last id>`.
+
+    Formats: NDJSON (one note per line), CSV (the history as a JSON array
+    column) and a zip archive holding `notes.ndjson`.
+'''
+import csv
+import json
+import zipfile
+from collections import defaultdict
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from notes.history_writer import wait_for_history
+from notes.models import History, Note
+from notes.streaming import iter_chunks, ndjson_line
+from notes.versions import decode_complete_history
+
+NOTE_FIELDS = ('id', 'title', 'description', 'created_by', 'created_at', 'updated_at', 'version')
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+    'zip': 'application/zip',
+}
+
+_encoder = JSONEncoder()
+
+
+def _value(value):
+    '''
+        Datetimes as DRF renders them, everything else unchanged.
+    '''
+    if value is None or isinstance(value, (str, int)):
+        return value
+    return _encoder.default(value)
+
+
+def history_record(entry):
+    return {
+        'version': entry.version,
+        'field': entry.field,
+        'updated_by': entry.updated_by_id,
+        'created_at': _value(entry.created_at),
+        'old_value': entry.old_value,
+        'new_value': entry.new_value,
+        'activity': entry.activity,
+    }
+
+
+def export_records(user, after=None, include_history=False, chunk_size=500):
+    '''
+        Yields the record of every note `user` can access with an id above
+        `after`, in id order, with its decoded history when
+        `include_history` is set. Notes are read as plain values, model
+        instances (and their FieldTracker cycles) are not needed here.
+    '''
+    notes = Note.objects.accessible_to(user).order_by('pk')
+    if after is not None:
+        notes = notes.filter(pk__gt=after)
+    notes = notes.values_list('pk', 'title', 'description', 'created_by_id', 'created_at', 'updated_at', 'version')
+    if include_history:
+        wait_for_history()
+    for chunk in iter_chunks(notes.iterator(chunk_size=chunk_size), chunk_size):
+        histories = defaultdict(list)
+        if include_history:
+            entries = History.objects.filter(note_id__in=[row[0] for row in chunk]).order_by('note_id', 'version', 'id')
+            versions = {row[0]: row[-1] for row in chunk}
+            for entry in entries.iterator(chunk_size=chunk_size):
+                # Saves committed after the note was read are left out
+                if entry.version <= versions[entry.note_id]:
+                    histories[entry.note_id].append(entry)
+        for row in chunk:
+            record = {name: _value(value) for name, value in zip(NOTE_FIELDS, row)}
+            if include_history:
+                entries = decode_complete_history(record['description'], histories.pop(record['id'], []), record['version'])
+                record['history'] = [history_record(entry) for entry in entries]
+            yield record
+
+
+def ndjson_stream(records):
+    for record in records:
+        yield ndjson_line(record)
+
+
+class _Echo:
+    '''
+        File-like object handing back what the csv writer writes.
+    '''
+    def write(self, value):
+        return value
+
+
+def csv_stream(records, include_history=False):
+    writer = csv.writer(_Echo())
+    columns = NOTE_FIELDS + (('history',) if include_history else ())
+    yield writer.writerow(columns)
+    for record in records:
+        if include_history:
+            record['history'] = json.dumps(record['history'], ensure_ascii=False, separators=(',', ':'))
+        yield writer.writerow([record[column] for column in columns])
+
+
+class _ZipBuffer:
+    '''
+        Unseekable sink for `zipfile`, collecting the archive bytes until
+        they are taken.
+    '''
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(lines, name='notes.ndjson'):
+    '''
+        Yields a deflated zip archive with one member `name` holding
+        `lines`, as the compressor produces it.
+    '''
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(name, 'w', force_zip64=True) as member:
+            for line in lines:
+                member.write(line.encode())
+                data = buffer.take()
+                if data:
+                    yield data
+    yield buffer.take()
+
+
+def export_stream(records, output, include_history=False):
+    if output == 'csv':
+        return csv_stream(records, include_history)
+    if output == 'zip':
+        return zip_stream(ndjson_stream(records))
+    return ndjson_stream(records)
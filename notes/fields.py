@@ -0,0 +1,139 @@
+'''
+    Model fields of the notes app.
+
+    `CompressedTextField` is a TextField storing long values zlib
+    compressed. A stored value is either the plain text or `MARKER`
+    followed by the base64 encoded zlib stream, so rows written before the
+    field was introduced (or below the threshold) stay readable as they
+    are:
+
+        NOTES_COMPRESSION_THRESHOLD = 1024    # UTF-8 bytes, None disables
+        NOTES_COMPRESSION_LEVEL = 6
+
+    A value is only stored compressed when that is actually smaller.
+    Compression happens when a value is written (`save`, `update`,
+    `bulk_create`) and decompression when it is read, the model attribute
+    always holds the plain text. Lookups other than `isnull` compare
+    against the stored form, so compressed columns are not filtered on.
+'''
+import base64
+import zlib
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.functions import Cast
+
+MARKER = '\x01z:'
+
+
+def compression_threshold():
+    return getattr(settings, 'NOTES_COMPRESSION_THRESHOLD', 1024)
+
+
+def compress(text, threshold=None, level=None):
+    '''
+        Returns the stored form of `text`.
+    '''
+    if threshold is None:
+        threshold = compression_threshold()
+    marked = text.startswith(MARKER)
+    if threshold is None and not marked:
+        return text
+    data = text.encode()
+    if len(data) < (threshold or 0) and not marked:
+        return text
+    if level is None:
+        level = getattr(settings, 'NOTES_COMPRESSION_LEVEL', 6)
+    stored = MARKER + base64.b64encode(zlib.compress(data, level)).decode('ascii')
+    # A plain text starting with the marker is always compressed, so that
+    # it cannot be mistaken for a compressed one
+    if len(stored) < len(text) or marked:
+        return stored
+    return text
+
+
+def decompress(value):
+    '''
+        Returns the text of the stored `value`, compressed or not.
+    '''
+    if not value.startswith(MARKER):
+        return value
+    return zlib.decompress(base64.b64decode(value[len(MARKER):])).decode()
+
+
+def is_compressed(value):
+    return value.startswith(MARKER)
+
+
+class CompressedTextField(models.TextField):
+    '''
+        TextField compressing its values above `NOTES_COMPRESSION_THRESHOLD`
+        bytes (see the module docstring).
+    '''
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress(value)
+
+    def get_db_prep_save(self, value, connection):
+        value = super().get_db_prep_save(value, connection)
+        if isinstance(value, str):
+            return compress(value)
+        return value
+
+
+def compress_existing(model, fields, chunk_size=500):
+    '''
+        Rewrites the values of `fields` in the rows of `model` that are over
+        the threshold and still stored as plain text, `chunk_size` rows at a
+        time. Returns the number of values compressed.
+    '''
+    threshold = compression_threshold()
+    if threshold is None:
+        return 0
+    manager = model._base_manager
+    # The stored values as they are, without the field's converter
+    stored = [Cast(field, models.TextField()) for field in fields]
+    compressed, last = 0, 0
+    while True:
+        rows = list(manager.filter(pk__gt=last).order_by('pk').values_list('pk', *stored)[:chunk_size])
+        if not rows:
+            return compressed
+        last = rows[-1][0]
+        for index, field in enumerate(fields, 1):
+            batch = [
+                model(pk=row[0], **{field: row[index]})
+                for row in rows
+                if row[index] is not None and not is_compressed(row[index]) and compress(row[index], threshold) != row[index]
+            ]
+            if batch:
+                with transaction.atomic():
+                    manager.bulk_update(batch, [field])
+                compressed += len(batch)
+
+
+def decompress_existing(model, fields, chunk_size=500):
+    '''
+        Stores the compressed values of `fields` in the rows of `model` as
+        plain text again. Returns the number of values decompressed.
+    '''
+    manager = model._base_manager
+    decompressed = 0
+    for field in fields:
+        raw = Cast(field, models.TextField())
+        last = 0
+        while True:
+            rows = list(
+                manager.annotate(stored=raw)
+                .filter(pk__gt=last, stored__startswith=MARKER)
+                .order_by('pk')
+                .values_list('pk', 'stored')[:chunk_size]
+            )
+            if not rows:
+                break
+            last = rows[-1][0]
+            with transaction.atomic():
+                for pk, value in rows:
+                    manager.filter(pk=pk).update(**{field: models.Value(decompress(value), output_field=models.TextField())})
+            decompressed += len(rows)
+    return decompressed
@@ -0,0 +1,544 @@
+'''
+    Write-behind History logging.
+
+    With `NOTES_HISTORY_WRITE_BEHIND['ENABLED']`, `Note.save()` no longer
+    inserts its History rows itself. Once the save's transaction commits,
+    the rows are appended to an on-disk spool and put on a bounded
+    in-memory queue, and a background thread writes them in batches with
+    one `bulk_create` each:
+
+        NOTES_HISTORY_WRITE_BEHIND = {
+            'ENABLED': True,
+            'MAX_QUEUE': 10000,       # saves waiting in memory
+            'BATCH_SIZE': 500,        # rows per INSERT
+            'FLUSH_INTERVAL': 0.2,    # seconds a partial batch waits
+            'SPOOL_DIR': BASE_DIR / 'history-spool',
+            'FSYNC': False,           # fsync the spool on every append
+        }
+
+    Delivery is at least once: a spool segment is deleted only after all of
+    its rows are written, and the segments left behind by a crash are
+    replayed by the background thread of the next writer before it takes
+    new rows, outside of any request's transaction (or by the
+    `replay_history_spool` command). Replays are harmless because of the unique (note, field,
+    version) constraint on History.
+
+    Every writer spools to a directory of its own under `SPOOL_DIR`, held
+    with an exclusive lock (`<directory>.lock`, released by the kernel if
+    the process dies), so processes sharing `SPOOL_DIR` never number their
+    segments alike and a replay only takes the directories whose lock is
+    free, those of writers that are gone.
+
+    Versions are still assigned inside the save's transaction, under the
+    note's version check, so they stay gap-free and ordered per note
+    whenever their rows get written, and the rows of one save are written
+    by the same INSERT. `created_at` is set when the rows are built and
+    spooled with them, so it is the time of the save, not of the INSERT. Readers of a note's history call
+    `wait_for_history()` first so that the rows captured by this process
+    are in the table before the delta chain is walked. That does not cover
+    the rows of other processes, nor those still pending after its
+    timeout: every INSERT advances the `history_version` watermark of its
+    notes, and `notes.versions.check_history_written()` tells from it when
+    the history of a note is behind its version.
+
+    The rows are spooled by an `on_commit` callback, after the note is
+    committed: a crash between the commit and the spool append loses them
+    (the note keeps a version without History rows). `FSYNC` only covers
+    the rows once they are appended.
+
+    When the queue is full the saving thread writes its rows itself, and the
+    queue is drained when the process exits.
+'''
+import atexit
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+from django.dispatch import receiver
+
+logger = logging.getLogger('notes.history')
+
+DEFAULT_WRITE_BEHIND = {
+    'ENABLED': False,
+    'MAX_QUEUE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 0.2,
+    'SPOOL_DIR': os.path.join(settings.BASE_DIR, 'history-spool'),
+    'FSYNC': False,
+}
+
+# History columns carried through the spool
+ROW_FIELDS = (
+    'note_id', 'updated_by_id', 'field', 'version', 'encoding', 'old_value', 'new_value', 'delta', 'activity',
+    'created_at',
+)
+
+# Seconds a save waits for room in a full queue before writing its rows itself
+QUEUE_FULL_TIMEOUT = 1.0
+
+_stop = object()
+
+
+def write_behind_settings():
+    return {**DEFAULT_WRITE_BEHIND, **getattr(settings, 'NOTES_HISTORY_WRITE_BEHIND', {})}
+
+
+def history_row(entry):
+    '''
+        The spooled form of an unsaved History object. `created_at` is
+        spooled as an ISO 8601 string, parsed back when the row is inserted.
+    '''
+    row = {field: entry._meta.get_field(field).get_prep_value(getattr(entry, field)) for field in ROW_FIELDS}
+    row['created_at'] = row['created_at'].isoformat()
+    return row
+
+
+def insert_rows(rows):
+    '''
+        Inserts History `rows` in one statement, sorted by note and version,
+        and advances the `history_version` of their notes in the same
+        transaction. Rows already written by an earlier attempt and rows of
+        notes purged in the meantime are skipped. Returns the number of
+        rows sent.
+    '''
+    from notes.models import History, Note
+
+    note_ids = set(Note.all_objects.filter(pk__in={row['note_id'] for row in rows}).values_list('pk', flat=True))
+    entries = [
+        History(**row)
+        for row in sorted(rows, key=lambda row: (row['note_id'], row['version'], row['field']))
+        if row['note_id'] in note_ids
+    ]
+    # The INSERT takes the write lock first, so concurrent writers see
+    # each other's rows when they advance the watermarks
+    with transaction.atomic():
+        History.objects.bulk_create(entries, ignore_conflicts=True)
+        advance_history_versions(note_ids)
+    return len(entries)
+
+
+def advance_history_versions(note_ids):
+    '''
+        Moves the `history_version` of the notes `note_ids` up to the last
+        version below which all their History rows are written and returns
+        `{note_id: history_version}`. Only the rows above the current
+        watermarks are read, which are the rows still being written behind.
+    '''
+    from notes.models import History, Note
+
+    watermarks = dict(Note.all_objects.filter(pk__in=note_ids).values_list('pk', 'history_version'))
+    written = defaultdict(set)
+    rows = History.objects.filter(note_id__in=watermarks, version__gt=F('note__history_version'))
+    for note_id, version in rows.values_list('note_id', 'version'):
+        written[note_id].add(version)
+    advanced = {}
+    for note_id, watermark in watermarks.items():
+        # Every version above 1 has at least one row
+        version = watermark
+        while version + 1 in written[note_id]:
+            version += 1
+        if version > watermark:
+            advanced[note_id] = version
+        watermarks[note_id] = version
+    if advanced:
+        # Never moved back by a writer that read an older watermark
+        Note.all_objects.filter(pk__in=advanced).update(history_version=Greatest(
+            'history_version', Case(*(When(pk=pk, then=Value(version)) for pk, version in advanced.items())),
+        ))
+    return watermarks
+
+
+class Spool:
+    '''
+        Append-only JSON lines files ("segments") holding the rows that are
+        not written yet. A segment is deleted once every row in it is
+        acknowledged, a new one is started every `segment_size` rows. The
+        directory is created with the first segment.
+    '''
+    def __init__(self, directory, fsync=False, segment_size=10000):
+        self.directory = os.path.normpath(str(directory))
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self.pending = Counter()
+        self.segment = max(self.segments(), default=0)
+        self._file = None
+        self._count = 0
+        self._lock = threading.Lock()
+        self._claim = None
+
+    @property
+    def lock_path(self):
+        return self.directory + '.lock'
+
+    def claim(self):
+        '''
+            Takes the exclusive lock of the spool until `release()`. Returns
+            False when another process holds it.
+        '''
+        os.makedirs(os.path.dirname(self.directory), exist_ok=True)
+        claim = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Released and deleted by its holder since it was opened
+            if os.fstat(claim.fileno()).st_ino != os.stat(self.lock_path).st_ino:
+                raise FileNotFoundError(self.lock_path)
+        except OSError:
+            claim.close()
+            return False
+        self._claim = claim
+        return True
+
+    def release(self, remove=True):
+        '''
+            Drops the lock of the spool, deleting the directory first when
+            `remove` and no segment is left in it.
+        '''
+        if self._claim is None:
+            return
+        if remove and not self.segments():
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+        os.remove(self.lock_path)
+        self._claim.close()
+        self._claim = None
+
+    def path(self, segment):
+        return os.path.join(self.directory, f'{segment:012d}.jsonl')
+
+    def segments(self):
+        '''
+            Numbers of the segments on disk, oldest first.
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            int(name[:-len('.jsonl')])
+            for name in os.listdir(self.directory)
+            if name.endswith('.jsonl') and name[:-len('.jsonl')].isdigit()
+        )
+
+    def read(self, segment):
+        '''
+            Rows of `segment`. A line torn by a crash mid-append is skipped.
+        '''
+        with open(self.path(segment)) as spool:
+            for line in spool:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping a truncated line in history spool segment %s", segment)
+
+    def append(self, rows):
+        '''
+            Writes `rows` to the current segment and returns its number.
+        '''
+        with self._lock:
+            if self._file is None or self._count >= self.segment_size:
+                self._rotate()
+            self._file.write(''.join(json.dumps(row, separators=(',', ':')) + '\n' for row in rows))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._count += len(rows)
+            self.pending[self.segment] += len(rows)
+            return self.segment
+
+    def ack(self, segment, count):
+        '''
+            Marks `count` rows of `segment` as written.
+        '''
+        with self._lock:
+            self.pending[segment] -= count
+            if self.pending[segment] <= 0 and segment != self.segment:
+                del self.pending[segment]
+                self._remove(segment)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                if self.pending[self.segment] <= 0:
+                    self._remove(self.segment)
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+            if self.pending[self.segment] <= 0:
+                self._remove(self.segment)
+        self.segment += 1
+        os.makedirs(self.directory, exist_ok=True)
+        self._file = open(self.path(self.segment), 'a')
+        self._count = 0
+
+    def _remove(self, segment):
+        try:
+            os.remove(self.path(segment))
+        except FileNotFoundError:
+            pass
+
+
+def replay_spool(directory, batch_size=500):
+    '''
+        Writes the rows left in the spool `directory` and deletes their
+        segments: its own segments and those of every writer spool in it
+        whose lock is free. Spools locked by a running writer, or a
+        `directory` locked by a concurrent replay, are skipped. Returns the
+        number of rows replayed.
+    '''
+    root = Spool(directory)
+    if not root.claim():
+        return 0
+    replayed = 0
+    try:
+        replayed += _replay_segments(root, batch_size)
+        names = os.listdir(root.directory) if os.path.isdir(root.directory) else []
+        # A writer gone before its first segment only leaves its lock file
+        names = {
+            name[:-len('.lock')] if name.endswith('.lock') else name
+            for name in names
+            if name.endswith('.lock') or os.path.isdir(os.path.join(root.directory, name))
+        }
+        for name in sorted(names):
+            spool = Spool(os.path.join(root.directory, name))
+            if spool.claim():
+                try:
+                    replayed += _replay_segments(spool, batch_size)
+                finally:
+                    spool.release()
+    finally:
+        root.release(remove=False)
+    if replayed:
+        logger.info("Replayed %s History rows from %s", replayed, root.directory)
+    return replayed
+
+
+def _replay_segments(spool, batch_size):
+    replayed = 0
+    for segment in spool.segments():
+        batch = []
+        for row in spool.read(segment):
+            # Batches end between versions, the rows of a save go together
+            if len(batch) >= batch_size and (row['note_id'], row['version']) != (batch[-1]['note_id'], batch[-1]['version']):
+                replayed += insert_rows(batch)
+                batch = []
+            batch.append(row)
+        if batch:
+            replayed += insert_rows(batch)
+        spool._remove(segment)
+    return replayed
+
+
+class HistoryWriter:
+    '''
+        Background thread writing the captured History rows in batches.
+    '''
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=0.2, spool_dir=None, fsync=False):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir or DEFAULT_WRITE_BEHIND['SPOOL_DIR']
+        self.spool = Spool(os.path.join(self.spool_dir, f'{os.getpid()}-{uuid.uuid4().hex[:12]}'), fsync=fsync)
+        if not self.spool.claim():
+            raise OSError(f"Could not lock the history spool {self.spool.directory}")
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stats = Counter()
+        self._pending = 0
+        self._replaying = True
+        self._idle = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self.run, name='history-writer', daemon=True)
+        self._thread.start()
+
+    def capture(self, entries):
+        '''
+            Spools the unsaved History `entries` and queues them for the
+            background thread. Meant to run once their note is committed.
+        '''
+        rows = [history_row(entry) for entry in entries]
+        try:
+            segment = self.spool.append(rows)
+        except OSError:
+            logger.exception("Could not spool %s History rows, writing them directly", len(rows))
+            self.write([(None, row) for row in rows])
+            return
+        with self._idle:
+            self._pending += len(rows)
+        self.stats['captured'] += len(rows)
+        # One item, so the rows of a save go into the same INSERT
+        items = [(segment, row) for row in rows]
+        try:
+            self.queue.put(items, timeout=QUEUE_FULL_TIMEOUT)
+        except queue.Full:
+            self.stats['overflow'] += len(rows)
+            self.write(items)
+
+    def replay(self):
+        '''
+            Writes the rows left in `spool_dir` by writers that are gone.
+            Runs first on the background thread: the writer is typically
+            created by a save, inside its transaction, and replayed rows
+            must not be rolled back with it once their segments are deleted.
+        '''
+        try:
+            replay_spool(self.spool_dir, self.batch_size)
+        except DatabaseError:
+            logger.exception("Could not replay the history spool %s", self.spool_dir)
+            close_old_connections()
+        finally:
+            with self._idle:
+                self._replaying = False
+                self._idle.notify_all()
+
+    def run(self):
+        try:
+            self.replay()
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+                if item is _stop:
+                    break
+                batch = list(item)
+                stop = False
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is _stop:
+                        stop = True
+                        break
+                    batch.extend(item)
+                self.write(batch)
+                if stop:
+                    break
+        finally:
+            close_old_connections()
+
+    def write(self, batch, attempts=5):
+        '''
+            Inserts the `(segment, row)` items of `batch`, retrying with a
+            backoff. Rows that still fail stay in the spool for the next
+            replay.
+        '''
+        for attempt in range(attempts):
+            try:
+                insert_rows([row for segment, row in batch])
+            except DatabaseError:
+                logger.exception("Could not write %s History rows (attempt %s)", len(batch), attempt + 1)
+                close_old_connections()
+                time.sleep(min(2 ** attempt * 0.1, 2))
+            else:
+                self.stats['written'] += len(batch)
+                self.stats['batches'] += 1
+                for segment, count in Counter(segment for segment, row in batch).items():
+                    if segment is not None:
+                        self.spool.ack(segment, count)
+                break
+        else:
+            self.stats['failed'] += len(batch)
+        with self._idle:
+            self._pending -= sum(1 for segment, row in batch if segment is not None)
+            self._idle.notify_all()
+
+    def flush(self, timeout=5):
+        '''
+            Waits until the spool left by earlier writers is replayed and
+            every captured row is written (or given up on). Returns False on
+            timeout.
+        '''
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._replaying and self._pending <= 0, timeout)
+
+    def stop(self, timeout=30):
+        '''
+            Writes what is queued and stops the thread.
+        '''
+        if self._stopped:
+            return
+        self._stopped = True
+        self.queue.put(_stop)
+        self._thread.join(timeout)
+        # Rows captured after the thread stopped
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _stop:
+                batch.extend(item)
+            if len(batch) >= self.batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+        self.spool.close()
+        # Segments of rows not written are left for the next replay
+        self.spool.release()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_history_writer():
+    '''
+        Returns the process wide HistoryWriter, or None when write-behind
+        is disabled.
+    '''
+    global _writer
+    options = write_behind_settings()
+    if not options['ENABLED']:
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = HistoryWriter(
+                    max_queue=options['MAX_QUEUE'],
+                    batch_size=options['BATCH_SIZE'],
+                    flush_interval=options['FLUSH_INTERVAL'],
+                    spool_dir=options['SPOOL_DIR'],
+                    fsync=options['FSYNC'],
+                )
+    return _writer
+
+
+def wait_for_history(timeout=5):
+    '''
+        Waits for the History rows captured by this process to be written.
+        A no-op when write-behind is disabled.
+    '''
+    writer = _writer if write_behind_settings()['ENABLED'] else None
+    if writer is not None and not writer.flush(timeout):
+        logger.warning("History rows still pending after %s seconds", timeout)
+
+
+@atexit.register
+def stop_history_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.stop()
+            _writer = None
+
+
+@receiver(setting_changed)
+def reset_history_writer(setting, **kwargs):
+    if setting == 'NOTES_HISTORY_WRITE_BEHIND':
+        stop_history_writer()
@@ -0,0 +1,202 @@
+'''
+    Streaming import of notes from NDJSON or CSV.
+
+    Rows are parsed one line at a time, validated in batches with the
+    semantics of `NotesSerializer` (plus the user ids of `shared_with` and,
+    without an owner, `created_by`, each resolved with one query per
+    batch), and inserted with `bulk_create` in one short transaction per
+    batch, together with their share rows. Invalid rows are reported with
+    their line number and skipped; they never abort the load.
+
+    Every row holds a `title` and a `description`, optionally `shared_with`
+    (user ids: a JSON list, or in CSV also a comma or space separated
+    string) and `created_by` (used when no owner is given).
+'''
+import csv
+import json
+import re
+import time
+from dataclasses import dataclass, field
+
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, transaction
+from rest_framework import serializers
+
+from notes.models import Note, NoteChange
+from notes.serializers import NotesSerializer
+from notes.streaming import iter_chunks
+
+User = get_user_model()
+
+FORMATS = ('ndjson', 'csv')
+
+
+@dataclass
+class ImportResult:
+    created: int = 0
+    failed: int = 0
+    shares: int = 0
+    max_errors: int = 1000
+    errors: list = field(default_factory=list)
+    started: float = field(default_factory=time.perf_counter, repr=False)
+    seconds: float = 0.0
+
+    def error(self, line, detail):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'errors': detail})
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'failed': self.failed,
+            'shares': self.shares,
+            'seconds': round(self.seconds, 3),
+            'notes_per_second': round(self.created / (self.seconds or 1e-9), 1),
+            'errors': sorted(self.errors, key=lambda error: error['line']),
+            'errors_truncated': self.failed > len(self.errors),
+        }
+
+
+def _text(lines):
+    for line in lines:
+        yield line.decode('utf-8', errors='replace') if isinstance(line, bytes) else line
+
+
+def read_ndjson(lines):
+    '''
+        Yields `(line number, row, error)` for every non blank line.
+    '''
+    for number, line in enumerate(_text(lines), 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield number, None, "Expected a JSON object."
+            continue
+        yield number, row, None
+
+
+def read_csv(lines):
+    '''
+        Yields `(line number, row, error)` for every CSV record after the
+        header. Quoted values may span several lines.
+    '''
+    reader = csv.DictReader(_text(lines))
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield reader.line_num, None, f"Invalid CSV: {e}"
+            continue
+        if None in row:
+            yield reader.line_num, None, "Too many values."
+            continue
+        yield reader.line_num, {key: value for key, value in row.items() if value is not None}, None
+
+
+def read_rows(lines, input_format):
+    return read_csv(lines) if input_format == 'csv' else read_ndjson(lines)
+
+
+def parse_user_ids(value):
+    '''
+        Returns the list of user ids of a `shared_with`/`created_by` value.
+        Raises ValueError for anything that is not a list of integers.
+    '''
+    if value in (None, ''):
+        return []
+    if isinstance(value, str):
+        value = json.loads(value) if value.lstrip().startswith('[') else [item for item in re.split(r'[\s,]+', value) if item]
+    if not isinstance(value, list):
+        value = [value]
+    ids = []
+    for item in value:
+        if isinstance(item, bool) or not isinstance(item, (int, str)):
+            raise ValueError(item)
+        ids.append(int(item))
+    return ids
+
+
+def import_notes(rows, owner=None, batch_size=1000, max_errors=1000):
+    '''
+        Imports the `(line number, row, error)` tuples of `rows` and
+        returns the ImportResult. The notes belong to `owner`, or to the
+        `created_by` user of every row when no owner is given.
+    '''
+    result = ImportResult(max_errors=max_errors)
+    for batch in iter_chunks(rows, batch_size):
+        _import_batch(batch, owner, result)
+    result.seconds = time.perf_counter() - result.started
+    return result
+
+
+def _import_batch(batch, owner, result):
+    serializer = NotesSerializer()
+    pending = []
+    for line, row, error in batch:
+        if error is not None:
+            result.error(line, {'non_field_errors': [error]})
+            continue
+        try:
+            data = serializer.run_validation(row)
+        except serializers.ValidationError as e:
+            result.error(line, e.detail)
+            continue
+        try:
+            shared_with = parse_user_ids(row.get('shared_with'))
+        except ValueError:
+            result.error(line, {'shared_with': ["Expected a list of user ids."]})
+            continue
+        if owner is not None:
+            owner_id = owner.pk
+        else:
+            try:
+                owner_ids = parse_user_ids(row.get('created_by'))
+            except ValueError:
+                owner_ids = []
+            if len(owner_ids) != 1:
+                result.error(line, {'created_by': ["Expected the id of the owner."]})
+                continue
+            owner_id = owner_ids[0]
+        pending.append((line, data, owner_id, shared_with))
+
+    user_ids = {owner_id for _, _, owner_id, _ in pending} | {
+        user_id for *_, shared_with in pending for user_id in shared_with
+    }
+    existing = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True)) if user_ids else set()
+    valid = []
+    for line, data, owner_id, shared_with in pending:
+        missing = sorted({owner_id, *shared_with} - existing)
+        if missing:
+            result.error(line, {'non_field_errors': [f"Invalid user ids: {missing}"]})
+        else:
+            valid.append((line, data, owner_id, shared_with))
+    if not valid:
+        return
+
+    through = Note.accessible_users.through
+    try:
+        with transaction.atomic():
+            notes = Note.objects.bulk_create([
+                Note(title=data['title'], description=data['description'], created_by_id=owner_id, updated_by_id=owner_id)
+                for _, data, owner_id, _ in valid
+            ])
+            shares = through.objects.bulk_create([
+                through(note_id=note.pk, user_id=user_id)
+                for note, (*_, shared_with) in zip(notes, valid)
+                for user_id in set(shared_with)
+            ])
+            NoteChange.objects.record(NoteChange.CREATE, notes)
+    except DatabaseError as e:
+        for line, *_ in valid:
+            result.error(line, {'non_field_errors': [f"Could not be saved: {e}"]})
+        return
+    result.created += len(notes)
+    result.shares += len(shares)
@@ -0,0 +1,70 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from notes.benchmarking import SCENARIOS, ASGIDriver, Dataset, WSGIDriver, run_benchmark, temporary_database
+from notes.seeding import SeedOptions
+
+# (synchronous view scenario, async view scenario)
+PAIRS = [
+    ('note-retrieve', 'async-note-retrieve'),
+    ('note-history', 'async-note-history'),
+    ('note-update', 'async-note-update'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Compare how the sync views under WSGI and ASGI and the async views under ASGI scale with concurrency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--notes-per-user', type=int, default=20)
+        parser.add_argument('--edits-per-note', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint and concurrency level')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64], help='Concurrency levels to measure')
+        parser.add_argument('--output', help='Write the JSON results to this file')
+
+    def handle(self, *args, **options):
+        '''
+            Drives every endpoint pair at each `--concurrency` level through
+            three stacks: the sync DRF view under `wsgi.py`, the same view
+            under `asgi.py` (one thread hop per request) and the async view
+            under `asgi.py`, and reports their throughput and latency.
+        '''
+        scenarios = {scenario.name: scenario for scenario in SCENARIOS}
+        stacks = [
+            ('wsgi', WSGIDriver, 0),
+            ('asgi', ASGIDriver, 0),
+            ('asgi-async', ASGIDriver, 1),
+        ]
+        results = []
+        with temporary_database():
+            dataset = Dataset(SeedOptions(
+                users=options['users'],
+                notes_per_user=options['notes_per_user'],
+                edits_per_note=options['edits_per_note'],
+                seed=options['seed'],
+                prefix='bench',
+            ))
+            for concurrency in options['concurrency']:
+                for stack, driver, index in stacks:
+                    report = run_benchmark(
+                        driver(concurrency),
+                        dataset,
+                        options['requests'],
+                        options['requests'],
+                        [scenarios[pair[index]] for pair in PAIRS],
+                    )
+                    for pair in PAIRS:
+                        results.append({'endpoint': pair[0], 'stack': stack, 'concurrency': concurrency, **report[pair[index]]})
+
+        self.stdout.write(f"{'endpoint':<14} {'stack':<11} {'concurrency':>11} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'errors':>6}")
+        for result in sorted(results, key=lambda result: (result['endpoint'], result['stack'], result['concurrency'])):
+            self.stdout.write(
+                f"{result['endpoint']:<14} {result['stack']:<11} {result['concurrency']:>11} {result['rps']:>9.1f} "
+                f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['errors']:>6}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
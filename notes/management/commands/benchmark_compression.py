@@ -0,0 +1,79 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from notes.benchmarking import percentile, temporary_database
+from notes.models import Note
+from notes.seeding import mutate_text, prose_text
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Compare database size and read/write latency of note descriptions stored plain and compressed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='*', default=[500, 2000, 10000, 50000], help='Description sizes in characters')
+        parser.add_argument('--notes', type=int, default=200, help='Notes per size')
+        parser.add_argument('--edits', type=int, default=5, help='Saves per note, every other one also changing the title')
+        parser.add_argument('--threshold', type=int, default=1024, help='Compression threshold in bytes')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        '''
+            For every size, creates `--notes` notes and saves each of them
+            `--edits` times in a throwaway database, once with compression
+            disabled and once with `--threshold`, then reads every note
+            back. Reports the database file size after VACUUM and the
+            latency percentiles of creates, edits and reads.
+        '''
+        self.stdout.write(
+            f"{'size':>7} {'mode':<10} {'db MiB':>8} {'create p50':>10} {'edit p50':>9} {'edit p99':>9} "
+            f"{'read p50':>9} {'read p99':>9}"
+        )
+        for size in options['sizes']:
+            for mode, threshold in (('plain', None), ('compressed', options['threshold'])):
+                with override_settings(NOTES_COMPRESSION_THRESHOLD=threshold), temporary_database():
+                    result = self.run(size, options)
+                self.stdout.write(
+                    f"{size:>7} {mode:<10} {result['size'] / 1024 / 1024:>8.2f} "
+                    f"{percentile(result['create'], 0.5) * 1000:>10.3f} "
+                    f"{percentile(result['edit'], 0.5) * 1000:>9.3f} {percentile(result['edit'], 0.99) * 1000:>9.3f} "
+                    f"{percentile(result['read'], 0.5) * 1000:>9.3f} {percentile(result['read'], 0.99) * 1000:>9.3f}"
+                )
+
+    def run(self, size, options):
+        rng = random.Random(f"{options['seed']}:{size}")
+        user = User.objects.create(username='compression', email='compression@example.com')
+        timings = {'create': [], 'edit': [], 'read': []}
+        notes = []
+        for index in range(options['notes']):
+            started = time.perf_counter()
+            notes.append(Note.objects.create(title=f'Note {index}', description=prose_text(rng, size), created_by=user, updated_by=user))
+            timings['create'].append(time.perf_counter() - started)
+        for edit in range(options['edits']):
+            for note in notes:
+                note.description = mutate_text(rng, note.description)
+                if edit % 2:
+                    note.title = f'{note.title} {edit}'
+                started = time.perf_counter()
+                note.save()
+                timings['edit'].append(time.perf_counter() - started)
+        for note in notes:
+            started = time.perf_counter()
+            Note.objects.get(pk=note.pk).description
+            timings['read'].append(time.perf_counter() - started)
+
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM')
+            cursor.execute('PRAGMA page_count')
+            page_count = cursor.fetchone()[0]
+            cursor.execute('PRAGMA page_size')
+            page_size = cursor.fetchone()[0]
+        for latencies in timings.values():
+            latencies.sort()
+        return {'size': page_count * page_size, **timings}
@@ -0,0 +1,81 @@
+import json
+import platform
+
+from django.core.management.base import BaseCommand, CommandError
+
+from notes.benchmarking import DRIVERS, SCENARIOS, Dataset, compare, run_benchmark, temporary_database, uncovered_routes
+from notes.seeding import SeedOptions
+
+
+class Command(BaseCommand):
+    help = 'Load test every notes and users endpoint in process and report latency percentiles, throughput and queries per request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--notes-per-user', type=int, default=20)
+        parser.add_argument('--share-fanout', type=int, default=3)
+        parser.add_argument('--edits-per-note', type=int, default=5)
+        parser.add_argument('--description-size', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint')
+        parser.add_argument('--password-requests', type=int, default=20, help='Requests per endpoint that hashes a password')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent in-flight requests')
+        parser.add_argument('--interface', choices=sorted(DRIVERS), default='wsgi', help='Application entry point the requests go through')
+        parser.add_argument('--endpoints', nargs='*', choices=[scenario.name for scenario in SCENARIOS], help='Only benchmark these endpoints')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--baseline', help='JSON report of a previous run to compare against')
+        parser.add_argument('--max-regression', type=float, default=0.2, help='Tolerated p95/throughput regression against the baseline, as a fraction')
+
+    def handle(self, *args, **options):
+        '''
+            Seeds a throwaway database, then drives every endpoint in its
+            own phase through the real WSGI/ASGI application with real JWTs.
+            Fails when a route has no scenario, or when `--baseline` is
+            given and a regression beyond `--max-regression` is found.
+        '''
+        missing = uncovered_routes()
+        if missing:
+            raise CommandError(f"No benchmark scenario for: {', '.join(missing)}")
+        scenarios = [scenario for scenario in SCENARIOS if not options['endpoints'] or scenario.name in options['endpoints']]
+        log = (lambda message: self.stdout.write(message)) if options['verbosity'] > 1 else None
+        seed_options = SeedOptions(
+            users=options['users'],
+            notes_per_user=options['notes_per_user'],
+            share_fanout=options['share_fanout'],
+            edits_per_note=options['edits_per_note'],
+            description_size=options['description_size'],
+            seed=options['seed'],
+            prefix='bench',
+        )
+
+        with temporary_database():
+            dataset = Dataset(seed_options, log)
+            driver = DRIVERS[options['interface']](options['concurrency'])
+            endpoints = run_benchmark(driver, dataset, options['requests'], options['password_requests'], scenarios, log)
+
+        report = {
+            'interface': options['interface'],
+            'concurrency': options['concurrency'],
+            'python': platform.python_version(),
+            'dataset': {key: value for key, value in dataset.counts.items() if key != 'seconds'},
+            'endpoints': endpoints,
+        }
+        self.write_table(endpoints)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = compare(report, json.load(baseline), options['max_regression'])
+            if regressions:
+                raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regression against the baseline.'))
+
+    def write_table(self, endpoints):
+        self.stdout.write(f"{'endpoint':<20} {'requests':>8} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>7}")
+        for name, result in endpoints.items():
+            self.stdout.write(
+                f"{name:<20} {result['requests']:>8} {result['errors']:>6} {result['rps']:>9.1f} "
+                f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['queries_per_request']:>7.2f}"
+            )
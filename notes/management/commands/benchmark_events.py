@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+import tracemalloc
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from notes.benchmarking import percentile, temporary_database
+from notes.events import get_event_hub
+from notes.models import Note
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Measure the memory of idle event stream connections and the latency of pushing a change to all of them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=2000, help='Idle event stream connections')
+        parser.add_argument('--users', type=int, default=50, help='Users the note is shared with, connections are spread over them')
+        parser.add_argument('--settle', type=float, default=1.0, help='Seconds left for the connections to go idle')
+
+    def handle(self, *args, **options):
+        '''
+            Opens `--connections` server-sent event streams through the ASGI
+            application against a throwaway database, all of them following
+            one note shared with `--users` users, and reports the traced
+            memory per idle connection and the threads they started. Then
+            edits the note once and reports how long the update took to
+            reach every connection.
+        '''
+        with temporary_database(), override_settings(ALLOWED_HOSTS=['localhost']):
+            users = User.objects.bulk_create([
+                User(username=f'events{index}', email=f'events{index}@example.com') for index in range(options['users'])
+            ])
+            note = Note.objects.create(title='Events', description='Body', created_by=users[0], updated_by=users[0])
+            note.accessible_users.add(*users[1:])
+            tokens = [str(AccessToken.for_user(user)) for user in users]
+            result = asyncio.run(self.run(note, tokens, options))
+
+        self.stdout.write(f"connections:            {options['connections']}")
+        self.stdout.write(f"memory per connection:  {result['memory'] / options['connections'] / 1024:.2f} KiB")
+        self.stdout.write(f"threads started:        {result['threads']}")
+        self.stdout.write(f"open time:              {result['open']:.2f} s")
+        self.stdout.write(
+            f"fan-out latency:        p50 {percentile(result['latencies'], 0.5) * 1000:.1f} ms, "
+            f"p99 {percentile(result['latencies'], 0.99) * 1000:.1f} ms, max {result['latencies'][-1] * 1000:.1f} ms"
+        )
+
+    async def run(self, note, tokens, options):
+        from notes_management.asgi import application
+
+        count = options['connections']
+        connected = asyncio.Semaphore(0)
+        received = {}
+        disconnect = asyncio.Event()
+
+        async def connection(index):
+            token = tokens[index % len(tokens)]
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                'path': '/notes/async/events/', 'raw_path': b'/notes/async/events/', 'query_string': b'',
+                'root_path': '', 'client': ('127.0.0.1', index), 'server': ('localhost', 80),
+                'headers': [(b'host', b'localhost'), (b'accept', b'text/event-stream'), (b'authorization', f'Bearer {token}'.encode())],
+            }
+            messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                body = message.get('body', b'')
+                if body.startswith(b': connected'):
+                    connected.release()
+                elif b'"update"' in body and index not in received:
+                    received[index] = time.perf_counter()
+
+            await application(scope, receive, send)
+
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            threads = threading.active_count()
+            started = time.perf_counter()
+            tasks = [asyncio.ensure_future(connection(index)) for index in range(count)]
+            for _ in range(count):
+                await connected.acquire()
+            opened = time.perf_counter() - started
+            await asyncio.sleep(options['settle'])
+            memory = tracemalloc.get_traced_memory()[0] - baseline
+            threads = threading.active_count() - threads
+        finally:
+            tracemalloc.stop()
+
+        def edit():
+            note.description = 'Edited'
+            note.save()
+
+        edited = time.perf_counter()
+        await sync_to_async(edit, thread_sensitive=False)()
+        deadline = time.perf_counter() + 30
+        while len(received) < count and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        if len(received) < count:
+            raise CommandError(f"Only {len(received)} of {count} connections received the change")
+        disconnect.set()
+        await asyncio.gather(*tasks)
+        if get_event_hub().stats()['subscribers']:
+            raise CommandError("Subscribers left after the connections closed")
+        return {
+            'memory': memory,
+            'open': opened,
+            'threads': threads,
+            'latencies': sorted(at - edited for at in received.values()),
+        }
@@ -0,0 +1,72 @@
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from notes import delta
+from notes.seeding import mutate_text, random_text
+
+
+class Command(BaseCommand):
+    help = 'Compare the storage cost of full-text History rows against delta-encoded rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100_000, help='Description size in characters')
+        parser.add_argument('--edits', type=int, default=1000, help='Number of small edits to simulate')
+        parser.add_argument('--interval', type=int, default=getattr(settings, 'NOTES_HISTORY_SNAPSHOT_INTERVAL', 50), help='Snapshot interval in versions')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        '''
+            Simulates `--edits` small edits on a `--size` character note and
+            measures the bytes History would store in the full-text format
+            against the delta format (reverse deltas plus a full snapshot
+            every `--interval` versions), along with encode and version
+            reconstruction times. Nothing is written to the database.
+        '''
+        rng = random.Random(options['seed'])
+        interval = options['interval']
+        user = "user@example.com username"
+        text = random_text(rng, options['size'])
+
+        full_bytes = delta_bytes = 0
+        encode_seconds = 0.0
+        chain, longest = [], ([], text)
+        for version in range(2, options['edits'] + 2):
+            new_text = mutate_text(rng, text)
+            full_activity = f"{user} updated description from {text} to {new_text}"
+            full_size = len(text.encode()) + len(new_text.encode()) + len(full_activity.encode())
+            full_bytes += full_size
+
+            if version % interval == 0:
+                delta_bytes += full_size
+                if len(chain) > len(longest[0]):
+                    longest = (chain, text)
+                chain = []
+            else:
+                started = time.perf_counter()
+                encoded = delta.dumps(delta.diff(new_text, text))
+                encode_seconds += time.perf_counter() - started
+                delta_bytes += len(encoded.encode()) + len(f"{user} updated description".encode())
+                chain.append(encoded)
+            text = new_text
+        if len(chain) > len(longest[0]):
+            longest = (chain, text)
+
+        # Worst case reconstruction: walk back over the longest chain of
+        # deltas from the full text above it.
+        chain, current = longest
+        started = time.perf_counter()
+        for encoded in reversed(chain):
+            current = delta.apply(delta.loads(encoded), current)
+        rebuild_seconds = time.perf_counter() - started
+
+        delta_edits = max(options['edits'] - options['edits'] // interval, 1)
+        self.stdout.write(f"edits: {options['edits']}  size: {options['size']} chars  snapshot interval: {interval}")
+        self.stdout.write(f"full format:  {full_bytes / 1024 / 1024:.2f} MiB")
+        self.stdout.write(f"delta format: {delta_bytes / 1024 / 1024:.2f} MiB")
+        self.stdout.write(f"ratio:        {full_bytes / max(delta_bytes, 1):.1f}x smaller")
+        self.stdout.write(f"encode:       {encode_seconds / delta_edits * 1000:.3f} ms per edit")
+        self.stdout.write(f"rebuild:      {rebuild_seconds * 1000:.3f} ms across {len(chain)} deltas")
+
@@ -0,0 +1,95 @@
+import random
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.tokens import AccessToken
+
+from notes import renderers
+from notes.benchmarking import percentile, temporary_database
+from notes.models import Note
+from notes.renderers import FastJSONRenderer
+from notes.seeding import mutate_text, prose_text
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Compare JSON render time and bytes on the wire of note and history responses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=5000, help='Description size in characters')
+        parser.add_argument('--edits', type=int, default=100, help='Edits of the note, one History row each')
+        parser.add_argument('--repeat', type=int, default=200, help='Renders per payload and renderer')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        '''
+            Builds a note with `--edits` description edits in a throwaway
+            database and fetches its detail and history pages. Every payload
+            is rendered `--repeat` times by DRF's JSONRenderer and by
+            FastJSONRenderer with orjson and with the stdlib fallback (the
+            outputs must be identical), then requested again through the
+            middleware with each content coding to count the bytes sent.
+        '''
+        rng = random.Random(options['seed'])
+        with temporary_database():
+            user = User.objects.create(username='rendering', email='rendering@example.com')
+            note = Note.objects.create(title='Rendering', description=prose_text(rng, options['size']), created_by=user, updated_by=user)
+            for _ in range(options['edits']):
+                note.description = mutate_text(rng, note.description)
+                note.save()
+            client = Client(SERVER_NAME='localhost', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+            urls = {
+                'note': reverse('get-edit-note', kwargs={'id': note.pk}),
+                'history': reverse('get-history', kwargs={'id': note.pk}) + '?page_size=100',
+                'history-stream': reverse('get-history', kwargs={'id': note.pk}) + '?stream=ndjson',
+            }
+            payloads = {name: client.get(url).data for name, url in urls.items() if 'stream' not in name}
+            wire = {name: self.wire_bytes(client, url) for name, url in urls.items()}
+
+        self.stdout.write(f"{'payload':<15} {'renderer':<16} {'p50 ms':>8} {'p99 ms':>8} {'speedup':>8}")
+        for name, data in payloads.items():
+            expected = JSONRenderer().render(data)
+            results = {'drf': self.measure(JSONRenderer().render, data, options['repeat'])}
+            if renderers.orjson is not None:
+                self.check_output(FastJSONRenderer().render(data), expected, 'orjson')
+                results['fast (orjson)'] = self.measure(FastJSONRenderer().render, data, options['repeat'])
+            with mock.patch.object(renderers, 'orjson', None):
+                self.check_output(FastJSONRenderer().render(data), expected, 'stdlib')
+                results['fast (stdlib)'] = self.measure(FastJSONRenderer().render, data, options['repeat'])
+            baseline = percentile(results['drf'], 0.5)
+            for renderer, latencies in results.items():
+                self.stdout.write(
+                    f"{name:<15} {renderer:<16} {percentile(latencies, 0.5) * 1000:>8.3f} "
+                    f"{percentile(latencies, 0.99) * 1000:>8.3f} {baseline / percentile(latencies, 0.5):>7.1f}x"
+                )
+
+        self.stdout.write('')
+        self.stdout.write(f"{'payload':<15} {'identity':>10} {'gzip':>10} {'deflate':>10}")
+        for name, sizes in wire.items():
+            self.stdout.write(f"{name:<15} {sizes['identity']:>10} {sizes['gzip']:>10} {sizes['deflate']:>10}")
+
+    def measure(self, render, data, repeat):
+        latencies = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            render(data)
+            latencies.append(time.perf_counter() - started)
+        return sorted(latencies)
+
+    def check_output(self, rendered, expected, backend):
+        if rendered != expected:
+            raise CommandError(f"FastJSONRenderer ({backend}) output differs from JSONRenderer")
+
+    def wire_bytes(self, client, url):
+        sizes = {}
+        for encoding in ('identity', 'gzip', 'deflate'):
+            response = client.get(url, HTTP_ACCEPT_ENCODING=encoding)
+            body = b''.join(response.streaming_content) if response.streaming else response.content
+            sizes[encoding] = len(body)
+        return sizes
@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from notes.importer import FORMATS, import_notes, read_rows
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Import notes from an NDJSON or CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or - for standard input")
+        parser.add_argument('--input', choices=FORMATS, help='Input format, guessed from the file extension by default')
+        parser.add_argument('--owner', help='Username owning the imported notes; without it every row needs created_by')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows validated and inserted per transaction')
+        parser.add_argument('--max-errors', type=int, default=1000, help='Row errors to report')
+        parser.add_argument('--errors', help='Write the row errors to this file as NDJSON')
+
+    def handle(self, *args, **options):
+        '''
+            Streams the file through `notes.importer` and prints the number
+            of notes and shares created, the throughput and the rows that
+            were rejected.
+        '''
+        input_format = options['input'] or ('csv' if options['path'].endswith('.csv') else 'ndjson')
+        owner = None
+        if options['owner']:
+            try:
+                owner = User.objects.get(username=options['owner'])
+            except User.DoesNotExist:
+                raise CommandError(f"No user named {options['owner']}")
+
+        if options['path'] == '-':
+            result = self.load(sys.stdin.buffer, input_format, owner, options)
+        else:
+            if not os.path.exists(options['path']):
+                raise CommandError(f"No such file: {options['path']}")
+            with open(options['path'], 'rb') as source:
+                result = self.load(source, input_format, owner, options)
+
+        report = result.as_dict()
+        self.stdout.write(
+            f"Imported {report['created']} notes and {report['shares']} shares in {report['seconds']}s "
+            f"({report['notes_per_second']} notes/s), {report['failed']} rows rejected"
+        )
+        if options['errors']:
+            with open(options['errors'], 'w') as errors:
+                for error in report['errors']:
+                    errors.write(json.dumps(error) + '\n')
+        else:
+            for error in report['errors'][:20]:
+                self.stdout.write(f"line {error['line']}: {json.dumps(error['errors'])}")
+
+    def load(self, source, input_format, owner, options):
+        return import_notes(
+            read_rows(source, input_format),
+            owner=owner,
+            batch_size=options['batch_size'],
+            max_errors=options['max_errors'],
+        )
@@ -0,0 +1,44 @@
+import json
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from notes.models import NoteChange
+
+
+class Command(BaseCommand):
+    help = 'Remove the change feed entries older than a given age in bounded batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=30 * 24 * 3600, help='Only prune entries written at least this many seconds ago (default 30 days)')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per DELETE statement')
+        parser.add_argument('--loop', action='store_true', help='Keep running as a worker, pruning every --interval seconds')
+        parser.add_argument('--interval', type=float, default=3600)
+        parser.add_argument('--json', action='store_true', help='Print the metrics as JSON')
+
+    def handle(self, *args, **options):
+        '''
+            Prunes the change feed once, or with `--loop` until it is
+            interrupted, printing the number of entries removed after every
+            pass that removed something.
+        '''
+        while True:
+            started = time.perf_counter()
+            deleted = NoteChange.objects.prune(timedelta(seconds=options['older_than']), batch_size=options['batch_size'])
+            metrics = {
+                'entries': deleted,
+                'oldest_seq': NoteChange.objects.oldest_seq(),
+                'seconds': round(time.perf_counter() - started, 3),
+            }
+            if deleted or not options['loop']:
+                if options['json']:
+                    self.stdout.write(json.dumps(metrics))
+                else:
+                    self.stdout.write(
+                        f"Pruned {metrics['entries']} change feed entries in {metrics['seconds']}s, "
+                        f"the feed now starts at seq {metrics['oldest_seq']}"
+                    )
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,54 @@
+import json
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from notes.purge import PurgeStats, purge_deleted_notes
+
+
+class Command(BaseCommand):
+    help = 'Remove deleted notes with their history and shares in bounded chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=0, help='Only purge notes deleted at least this many seconds ago')
+        parser.add_argument('--chunk-size', type=int, default=100, help='Notes purged per chunk')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per DELETE statement')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between chunks')
+        parser.add_argument('--limit', type=int, help='Stop after this many notes')
+        parser.add_argument('--loop', action='store_true', help='Keep running as a worker, checking for deleted notes every --interval seconds')
+        parser.add_argument('--interval', type=float, default=60)
+        parser.add_argument('--json', action='store_true', help='Print the metrics as JSON')
+
+    def handle(self, *args, **options):
+        '''
+            Purges the tombstoned notes once, or with `--loop` until it is
+            interrupted, printing the number of notes and rows removed and
+            the purge throughput after every pass that removed something.
+        '''
+        while True:
+            stats = purge_deleted_notes(
+                older_than=timedelta(seconds=options['older_than']),
+                chunk_size=options['chunk_size'],
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                limit=options['limit'],
+                stats=PurgeStats(),
+            )
+            if stats.notes or not options['loop']:
+                self.report(stats, options['json'])
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
+
+    def report(self, stats, as_json):
+        metrics = stats.as_dict()
+        if as_json:
+            self.stdout.write(json.dumps(metrics))
+            return
+        self.stdout.write(
+            f"Purged {metrics['notes']} notes, {metrics['history']} history rows and {metrics['shares']} shares "
+            f"in {metrics['chunks']} chunks and {metrics['seconds']}s "
+            f"({metrics['notes_per_second']} notes/s, {metrics['rows_per_second']} rows/s, "
+            f"slowest statement {metrics['slowest_statement_ms']} ms)"
+        )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from notes.history_writer import replay_spool, write_behind_settings
+
+
+class Command(BaseCommand):
+    help = 'Write the History rows left in the write-behind spool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spool-dir', help='Spool directory, NOTES_HISTORY_WRITE_BEHIND["SPOOL_DIR"] by default')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        '''
+            Replays every segment of the spool and deletes it. Rows that are
+            already in History are skipped and the spools of running
+            writers are left alone, so this is safe to run at any time.
+        '''
+        directory = options['spool_dir'] or write_behind_settings()['SPOOL_DIR']
+        replayed = replay_spool(directory, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Replayed {replayed} History rows from {directory}."))
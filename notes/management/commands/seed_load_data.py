@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from notes.seeding import SeedOptions, seed
+
+
+class Command(BaseCommand):
+    help = 'Create a large synthetic dataset of users, notes, shares and history for load testing'
+
+    def add_arguments(self, parser):
+        defaults = SeedOptions()
+        parser.add_argument('--users', type=int, default=defaults.users)
+        parser.add_argument('--notes-per-user', type=int, default=defaults.notes_per_user)
+        parser.add_argument('--share-fanout', type=int, default=defaults.share_fanout, help='Number of other users every note is shared with')
+        parser.add_argument('--edits-per-note', type=int, default=defaults.edits_per_note, help='Description edits per note, each recorded in History')
+        parser.add_argument('--description-size', type=int, default=defaults.description_size, help='Description size in characters')
+        parser.add_argument('--seed', type=int, default=defaults.seed, help='Random seed, also used in the generated usernames')
+        parser.add_argument('--batch-size', type=int, default=defaults.batch_size, help='Rows per bulk_create and per transaction')
+        parser.add_argument('--processes', type=int, default=defaults.processes, help='Worker processes generating the rows')
+        parser.add_argument('--password', default=defaults.password, help='Password shared by all the generated users')
+        parser.add_argument('--prefix', default=defaults.prefix, help='Username prefix of the generated users')
+
+    def handle(self, *args, **options):
+        '''
+            The password is hashed once and shared by every user, rows are
+            written with batched `bulk_create` calls in chunked transactions
+            and row generation can be split across `--processes` workers.
+        '''
+        seed_options = SeedOptions(**{
+            field: options[field]
+            for field in SeedOptions.__dataclass_fields__
+        })
+        counts = seed(seed_options, log=lambda message: self.stdout.write(message) if options['verbosity'] > 1 else None)
+        rows = counts['users'] + counts['notes'] + counts['shares'] + counts['history']
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {counts['users']} users, {counts['notes']} notes, {counts['shares']} shares "
+            f"and {counts['history']} history rows in {counts['seconds']:.1f}s "
+            f"({rows / max(counts['seconds'], 1e-9):.0f} rows/s)."
+        ))
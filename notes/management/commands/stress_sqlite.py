@@ -0,0 +1,122 @@
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, connections, transaction
+
+from notes.benchmarking import percentile, temporary_database
+from notes.models import History, Note
+from notes.seeding import SeedOptions, mutate_text, seed
+
+User = get_user_model()
+
+MODES = {
+    'plain': {'ENGINE': 'django.db.backends.sqlite3', 'CONN_MAX_AGE': 0, 'OPTIONS': {}},
+    'production': {'ENGINE': 'notes_management.sqlite', 'CONN_MAX_AGE': 600, 'OPTIONS': {'timeout': 20}},
+}
+
+
+class Command(BaseCommand):
+    help = 'Run concurrent note readers and writers against a throwaway SQLite database and report errors and latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=[*MODES, 'both'], default='both', help='SQLite configuration of the worker threads')
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--notes', type=int, default=200, help='Notes in the seeded dataset')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        '''
+            Every writer edits random notes with `Note.save()` (one History
+            row per change) and creates a note every tenth operation, every
+            reader lists notes and counts their history in one read
+            transaction. The worker threads
+            open their own connections with the configuration of `--mode`.
+        '''
+        modes = list(MODES) if options['mode'] == 'both' else [options['mode']]
+        self.stdout.write(f"{'mode':<11} {'operation':<7} {'ops':>7} {'ops/s':>8} {'p50 ms':>8} {'p99 ms':>9} {'errors':>6}")
+        for mode in modes:
+            with temporary_database():
+                results, errors, messages = self.run(mode, options)
+            for operation, latencies in sorted(results.items()):
+                latencies.sort()
+                self.stdout.write(
+                    f"{mode:<11} {operation:<7} {len(latencies):>7} {len(latencies) / options['seconds']:>8.1f} "
+                    f"{percentile(latencies, 0.5) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>9.2f} "
+                    f"{errors[operation]:>6}"
+                )
+            for message, count in messages.most_common():
+                self.stdout.write(f"{mode:<11} {count} x {message}")
+
+    def run(self, mode, options):
+        seed(SeedOptions(users=max(1, options['notes'] // 10), notes_per_user=10, share_fanout=1, seed=options['seed'], prefix='stress'))
+        note_ids = list(Note.objects.values_list('pk', flat=True))
+        user_ids = list(User.objects.values_list('pk', flat=True))
+
+        # Worker threads build their connections from these settings
+        settings_dict = connection.settings_dict
+        previous = {key: settings_dict.get(key) for key in MODES[mode]}
+        settings_dict.update(MODES[mode])
+        results = defaultdict(list)
+        errors = Counter()
+        messages = Counter()
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options['seconds']
+
+        def work(operation, index):
+            rng = random.Random(f"{options['seed']}:{operation}:{index}")
+            latencies = []
+            failures = Counter()
+            failure_messages = Counter()
+            try:
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        getattr(self, operation)(rng, note_ids, user_ids)
+                    except DatabaseError as error:
+                        failures[operation] += 1
+                        failure_messages[str(error)] += 1
+                    else:
+                        latencies.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+            with lock:
+                results[operation].extend(latencies)
+                errors.update(failures)
+                messages.update(failure_messages)
+
+        threads = [
+            threading.Thread(target=work, args=(operation, index))
+            for operation, count in (('write', options['writers']), ('read', options['readers']))
+            for index in range(count)
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            settings_dict.update(previous)
+        return results, errors, messages
+
+    def write(self, rng, note_ids, user_ids):
+        if rng.random() < 0.1:
+            user_id = rng.choice(user_ids)
+            Note.objects.create(title='Stress', description='Created under load', created_by_id=user_id, updated_by_id=user_id)
+            return
+        note = Note.objects.get(pk=rng.choice(note_ids))
+        note.description = mutate_text(rng, note.description)
+        note.updated_by_id = rng.choice(user_ids)
+        note.save()
+
+    def read(self, rng, note_ids, user_ids):
+        user = User(pk=rng.choice(user_ids))
+        # One snapshot for the notes and their history count
+        with transaction.atomic():
+            notes = list(Note.objects.accessible_to(user).order_by('-updated_at', '-id').only('id', 'title', 'updated_at')[:50])
+            History.objects.filter(note_id__in=[note.pk for note in notes]).count()
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.16 on 2026-10-18 16:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0004_alter_note_options'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['created_by', '-updated_at', '-id', 'title'], name='note_owner_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['-updated_at', '-id'], name='note_updated_idx'),
+        ),
+    ]
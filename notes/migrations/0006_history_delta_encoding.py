@@ -0,0 +1,66 @@
+# Generated by Django 3.2.16 on 2026-10-18 17:05
+
+import re
+
+from django.db import migrations, models
+
+ACTIVITY_FIELD = re.compile(r" updated (\w+) from ")
+
+
+def backfill_versions(apps, schema_editor):
+    '''
+        Numbers the existing History rows of every note in creation order
+        (the note as created is version 1) and fills `field` from the
+        activity text. Existing rows keep the full encoding.
+    '''
+    Note = apps.get_model('notes', 'Note')
+    History = apps.get_model('notes', 'History')
+    note_ids = History.objects.exclude(note=None).values_list('note_id', flat=True).distinct()
+    for note_id in note_ids.iterator():
+        entries = list(History.objects.filter(note_id=note_id).order_by('created_at', 'id'))
+        for version, entry in enumerate(entries, start=2):
+            match = ACTIVITY_FIELD.search(entry.activity)
+            entry.field = match.group(1) if match else ''
+            entry.version = version
+        History.objects.bulk_update(entries, ['field', 'version'])
+        Note.objects.filter(pk=note_id).update(version=len(entries) + 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0005_note_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='field',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='encoding',
+            field=models.CharField(choices=[('full', 'Full'), ('delta', 'Delta')], default='full', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='delta',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['note', 'field', 'version'], name='history_note_field_version_idx'),
+        ),
+        migrations.RunPython(backfill_versions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.16 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0006_history_delta_encoding'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['note', 'created_at', 'id'], name='history_note_created_idx'),
+        ),
+    ]
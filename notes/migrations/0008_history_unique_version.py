@@ -0,0 +1,21 @@
+# Generated by Django 3.2.16 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0007_history_note_created_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='history',
+            name='history_note_field_version_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='history',
+            constraint=models.UniqueConstraint(fields=('note', 'field', 'version'), name='history_note_field_version_uniq'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.16 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0008_history_unique_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(condition=models.Q(('encoding', 'full'), ('field', 'description')), fields=['note', 'field', 'encoding', 'version'], name='history_snapshot_idx'),
+        ),
+    ]
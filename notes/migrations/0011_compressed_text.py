@@ -0,0 +1,58 @@
+# Generated by Django 3.2.16 on 2026-10-18 23:40
+
+from django.db import migrations
+
+import notes.fields
+
+COMPRESSED_FIELDS = {
+    'Note': ['description'],
+    'History': ['old_value', 'new_value', 'activity'],
+}
+
+
+def compress_text(apps, schema_editor):
+    '''
+        Compresses the existing values over the threshold. Plain values stay
+        readable, so this can also be left to run again later.
+    '''
+    for model, fields in COMPRESSED_FIELDS.items():
+        notes.fields.compress_existing(apps.get_model('notes', model), fields)
+
+
+def decompress_text(apps, schema_editor):
+    for model, fields in COMPRESSED_FIELDS.items():
+        notes.fields.decompress_existing(apps.get_model('notes', model), fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0010_note_soft_delete'),
+    ]
+
+    operations = [
+        # Same text columns, only the field class changes: no table rebuild
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='note',
+                name='description',
+                field=notes.fields.CompressedTextField(),
+            ),
+            migrations.AlterField(
+                model_name='history',
+                name='old_value',
+                field=notes.fields.CompressedTextField(),
+            ),
+            migrations.AlterField(
+                model_name='history',
+                name='new_value',
+                field=notes.fields.CompressedTextField(),
+            ),
+            migrations.AlterField(
+                model_name='history',
+                name='activity',
+                field=notes.fields.CompressedTextField(default=''),
+            ),
+        ]),
+        migrations.RunPython(compress_text, decompress_text),
+    ]
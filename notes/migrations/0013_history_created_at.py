@@ -0,0 +1,19 @@
+# Generated by Django 3.2.16 on 2026-10-18 19:09
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0012_note_change'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='history',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.16 on 2026-10-18 20:02
+
+from django.db import migrations, models
+
+
+def written_up_to_version(apps, schema_editor):
+    # Rows written so far are all in the table
+    Note = apps.get_model('notes', 'Note')
+    Note.objects.update(history_version=models.F('version'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0013_history_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='history_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(written_up_to_version, migrations.RunPython.noop),
+    ]
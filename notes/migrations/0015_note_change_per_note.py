@@ -0,0 +1,49 @@
+# Generated by Django 3.2.16 on 2026-10-18 23:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def one_entry_per_note_change(apps, schema_editor):
+    # The per user copies of a change of a note that still exists become
+    # one entry with no user, the one with the lowest seq. The entries of
+    # purged notes stay with their users, nothing joins them anymore
+    Note = apps.get_model('notes', 'Note')
+    NoteChange = apps.get_model('notes', 'NoteChange')
+    changes = NoteChange.objects.filter(
+        action__in=['create', 'update', 'delete'],
+        note_id__in=Note.objects.values('pk'),
+    )
+    first = changes.values('note_id', 'action', 'version').annotate(first=models.Min('seq')).values('first')
+    changes.exclude(seq__in=first).delete()
+    changes.update(user=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notes', '0014_note_history_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notechange',
+            name='user',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='note_changes', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RemoveIndex(
+            model_name='notechange',
+            name='note_change_user_seq_idx',
+        ),
+        migrations.AddIndex(
+            model_name='notechange',
+            index=models.Index(condition=models.Q(('user__isnull', False)), fields=['user', 'seq'], name='note_change_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notechange',
+            index=models.Index(fields=['note_id', 'seq'], name='note_change_note_seq_idx'),
+        ),
+        migrations.RunPython(one_entry_per_note_change, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,19 @@
+import logging
+from collections import defaultdict
+
+from django.conf import settings
 from django.db import models
 from django.contrib.auth import get_user_model
 from model_utils import FieldTracker
 from django.db import transaction
+from django.utils import timezone
+
+from notes import delta
+from notes.cache import get_note_cache
+from notes.events import publish_changes
+from notes.fields import CompressedTextField
+
+logger = logging.getLogger('notes.history')
 
 
 class TimestampedModel(models.Model):
@@ -26,6 +38,55 @@ class UserStampedModel(models.Model):
         abstract = True
 
 
+class StaleVersionError(Exception):
+    '''
+        Raised when a conditional save finds the note at another version.
+    '''
+
+
+class NoteQuerySet(models.QuerySet):
+    '''
+        QuerySet with the access filters shared by the note endpoints.
+    '''
+    def accessible_to(self, user):
+        '''
+            Notes owned by `user` or shared with them. The shared branch is a
+            subquery on the through table so no join duplicates rows.
+        '''
+        shared = Note.accessible_users.through.objects.filter(user=user).values('note_id')
+        return self.filter(models.Q(created_by=user) | models.Q(pk__in=shared))
+
+    def with_share_flag(self, user):
+        '''
+            Annotates `is_shared` (whether the note is shared with `user`)
+            as an EXISTS on the through table's (note_id, user_id) index.
+        '''
+        shared = Note.accessible_users.through.objects.filter(note=models.OuterRef('pk'), user=user)
+        return self.annotate(is_shared=models.Exists(shared))
+
+    def soft_delete(self):
+        '''
+            Tombstones the notes with one UPDATE; their rows, History and
+            shares are removed later by the `purge_deleted_notes` command.
+            Returns the number of notes deleted.
+        '''
+        notes = list(self.filter(deleted_at__isnull=True).only('id', 'created_by', 'version'))
+        note_ids = [note.pk for note in notes]
+        with transaction.atomic():
+            deleted = Note.all_objects.filter(pk__in=note_ids).update(deleted_at=timezone.now())
+            NoteChange.objects.record(NoteChange.DELETE, notes)
+        get_note_cache().invalidate_many(note_ids)
+        return deleted
+
+
+class NoteManager(models.Manager.from_queryset(NoteQuerySet)):
+    '''
+        Default manager of notes, leaving out the deleted ones.
+    '''
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class Note(TimestampedModel, UserStampedModel):
     '''
         This class inherits from 
@@ -33,57 +94,461 @@ class Note(TimestampedModel, UserStampedModel):
             - UserStampedModel for adding fields like : created_by and updated_by
     '''
     title = models.CharField(max_length=255, null=False, blank=False)
-    description = models.TextField(null=False, blank=False)
+    description = CompressedTextField(null=False, blank=False)
     accessible_users = models.ManyToManyField(get_user_model(), related_name='accessible_notes')
+    # Incremented by every save that changes a tracked field; History rows
+    # of that save carry the new version.
+    version = models.PositiveIntegerField(default=1)
+    # Every version up to this one has its History rows written. Only
+    # behind `version` while write-behind rows are pending, see
+    # `notes.history_writer.advance_history_versions`.
+    history_version = models.PositiveIntegerField(default=1)
+    # Set when the note is deleted; the row is purged in the background
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    objects = NoteManager()
+    # Including the deleted notes
+    all_objects = NoteQuerySet.as_manager()
 
-    #For tracking changes in models
-    tracker = FieldTracker()
+    #For tracking changes in models. Only the fields with a History are
+    #tracked, so assigning any other field (`updated_at` on every save)
+    #never loads it when it was deferred.
+    tracker = FieldTracker(fields=['title', 'description'])
 
     class Meta:
         permissions = (("download_Note", "Can Download Notes"),)
+        indexes = [
+            # Keyset pagination of "my notes": owner range scan in
+            # (updated_at, id) order, covering the listing columns and the
+            # `deleted_at IS NULL` filter of the default manager.
+            models.Index(fields=['created_by', 'deleted_at', '-updated_at', '-id', 'title'], name='note_owner_updated_idx'),
+            models.Index(fields=['-updated_at', '-id'], name='note_updated_idx'),
+            # Purge queue
+            models.Index(
+                fields=['deleted_at', 'id'],
+                condition=models.Q(deleted_at__isnull=False),
+                name='note_deleted_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.title} {self.pk}"
 
-    def save(self, *args, **kwargs):
+    @property
+    def etag(self):
+        '''
+            Strong entity tag of the note content, derived from the version
+            counter.
+        '''
+        return f'"{self.pk}-{self.version}"'
+
+    def patch_description(self, ops):
+        '''
+            Applies the text delta `ops` (see `notes.delta`) to the
+            description. The next save stores the inverse of `ops` in
+            History instead of diffing the old and new descriptions.
+            Raises ValueError if the delta does not fit the description.
+        '''
+        old_value = self.description
+        self.description = delta.apply(ops, old_value)
+        self._description_patch = (old_value, self.description, ops)
+
+    def delete(self, *args, **kwargs):
+        '''
+            Tombstones the note instead of deleting it, so the request does
+            not wait for its History and shares to be deleted.
+        '''
+        deleted = Note.all_objects.filter(pk=self.pk).soft_delete()
+        self.deleted_at = timezone.now()
+        return deleted, {self._meta.label: deleted}
+
+    def save(self, *args, expected_version=None, **kwargs):
         '''
             Custom save method for tracking changes at model level
+
+            With `expected_version` the UPDATE only matches the row while it
+            still has that version, and StaleVersionError is raised (with
+            nothing written) if another write got there first. No row lock
+            is held between reading and writing the note.
+
+            A save without `expected_version` still wins over concurrent
+            writes, but is rebased on the row it overwrites first, so every
+            version gets exactly one History row per changed field and the
+            delta chain stays intact. The retry only writes the fields this
+            save changed, the others keep what the concurrent write stored.
         '''
-        if self.pk:
-            changed_fields = self.tracker.changed()
-            for field, original_value in changed_fields.items():
-                if field == "updated_by_id":
-                    continue
-                new_value = getattr(self, field)
-                # Log the change
-                self.track_changes(field, original_value, new_value)
-        super(Note, self).save(*args, **kwargs)
+        if self.pk and not self._state.adding and kwargs.get('update_fields') is None:
+            deferred = self.get_deferred_fields()
+            # Django only writes the loaded fields of a partially loaded
+            # note; `updated_at` is set by the save either way. The
+            # `history_version` read with the note may be stale, only the
+            # History writer moves it.
+            kwargs['update_fields'] = [
+                field.attname for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname != 'history_version'
+                and (field.attname not in deferred or field.attname == 'updated_at')
+            ]
+        while True:
+            # Read without loading a deferred `updated_at`
+            version, updated_at = self.version, self.__dict__.get('updated_at', models.DEFERRED)
+            saved_data = dict(self.tracker.saved_data)
+            try:
+                return self._save_tracked(expected_version, *args, **kwargs)
+            except StaleVersionError:
+                # Undo what the failed attempt set, so that `updated_at`
+                # does not show up as a changed field
+                self.version = version
+                if updated_at is models.DEFERRED:
+                    self.__dict__.pop('updated_at', None)
+                else:
+                    self.updated_at = updated_at
+                # The tracker marks the fields as saved even when the UPDATE
+                # matched nothing
+                self.tracker.saved_data = saved_data
+                changed = list(self.tracker.changed())
+                if expected_version is not None or not self._rebase():
+                    raise
+                kwargs['update_fields'] = [*changed, 'version', 'updated_at', 'updated_by']
+
+    def _save_tracked(self, expected_version, *args, **kwargs):
+        try:
+            with transaction.atomic():
+                guard = expected_version
+                changes = []
+                if self.pk:
+                    changed_fields = self.tracker.changed()
+                    if changed_fields:
+                        if guard is None:
+                            guard = self.version
+                        self.version += 1
+                    changes = [
+                        (field, original_value, getattr(self, field))
+                        for field, original_value in changed_fields.items()
+                    ]
+                self._expected_version = guard
+                created = not self.pk
+                super(Note, self).save(*args, **kwargs)
+                # Log the changes once the version check has passed
+                self.log_changes(changes)
+                if created or changes:
+                    NoteChange.objects.record(NoteChange.CREATE if created else NoteChange.UPDATE, [self])
+        finally:
+            self._expected_version = None
+            self._description_patch = None
+
+    def _rebase(self):
+        '''
+            Takes the version and the stored values of the tracked fields
+            from the database row, as if the note had just been loaded and
+            the pending changes applied to it. Returns False if the row is
+            gone.
+        '''
+        changed = self.tracker.changed()
+        current = Note.objects.filter(pk=self.pk).values('version', *self.tracker.fields).first()
+        if current is None:
+            return False
+        self.version = current.pop('version')
+        for field, value in current.items():
+            if field not in changed:
+                # Changed by the concurrent write only
+                setattr(self, field, value)
+        self.tracker.saved_data.update(current)
+        return True
+
+    def _do_update(self, base_qs, *args, **kwargs):
+        expected_version = getattr(self, '_expected_version', None)
+        if expected_version is None:
+            return super()._do_update(base_qs, *args, **kwargs)
+        updated = super()._do_update(base_qs.filter(version=expected_version), *args, **kwargs)
+        if not updated:
+            raise StaleVersionError(f"Note {self.pk} is no longer at version {expected_version}.")
+        return updated
     
-    @transaction.atomic
+    def log_changes(self, changes):
+        '''
+            Logs the `(field, old_value, new_value)` changes of one save.
+            In write-behind mode their rows are handed to the background
+            writer together, so that a version is never half written.
+        '''
+        from notes.history_writer import get_history_writer
+
+        writer = get_history_writer()
+        if writer is None:
+            for field, old_value, new_value in changes:
+                self.track_changes(field, old_value, new_value)
+        elif changes:
+            entries = [self.build_history(field, old_value, new_value) for field, old_value, new_value in changes]
+            transaction.on_commit(lambda: writer.capture(entries))
+
     def track_changes(self, field, old_value, new_value):
         '''
             Function to create History object which tracks the 
             changes made to a particular note.
+
+            In write-behind mode (see `notes.history_writer`) the row is
+            handed to the background writer once the save commits instead.
         '''
+        from notes.history_writer import get_history_writer
+
+        writer = get_history_writer()
+        if writer is not None:
+            entry = self.build_history(field, old_value, new_value)
+            transaction.on_commit(lambda: writer.capture([entry]))
+            return
         try:
-            user = self.updated_by
-            History.objects.create(
+            with transaction.atomic():
+                self.build_history(field, old_value, new_value).save()
+        except Exception:
+            logger.exception("Could not record the %s change of note %s", field, self.pk)
+
+    def build_history(self, field, old_value, new_value):
+        '''
+            Returns an unsaved History object for a change of `field`, so
+            that bulk code paths can insert many of them at once.
+        '''
+        user = self.updated_by
+        interval = getattr(settings, 'NOTES_HISTORY_SNAPSHOT_INTERVAL', 50)
+        if field == "description" and self.version % interval != 0:
+            # Store a reverse delta (new -> old); the full text is recovered
+            # from the current note or from the next snapshot, see
+            # `notes.versions`.
+            return History(
                 updated_by = user,
                 note = self,
-                old_value = old_value,
-                new_value = new_value,
-                activity = f"{user} updated {field} from {old_value} to {new_value}"
+                field = field,
+                version = self.version,
+                encoding = History.DELTA,
+                delta = delta.dumps(self.reverse_delta(old_value, new_value)),
+                old_value = '',
+                new_value = '',
+                activity = f"{user} updated {field}"
             )
-        except Exception as e:
-            print(f"ERROR : {e}")
+        return History(
+            updated_by = user,
+            note = self,
+            field = field,
+            version = self.version,
+            old_value = old_value,
+            new_value = new_value,
+            activity = f"{user} updated {field} from {old_value} to {new_value}"
+        )
+
+    def reverse_delta(self, old_value, new_value):
+        '''
+            Returns the delta turning `new_value` back into `old_value`,
+            inverted from the patch of `patch_description()` when it made
+            that change.
+        '''
+        patch = getattr(self, '_description_patch', None)
+        if patch is not None and patch[0] == old_value and patch[1] == new_value:
+            return delta.invert(patch[2], old_value)
+        return delta.diff(new_value, old_value)
 
 class History(TimestampedModel):    
     '''
         This class inherits from a `TimestampedModel` class and is related to storing historical
         data.
+
+        Description changes are stored as reverse deltas (`encoding=delta`,
+        values in `delta`, `old_value`/`new_value` left empty), except every
+        `NOTES_HISTORY_SNAPSHOT_INTERVAL`-th version which keeps the full
+        texts as a snapshot. Use `notes.versions` to read them back.
+
+        Long values and activities are stored zlib compressed, see
+        `notes.fields`.
     '''
+    FULL = 'full'
+    DELTA = 'delta'
+    ENCODING_CHOICES = (
+        (FULL, 'Full'),
+        (DELTA, 'Delta'),
+    )
+
+    # Set when the row is built rather than when it is inserted, so that a
+    # row written behind (see `notes.history_writer`) keeps the time of its save
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_by = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='%(class)s_updated', null=True)
-    old_value = models.TextField()
-    new_value = models.TextField()
-    activity =  models.TextField(default='')
-    note = models.ForeignKey(Note, blank=False, null=True, on_delete=models.CASCADE,)
\ No newline at end of file
+    old_value = CompressedTextField()
+    new_value = CompressedTextField()
+    activity =  CompressedTextField(default='')
+    note = models.ForeignKey(Note, blank=False, null=True, on_delete=models.CASCADE,)
+    field = models.CharField(max_length=64, blank=True, default='')
+    version = models.PositiveIntegerField(default=0)
+    encoding = models.CharField(max_length=8, choices=ENCODING_CHOICES, default=FULL)
+    delta = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['note', 'created_at', 'id'], name='history_note_created_idx'),
+            # Description snapshots, where the delta walk of `notes.versions` starts
+            models.Index(
+                fields=['note', 'field', 'encoding', 'version'],
+                condition=models.Q(field='description', encoding='full'),
+                name='history_snapshot_idx',
+            ),
+        ]
+        constraints = [
+            # One row per field and version, which also makes replaying the
+            # write-behind spool idempotent
+            models.UniqueConstraint(fields=['note', 'field', 'version'], name='history_note_field_version_uniq'),
+        ]
+
+
+class NoteChangeQuerySet(models.QuerySet):
+    def for_user(self, user_id):
+        '''
+            Entries of the feed of `user_id`: the changes of the notes they
+            own or that are shared with them, read through the shares at the
+            time of the query, and their own share, unshare and purge
+            entries.
+        '''
+        owned = Note.all_objects.filter(created_by_id=user_id).values('pk')
+        shared = Note.accessible_users.through.objects.filter(user_id=user_id).values('note_id')
+        return self.filter(
+            models.Q(user_id=user_id)
+            | models.Q(user__isnull=True) & (models.Q(note_id__in=owned) | models.Q(note_id__in=shared))
+        )
+
+
+class NoteChangeManager(models.Manager.from_queryset(NoteChangeQuerySet)):
+    '''
+        Manager writing the change feed. The entries are also published to
+        the connected clients once the transaction commits, see
+        `notes.events`.
+    '''
+    def record(self, action, notes):
+        '''
+            Records `action` on every note of `notes`, one entry per note
+            whatever the number of users it is shared with.
+        '''
+        entries = self.bulk_create([
+            NoteChange(note_id=note.pk, action=action, version=note.version)
+            for note in notes
+        ])
+        publish_changes(entries)
+        return entries
+
+    def record_shares(self, action, pairs):
+        '''
+            Records a share or unshare for every `(note id, user id)` pair,
+            visible to that user only.
+        '''
+        entries = self.bulk_create([
+            NoteChange(user_id=user_id, note_id=note_id, action=action)
+            for note_id, user_id in pairs
+        ])
+        publish_changes(entries)
+        return entries
+
+    def record_purge(self, notes, batch_size=None):
+        '''
+            Records the delete of every `(note id, version)` of `notes` once
+            more for its owner and every user it is shared with, before the
+            purge removes the shares through which their feed reaches the
+            note's own entries. Not published: the delete was when the
+            note was deleted.
+        '''
+        notes = dict(notes)
+        audience = self.audience(notes)
+        return self.bulk_create([
+            NoteChange(user_id=user_id, note_id=note_id, action=NoteChange.DELETE, version=notes[note_id])
+            for note_id in sorted(audience)
+            for user_id in sorted(audience[note_id])
+        ], batch_size=batch_size)
+
+    def audience(self, note_ids, user_ids=None):
+        '''
+            Returns the users each note of `note_ids` is visible to, its
+            owner and the users it is shared with, by note id. With
+            `user_ids` only those users are looked up. Two queries.
+        '''
+        note_ids = list(note_ids)
+        notes = Note.all_objects.filter(pk__in=note_ids)
+        shares = Note.accessible_users.through.objects.filter(note_id__in=note_ids)
+        if user_ids is not None:
+            user_ids = list(user_ids)
+            notes = notes.filter(created_by_id__in=user_ids)
+            shares = shares.filter(user_id__in=user_ids)
+        audience = defaultdict(set)
+        for note_id, user_id in notes.exclude(created_by=None).values_list('pk', 'created_by_id'):
+            audience[note_id].add(user_id)
+        for note_id, user_id in shares.values_list('note_id', 'user_id'):
+            audience[note_id].add(user_id)
+        return audience
+
+    def prune(self, older_than, batch_size=5000):
+        '''
+            Deletes the entries written more than `older_than` ago, oldest
+            first, with DELETE statements of at most `batch_size` rows. Only
+            a prefix of the feed is removed and the newest entry is always
+            kept, so the oldest `seq` left tells `/notes/sync/` how far back
+            a client can resume. Returns the number deleted.
+        '''
+        cutoff = timezone.now() - older_than
+        head = self.aggregate(head=models.Max('seq'))['head']
+        if head is None:
+            return 0
+        kept = self.filter(created_at__gte=cutoff).order_by('seq').values_list('seq', flat=True).first()
+        horizon = head if kept is None else min(kept, head)
+        deleted = 0
+        while True:
+            seqs = list(self.filter(seq__lt=horizon).order_by('seq').values_list('seq', flat=True)[:batch_size])
+            if not seqs:
+                return deleted
+            deleted += self.filter(seq__gte=seqs[0], seq__lte=seqs[-1]).delete()[0]
+
+    def oldest_seq(self):
+        '''
+            Returns the `seq` of the oldest entry left, None if the feed is
+            empty.
+        '''
+        return self.order_by('seq').values_list('seq', flat=True).first()
+
+
+class NoteChange(models.Model):
+    '''
+        One entry of the change feed read by `/notes/sync/`.
+
+        Every create, update and delete of a note is recorded once, with no
+        user, in the transaction of the change: its feed readers are the
+        owner and the users it is shared with when they read it, see
+        `NoteChangeQuerySet.for_user()`. Every share and unshare is recorded
+        once for the user concerned, and the purge of a deleted note once
+        per user who could see it, as the purge removes its shares. `seq`
+        only grows, so a client that knows the last `seq` it has seen reads
+        what changed since with range scans of the (note id, seq) and
+        (user, seq) indexes. Old entries are removed by
+        `prune_note_changes`.
+
+        `note_id` is not a foreign key: entries outlive the purge of the
+        notes they describe.
+    '''
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    SHARE = 'share'
+    UNSHARE = 'unshare'
+    ACTION_CHOICES = (
+        (CREATE, 'Create'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+        (SHARE, 'Share'),
+        (UNSHARE, 'Unshare'),
+    )
+
+    seq = models.BigAutoField(primary_key=True)
+    # Set on share, unshare and purge entries only
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, null=True, related_name='note_changes', db_index=False)
+    note_id = models.IntegerField()
+    action = models.CharField(max_length=8, choices=ACTION_CHOICES)
+    # Version of the note after the change, None for shares
+    version = models.PositiveIntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = NoteChangeManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'seq'], name='note_change_user_idx', condition=models.Q(user__isnull=False)),
+            models.Index(fields=['note_id', 'seq'], name='note_change_note_seq_idx'),
+        ]
@@ -0,0 +1,169 @@
+import base64
+import binascii
+
+from django.db.models import Max, Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    '''
+        Cursor (keyset) pagination over a composite (timestamp, id) key.
+
+        Instead of OFFSET, every page continues strictly after the key of the
+        last row of the previous page, so with a matching composite index
+        page N costs the same as page 1.
+    '''
+    ordering = ('-updated_at', '-id')
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.get_page(list(self.get_page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        '''
+            Async variant of `paginate_queryset()` for the async views.
+        '''
+        return self.get_page([row async for row in self.get_page_queryset(queryset, request)])
+
+    def get_page_queryset(self, queryset, request):
+        '''
+            Returns the rows of the requested page plus one, which tells
+            whether there is a next page.
+        '''
+        self.request = request
+        self.current_page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.get_cursor_filter(cursor))
+        return queryset.order_by(*self.ordering)[:self.current_page_size + 1]
+
+    def get_page(self, results):
+        self.has_next = len(results) > self.current_page_size
+        results = results[:self.current_page_size]
+        self.next_position = self.get_position(results[-1]) if self.has_next else None
+        return results
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_position(self, instance):
+        time_field, id_field = (field.lstrip('-') for field in self.ordering)
+        return getattr(instance, time_field), getattr(instance, id_field)
+
+    def get_cursor_filter(self, position):
+        '''
+            Returns the row-value comparison `(time, id) > (t, i)` (or `<` for
+            descending ordering) spelled out so the index can be used.
+        '''
+        time_field, id_field = (field.lstrip('-') for field in self.ordering)
+        lookup = 'lt' if self.ordering[0].startswith('-') else 'gt'
+        timestamp, pk = position
+        return (
+            Q(**{f'{time_field}__{lookup}': timestamp})
+            | Q(**{time_field: timestamp, f'{id_field}__{lookup}': pk})
+        )
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def encode_cursor(self, position):
+        timestamp, pk = position
+        raw = f'{timestamp.isoformat()}|{pk}'
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            timestamp, pk = raw.rsplit('|', 1)
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, pk
+
+
+class HistoryPagination(KeysetPagination):
+    '''
+        Keyset pagination of a note's History, oldest change first.
+    '''
+    ordering = ('created_at', 'id')
+    page_size = 100
+    max_page_size = 1000
+
+
+class ChangeFeedPagination(KeysetPagination):
+    '''
+        Keyset pagination of the change feed on `seq`, continuing after the
+        `?since=` sequence number.
+
+        Besides `next`, responses carry the `cursor` to send as `since` the
+        next time: the `seq` of the last entry when there are more pages,
+        otherwise the highest `seq` of the whole feed when the page was
+        read, so the entries of other users are never scanned again.
+    '''
+    ordering = ('seq',)
+    page_size = 200
+    max_page_size = 1000
+    cursor_query_param = 'since'
+
+    def get_page_queryset(self, queryset, request):
+        self.since = self.decode_cursor(request) or 0
+        self.head = queryset.model.objects.aggregate(head=Max('seq'))['head'] or 0
+        return super().get_page_queryset(queryset.filter(seq__lte=self.head), request)
+
+    def get_paginated_response(self, data):
+        cursor = self.next_position if self.next_position is not None else max(self.head, self.since)
+        return Response({
+            'next': self.get_next_link(),
+            'cursor': cursor,
+            'results': data,
+        })
+
+    def get_position(self, instance):
+        return instance.seq
+
+    def get_cursor_filter(self, position):
+        return Q(seq__gt=position)
+
+    def encode_cursor(self, position):
+        return str(position)
+
+    def decode_cursor(self, request):
+        value = request.query_params.get(self.cursor_query_param)
+        if not value:
+            return None
+        try:
+            position = int(value)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if position < 0:
+            raise NotFound(self.invalid_cursor_message)
+        return position
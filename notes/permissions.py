@@ -12,12 +12,15 @@ class IsOwnerOrSharedUser(permissions.BasePermission):
         `True`, otherwise it returns `False`.
         """
         # Check if the requesting user is the owner of the note
-        if request.user == obj.created_by:
+        if request.user.pk == obj.created_by_id:
             return True
-        # Check if the requesting user is in the list of accessible users
-        elif request.user in obj.accessible_users.all():
-            return True
-        return False
+        # Check if the requesting user is in the list of accessible users,
+        # using the `is_shared` annotation of `Note.objects.with_share_flag`
+        # when the view loaded it
+        is_shared = getattr(obj, 'is_shared', None)
+        if is_shared is None:
+            is_shared = obj.accessible_users.filter(pk=request.user.pk).exists()
+        return is_shared
 
 class IsOwner(permissions.BasePermission):
     '''
@@ -27,4 +30,13 @@ class IsOwner(permissions.BasePermission):
 
     def has_object_permission(self, request, view, obj) -> bool:
         # Check if the requesting user is the owner of the note
-        return request.user == obj.created_by
\ No newline at end of file
+        return request.user.pk == obj.created_by_id
+
+class CanDownloadNotes(permissions.BasePermission):
+    '''
+        Requires the `notes.download_Note` permission, granted to a user or
+        to one of their groups.
+    '''
+
+    def has_permission(self, request, view) -> bool:
+        return request.user.has_perm('notes.download_Note')
@@ -0,0 +1,102 @@
+'''
+    Purging deleted notes.
+
+    Deleting a note only sets its `deleted_at`. The tombstoned notes are
+    removed here in chunks: their History rows and shares first, in bounded
+    DELETE statements of at most `batch_size` rows, then the notes
+    themselves. Before the shares go, the delete is recorded in the change
+    feed once more for every user who could see the note, as their feed no
+    longer reaches it afterwards (see `NoteChange`). Every statement runs in its own short transaction so the
+    database is never locked for long, and a purge can be interrupted and
+    resumed at any point.
+'''
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from notes.models import History, Note, NoteChange
+
+
+@dataclass
+class PurgeStats:
+    notes: int = 0
+    history: int = 0
+    shares: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+    slowest_statement: float = 0.0
+    started: float = field(default_factory=time.perf_counter, repr=False)
+
+    @property
+    def rows(self):
+        return self.notes + self.history + self.shares
+
+    def as_dict(self):
+        elapsed = self.seconds or 1e-9
+        return {
+            'notes': self.notes,
+            'history': self.history,
+            'shares': self.shares,
+            'chunks': self.chunks,
+            'seconds': round(self.seconds, 3),
+            'notes_per_second': round(self.notes / elapsed, 1),
+            'rows_per_second': round(self.rows / elapsed, 1),
+            'slowest_statement_ms': round(self.slowest_statement * 1000, 2),
+        }
+
+
+def _delete_in_batches(queryset, batch_size, stats):
+    '''
+        Deletes the rows of `queryset` with DELETE statements of at most
+        `batch_size` rows by primary key. Returns the number deleted.
+    '''
+    deleted = 0
+    model = queryset.model
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        started = time.perf_counter()
+        with transaction.atomic():
+            deleted += model._base_manager.filter(pk__in=pks).delete()[0]
+        stats.slowest_statement = max(stats.slowest_statement, time.perf_counter() - started)
+
+
+def purge_deleted_notes(older_than=timedelta(0), chunk_size=100, batch_size=5000, pause=0, limit=None, stats=None):
+    '''
+        Removes the notes deleted more than `older_than` ago, `chunk_size`
+        notes at a time, with their History and shares, and returns the
+        PurgeStats. Stops after `limit` notes when given. `pause` seconds
+        are slept between chunks to leave room for other writers.
+    '''
+    stats = stats or PurgeStats()
+    cutoff = timezone.now() - older_than
+    through = Note.accessible_users.through
+    tombstoned = Note.all_objects.filter(deleted_at__lte=cutoff).order_by('deleted_at', 'id')
+    while limit is None or stats.notes < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - stats.notes)
+        notes = list(tombstoned.values_list('pk', 'version')[:size])
+        if not notes:
+            break
+        note_ids = [note_id for note_id, _ in notes]
+        started = time.perf_counter()
+        with transaction.atomic():
+            NoteChange.objects.record_purge(notes, batch_size=batch_size)
+        stats.slowest_statement = max(stats.slowest_statement, time.perf_counter() - started)
+        stats.history += _delete_in_batches(History.objects.filter(note_id__in=note_ids), batch_size, stats)
+        stats.shares += _delete_in_batches(through.objects.filter(note_id__in=note_ids), batch_size, stats)
+        started = time.perf_counter()
+        # The History and share rows are gone, nothing is left to cascade.
+        # The notes are collected (read) before the transaction of the
+        # delete, which then starts with a write
+        deleted = Note.all_objects.filter(pk__in=note_ids, deleted_at__isnull=False).delete()[1]
+        stats.notes += deleted.get(Note._meta.label, 0)
+        stats.slowest_statement = max(stats.slowest_statement, time.perf_counter() - started)
+        stats.chunks += 1
+        if pause:
+            time.sleep(pause)
+    stats.seconds = time.perf_counter() - stats.started
+    return stats
@@ -0,0 +1,66 @@
+'''
+    Fast JSON rendering.
+
+    `FastJSONRenderer` renders JSON equivalent to that of DRF's
+    `JSONRenderer` with the default settings (compact, unescaped unicode,
+    U+2028/U+2029 escaped), faster: with `orjson` when it is installed,
+    otherwise with one reused stdlib encoder, which renders the same bytes.
+    orjson writes some floats differently (`1e-7` for `1e-07`, `1e16` for
+    `1e+16`), the values parsed back are the same. Values orjson does not
+    know natively (datetimes, lazy strings, decimals...) go through DRF's
+    `JSONEncoder`, and anything orjson rejects (integers over 64 bits,
+    non-string keys) is rendered by the stdlib encoder instead. Indented
+    output (`indent=` in the Accept header, the browsable API) is left to
+    `JSONRenderer`.
+
+    orjson renders NaN and infinities as `null` where the stdlib encoder
+    raises; the API never returns them.
+'''
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+_default = JSONEncoder().default
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+def dumps(data, escape_line_separators=True):
+    '''
+        Returns `data` as compact JSON bytes, as `JSONRenderer` renders it
+        when `escape_line_separators` is set.
+    '''
+    if orjson is not None:
+        try:
+            rendered = orjson.dumps(data, default=_default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            pass
+        else:
+            if escape_line_separators and b'\xe2\x80' in rendered:
+                rendered = rendered.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+            return rendered
+    rendered = _encoder.encode(data)
+    if escape_line_separators:
+        rendered = rendered.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+    return rendered.encode()
+
+
+class FastJSONRenderer(JSONRenderer):
+    '''
+        Drop-in JSONRenderer rendering through `dumps`.
+    '''
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.ensure_ascii or not self.compact or not self.strict:
+            return super().render(data, accepted_media_type, renderer_context)
+        indented = 'indent' in (accepted_media_type or '') or (renderer_context or {}).get('indent') is not None
+        if indented and self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
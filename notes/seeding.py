@@ -0,0 +1,205 @@
+'''
+    Synthetic data generation for load testing.
+
+    Generation is deterministic for a given seed: every user gets its own
+    random stream, so the same dataset is produced whatever the number of
+    worker processes. Workers only build plain row data; all writes happen
+    in the parent with batched `bulk_create` calls in chunked transactions.
+'''
+import multiprocessing
+import random
+import string
+import time
+from dataclasses import dataclass
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connections, transaction
+
+from notes.models import History, Note, NoteChange
+from notes.streaming import iter_chunks
+
+User = get_user_model()
+
+HISTORY_FIELDS = ('field', 'version', 'encoding', 'old_value', 'new_value', 'delta', 'activity')
+ALPHABET = string.ascii_letters + '     '
+WORDS = (
+    'the a to of and in for on with is it that this we be will at as by from are our meeting project draft review '
+    'customer update plan team release budget design issue fix deploy schedule notes agenda follow up action items '
+    'decided next week owner status blocked waiting feedback api database migration test report quarter goals'
+).split()
+
+
+@dataclass
+class SeedOptions:
+    users: int = 100
+    notes_per_user: int = 10
+    share_fanout: int = 2
+    edits_per_note: int = 0
+    description_size: int = 200
+    seed: int = 0
+    batch_size: int = 2000
+    processes: int = 1
+    password: str = 'Test@1234'
+    prefix: str = 'load'
+
+
+def random_text(rng, size):
+    return ''.join(rng.choices(ALPHABET, k=size))
+
+
+def prose_text(rng, size):
+    '''
+        Word based text of `size` characters, compressing like real notes
+        (`random_text` is close to incompressible).
+    '''
+    words, length = [], 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word + ('.\n' if rng.random() < 0.08 else ' '))
+        length += len(words[-1])
+    return ''.join(words)[:size]
+
+
+def mutate_text(rng, text):
+    '''
+        Returns `text` with a small random insertion, deletion or
+        replacement, like a typical interactive edit.
+    '''
+    position = rng.randrange(len(text) + 1)
+    length = rng.randint(1, 20)
+    fragment = ''.join(rng.choices(string.ascii_letters, k=length))
+    kind = rng.choice(('insert', 'delete', 'replace'))
+    if kind == 'insert':
+        return text[:position] + fragment + text[position:]
+    if kind == 'delete':
+        return text[:position] + text[position + length:] or fragment
+    return text[:position] + fragment + text[position + length:]
+
+
+def username(options, index):
+    return f'{options.prefix}{options.seed}_{index}'
+
+
+def generate_user_notes(options, user_index):
+    '''
+        Returns the note rows of one user as plain dicts. History rows are
+        built with `Note.build_history`, so they use the same delta encoding
+        as real edits.
+    '''
+    rng = random.Random(f'{options.seed}:{user_index}')
+    owner = User(username=username(options, user_index), email=f'{username(options, user_index)}@example.com')
+    fanout = min(options.share_fanout, options.users - 1)
+    rows = []
+    for _ in range(options.notes_per_user):
+        note = Note(
+            title=random_text(rng, 20).strip() or 'Untitled',
+            description=random_text(rng, options.description_size),
+            updated_by=owner,
+        )
+        history = []
+        for _ in range(options.edits_per_note):
+            new_description = mutate_text(rng, note.description)
+            note.version += 1
+            entry = note.build_history('description', note.description, new_description)
+            history.append({field: getattr(entry, field) for field in HISTORY_FIELDS})
+            note.description = new_description
+        rows.append({
+            'owner': user_index,
+            'title': note.title,
+            'description': note.description,
+            'version': note.version,
+            'history': history,
+            # Sample among the other users without materializing them all
+            'shared': [
+                index + (index >= user_index)
+                for index in rng.sample(range(options.users - 1), fanout)
+            ],
+        })
+    return rows
+
+
+def _generate_chunk(args):
+    options, user_indexes = args
+    return [row for user_index in user_indexes for row in generate_user_notes(options, user_index)]
+
+
+def seed(options, log=None):
+    '''
+        Creates `options.users` users and their notes, shares and History
+        rows. Returns a dict of row counts and elapsed seconds.
+    '''
+    log = log or (lambda message: None)
+    started = time.perf_counter()
+    counts = {'users': 0, 'notes': 0, 'shares': 0, 'history': 0}
+
+    password = make_password(options.password)
+    user_ids = []
+    for indexes in iter_chunks(range(options.users), options.batch_size):
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(
+                    username=username(options, index),
+                    email=f'{username(options, index)}@example.com',
+                    password=password,
+                    first_name='Load',
+                    last_name='User',
+                )
+                for index in indexes
+            ])
+        user_ids.extend(user.pk for user in users)
+        counts['users'] += len(users)
+    log(f"users: {counts['users']}")
+
+    # Enough users per task to keep workers busy without holding the whole
+    # dataset in memory.
+    users_per_task = max(1, options.batch_size // max(options.notes_per_user, 1))
+    tasks = [(options, indexes) for indexes in iter_chunks(range(options.users), users_per_task)]
+    if options.processes > 1:
+        connections.close_all()
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        with context.Pool(options.processes) as pool:
+            for rows in pool.imap(_generate_chunk, tasks):
+                write_notes(rows, user_ids, options, counts)
+                log(f"notes: {counts['notes']}")
+    else:
+        for task in tasks:
+            write_notes(_generate_chunk(task), user_ids, options, counts)
+            log(f"notes: {counts['notes']}")
+
+    counts['seconds'] = time.perf_counter() - started
+    return counts
+
+
+def write_notes(rows, user_ids, options, counts):
+    through = Note.accessible_users.through
+    for chunk in iter_chunks(rows, options.batch_size):
+        with transaction.atomic():
+            notes = Note.objects.bulk_create([
+                Note(
+                    title=row['title'],
+                    description=row['description'],
+                    version=row['version'],
+                    # The whole history is written below
+                    history_version=row['version'],
+                    created_by_id=user_ids[row['owner']],
+                    updated_by_id=user_ids[row['owner']],
+                )
+                for row in chunk
+            ], batch_size=options.batch_size)
+            shares = [
+                through(note_id=note.pk, user_id=user_ids[index])
+                for note, row in zip(notes, chunk)
+                for index in row['shared']
+            ]
+            through.objects.bulk_create(shares, batch_size=options.batch_size)
+            history = [
+                History(note_id=note.pk, updated_by_id=user_ids[row['owner']], **entry)
+                for note, row in zip(notes, chunk)
+                for entry in row['history']
+            ]
+            History.objects.bulk_create(history, batch_size=options.batch_size)
+            NoteChange.objects.record(NoteChange.CREATE, notes)
+        counts['notes'] += len(notes)
+        counts['shares'] += len(shares)
+        counts['history'] += len(history)
@@ -2,10 +2,40 @@ from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 
-from notes.models import Note, History
+from notes.models import Note, History, NoteChange
 
 
-class NotesSerializer(ModelSerializer):
+def parse_fields(value, allowed):
+    '''
+        Returns the names listed in a `?fields=` value (comma separated), in
+        the order of `allowed`, or None when the parameter is absent or
+        lists every field. Unknown names raise a ValidationError.
+    '''
+    if value is None:
+        return None
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = names - set(allowed)
+    if unknown:
+        raise serializers.ValidationError({'fields': [f"Unknown fields: {', '.join(sorted(unknown))}."]})
+    if not names:
+        raise serializers.ValidationError({'fields': ["Provide at least one field."]})
+    if len(names) == len(allowed):
+        return None
+    return tuple(name for name in allowed if name in names)
+
+class SparseFieldsMixin:
+    '''
+        Serializer mixin keeping only the fields named in the `fields` entry
+        of the context (see `parse_fields`), all of them when it is None.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get('fields')
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class NotesSerializer(SparseFieldsMixin, ModelSerializer):
     '''
         ModelSerializer for updating and creating Notes.
     '''
@@ -13,13 +43,97 @@ class NotesSerializer(ModelSerializer):
         model = Note
         fields = ("title","description")
 
-class HistorySerializer(ModelSerializer):
+class NoteListSerializer(ModelSerializer):
+    '''
+        ModelSerializer for the notes listing. `description` is only
+        included when the view asks for it through the serializer context.
+    '''
+    class Meta:
+        model = Note
+        fields = ("id", "title", "description", "created_by", "updated_at")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.context.get('include_description'):
+            self.fields.pop('description')
+
+class HistorySerializer(SparseFieldsMixin, ModelSerializer):
     '''
         ModelSerializer for sending data from History.
     '''
     class Meta:
         model = History
-        fields = ('updated_by', 'old_value', 'new_value', 'activity', 'note')
+        fields = ('updated_by', 'old_value', 'new_value', 'activity', 'note', 'version')
+
+class NoteChangeSerializer(ModelSerializer):
+    '''
+        ModelSerializer for the change feed. `note` holds the current title
+        and description of the note, null once it was deleted or unshared.
+    '''
+    note = NotesSerializer(read_only=True)
+
+    class Meta:
+        model = NoteChange
+        fields = ('seq', 'note_id', 'action', 'version', 'created_at', 'note')
+
+class HistoryFilterSerializer(serializers.Serializer):
+    '''
+        Serializer for validating the query parameters of the version
+        history endpoint.
+    '''
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    updated_by = serializers.IntegerField(required=False)
+    stream = serializers.ChoiceField(choices=("ndjson",), required=False)
+
+class NoteAsOfSerializer(serializers.Serializer):
+    '''
+        Serializer for validating the query parameters of the point in time
+        endpoint: exactly one of `timestamp` and `version`.
+    '''
+    timestamp = serializers.DateTimeField(required=False)
+    version = serializers.IntegerField(min_value=1, required=False)
+
+    def validate(self, data):
+        if ('timestamp' in data) == ('version' in data):
+            raise serializers.ValidationError("Provide either timestamp or version.")
+        return data
+
+class NoteExportSerializer(serializers.Serializer):
+    '''
+        Serializer for validating the query parameters of the export
+        endpoint.
+    '''
+    output = serializers.ChoiceField(choices=("ndjson", "csv", "zip"), default="ndjson")
+    history = serializers.BooleanField(default=False)
+    after = serializers.IntegerField(min_value=0, required=False)
+
+class NoteEventsSerializer(serializers.Serializer):
+    '''
+        Serializer for validating the query parameters of the note events
+        endpoint.
+    '''
+    since = serializers.IntegerField(min_value=0, required=False)
+    timeout = serializers.FloatField(min_value=0, required=False)
+
+class NoteImportSerializer(serializers.Serializer):
+    '''
+        Serializer for validating the query parameters of the import
+        endpoint.
+    '''
+    input = serializers.ChoiceField(choices=("ndjson", "csv"), default="ndjson")
+
+def validate_user_ids(user_ids):
+    '''
+        Checks that every id belongs to an existing user with a single IN
+        query and returns the de-duplicated ids.
+    '''
+    user_ids = set(user_ids)
+    existing = set(get_user_model().objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+    missing = sorted(user_ids - existing)
+    if missing:
+        raise serializers.ValidationError(f"Invalid user ids: {missing}")
+    return sorted(user_ids)
 
 class NoteShareSerializer(serializers.Serializer):
     '''
@@ -30,7 +144,32 @@ class NoteShareSerializer(serializers.Serializer):
         exisisting user in our system or not.
     '''
     note_id = serializers.IntegerField()
-    users = serializers.PrimaryKeyRelatedField(queryset=get_user_model().objects.all(), many=True)
+    users = serializers.ListField(child=serializers.IntegerField())
+
+    def validate_users(self, value):
+        return validate_user_ids(value)
+
+class NoteBulkShareSerializer(serializers.Serializer):
+    '''
+        Serializer for validating a bulk share/unshare of many notes with
+        many users. User ids are checked with a single IN query.
+    '''
+    MAX_PAIRS = 100_000
+
+    action = serializers.ChoiceField(choices=("share", "unshare"), default="share")
+    note_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+    user_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+    def validate_note_ids(self, value):
+        return sorted(set(value))
+
+    def validate_user_ids(self, value):
+        return validate_user_ids(value)
+
+    def validate(self, attrs):
+        if len(attrs['note_ids']) * len(attrs['user_ids']) > self.MAX_PAIRS:
+            raise serializers.ValidationError(f"At most {self.MAX_PAIRS} note/user pairs per request.")
+        return attrs
 
 class NoteUpdateSerializer(serializers.ModelSerializer):
     '''
@@ -39,4 +178,73 @@ class NoteUpdateSerializer(serializers.ModelSerializer):
     '''
     class Meta:
         model = Note
-        fields = ['description']
\ No newline at end of file
+        fields = ['description']
+
+    def update(self, instance, validated_data):
+        expected_version = validated_data.pop('expected_version', None)
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(expected_version=expected_version)
+        return instance
+
+class NotePatchSerializer(serializers.Serializer):
+    '''
+        Serializer for validating a text patch of a note description.
+
+        `patch` is a delta (see `notes.delta`) against the description of
+        `base_version`, e.g. `[120, -5, "fixed", 3000]`. The note is only
+        saved while it is still at `base_version`, and the response holds
+        the new `version` instead of the description.
+    '''
+    MAX_OPERATIONS = 10000
+
+    base_version = serializers.IntegerField(min_value=1, write_only=True)
+    patch = serializers.ListField(child=serializers.JSONField(), max_length=MAX_OPERATIONS, write_only=True)
+    version = serializers.IntegerField(read_only=True)
+
+    def update(self, instance, validated_data):
+        try:
+            instance.patch_description(validated_data['patch'])
+        except ValueError as error:
+            raise serializers.ValidationError({'patch': [str(error)]})
+        if not instance.description:
+            raise serializers.ValidationError({'patch': ["The description may not be blank."]})
+        instance.updated_by = validated_data['updated_by']
+        instance.save(expected_version=validated_data['base_version'])
+        return instance
+
+class NoteBatchOperationSerializer(serializers.Serializer):
+    '''
+        Serializer for validating a single operation of a batch request.
+
+        - `create` requires `title` and `description`
+        - `update` requires `id` and at least one of `title`/`description`
+        - `delete` requires `id`
+    '''
+    op = serializers.ChoiceField(choices=("create", "update", "delete"))
+    id = serializers.IntegerField(required=False)
+    title = serializers.CharField(max_length=255, required=False)
+    description = serializers.CharField(required=False)
+
+    def validate(self, attrs):
+        op = attrs['op']
+        if op == 'create' and not ('title' in attrs and 'description' in attrs):
+            raise serializers.ValidationError("create requires title and description.")
+        if op in ('update', 'delete') and 'id' not in attrs:
+            raise serializers.ValidationError(f"{op} requires id.")
+        if op == 'update' and not ('title' in attrs or 'description' in attrs):
+            raise serializers.ValidationError("update requires title or description.")
+        return attrs
+
+class NoteBatchSerializer(serializers.Serializer):
+    '''
+        Serializer for validating the list of operations applied by the
+        batch endpoint in a single transaction.
+    '''
+    MAX_OPERATIONS = 1000
+
+    operations = serializers.ListField(
+        child=NoteBatchOperationSerializer(),
+        allow_empty=False,
+        max_length=MAX_OPERATIONS,
+    )
@@ -0,0 +1,59 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from notes.cache import get_note_cache
+from notes.models import Note, NoteChange
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_delete, sender=Note)
+def invalidate_cached_note(sender, instance, **kwargs):
+    '''
+        Drops the cached copy of a note when it is saved or deleted.
+    '''
+    get_note_cache().invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=Note.accessible_users.through)
+def invalidate_cached_note_acl(sender, instance, action, reverse, pk_set, **kwargs):
+    '''
+        Drops the cached ACL of the notes whose `accessible_users` changed,
+        from either side of the relation.
+    '''
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            get_note_cache().invalidate(instance.pk)
+    elif action in ('post_add', 'post_remove'):
+        get_note_cache().invalidate_many(pk_set)
+    elif action == 'pre_clear':
+        get_note_cache().invalidate_many(instance.accessible_notes.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Note.accessible_users.through)
+def record_note_shares(sender, instance, action, reverse, pk_set, **kwargs):
+    '''
+        Records the users a note was shared with or unshared from in the
+        change feed, from either side of the relation. `pk_set` of an add
+        only holds the users it actually added, that of a remove every
+        requested one, so the pairs a remove deletes are read before it.
+    '''
+    if action == 'pre_clear':
+        if reverse:
+            pairs = [(note_id, instance.pk) for note_id in instance.accessible_notes.values_list('pk', flat=True)]
+        else:
+            pairs = [(instance.pk, user_id) for user_id in instance.accessible_users.values_list('pk', flat=True)]
+        NoteChange.objects.record_shares(NoteChange.UNSHARE, pairs)
+    elif action == 'pre_remove' and pk_set:
+        if reverse:
+            shares = sender.objects.filter(user_id=instance.pk, note_id__in=pk_set)
+        else:
+            shares = sender.objects.filter(note_id=instance.pk, user_id__in=pk_set)
+        instance._removed_shares = list(shares.order_by('note_id', 'user_id').values_list('note_id', 'user_id'))
+    elif action == 'post_remove':
+        NoteChange.objects.record_shares(NoteChange.UNSHARE, instance.__dict__.pop('_removed_shares', []))
+    elif action == 'post_add' and pk_set:
+        if reverse:
+            pairs = [(note_id, instance.pk) for note_id in pk_set]
+        else:
+            pairs = [(instance.pk, user_id) for user_id in pk_set]
+        NoteChange.objects.record_shares(NoteChange.SHARE, sorted(pairs))
@@ -0,0 +1,26 @@
+'''
+    Helpers for streaming large result sets without holding them in memory.
+'''
+from itertools import islice
+
+from notes.renderers import dumps
+
+
+def iter_chunks(iterable, size):
+    '''
+        Yields lists of at most `size` items from `iterable`.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ndjson_line(record):
+    '''
+        Returns `record` as one line of newline delimited JSON, encoded the
+        same way DRF renders it.
+    '''
+    return dumps(record, escape_line_separators=False).decode() + '\n'
@@ -1,9 +1,45 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+import zlib
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management import call_command
+from django.db import OperationalError, connection, models, transaction
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
 from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
 from rest_framework import status
-from notes.models import Note
+from rest_framework.exceptions import ErrorDetail
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.tokens import AccessToken
+from notes import benchmarking, delta, renderers
+from notes.cache import DjangoCacheBackend, LRUCacheBackend, NoteCache, get_note_cache
+from notes.events import EventHub, LocalBroker, get_event_hub
+from notes.fields import MARKER, compress, compress_existing, decompress_existing
+from notes.history_writer import Spool, get_history_writer, history_row, wait_for_history
+from notes.models import History, Note, NoteChange, StaleVersionError
+from notes.renderers import FastJSONRenderer
+from notes.seeding import SeedOptions
 from notes.serializers import (
     NotesSerializer,
     NoteShareSerializer,
@@ -13,8 +49,16 @@ from notes.permissions import (
     IsOwnerOrSharedUser,
     IsOwner
 )
+from notes.export import export_records
+from notes.versions import check_history_written, decode_history, note_at_version
+from users.authentication import token_cache, user_cache
+from notes_management.middleware import CompressionMiddleware, SQLInstrumentationMiddleware, negotiate_encoding, normalize_sql
+from notes_management.sqlite import base as sqlite_backend
 from notes.views import (
+    NoteBatchView,
+    NoteExportView,
     NotesRetrieveUpdateView,
+    NoteVersionHistoryView,
 )
 
 User = get_user_model()
@@ -230,4 +274,2207 @@ class NoteUpdateSerializerTestCase(TestCase):
     def test_serializer_invalid_data(self):
         data = {'title': '', 'description': ''}
         serializer = NoteUpdateSerializer(data=data)
-        self.assertFalse(serializer.is_valid())
\ No newline at end of file
+        self.assertFalse(serializer.is_valid())
+
+class NotesListViewTestCase(TestCase):
+    """
+        The below code tests the keyset paginated listing of owned and shared notes.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.other_user = User.objects.create_user(username='otheruser', password='password123', email='otheruser@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.owned = [
+            Note.objects.create(title=f'Note {i}', description='Body', created_by=self.user, updated_by=self.user)
+            for i in range(5)
+        ]
+        self.shared = Note.objects.create(title='Shared', description='Body', created_by=self.other_user, updated_by=self.other_user)
+        self.shared.accessible_users.add(self.user)
+        Note.objects.create(title='Private', description='Body', created_by=self.other_user, updated_by=self.other_user)
+
+    def test_list_pages_through_owned_and_shared_notes(self):
+        url = reverse('list-notes')
+        seen = []
+        response = self.client.get(url, {'page_size': 2})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(item['id'] for item in response.data['results'])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+
+        expected = Note.objects.filter(pk__in=[note.pk for note in self.owned] + [self.shared.pk])
+        self.assertEqual(seen, list(expected.order_by('-updated_at', '-id').values_list('id', flat=True)))
+
+    def test_list_excludes_description_unless_requested(self):
+        url = reverse('list-notes')
+        response = self.client.get(url)
+        self.assertNotIn('description', response.data['results'][0])
+
+        response = self.client.get(url, {'include_description': 'true'})
+        self.assertEqual(response.data['results'][0]['description'], 'Body')
+
+    def test_list_invalid_cursor(self):
+        response = self.client.get(reverse('list-notes'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+
+class NoteBatchViewTestCase(TestCase):
+    """
+        The below code tests applying create/update/delete operations in a single batch request.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.other_user = User.objects.create_user(username='otheruser', password='password123', email='otheruser@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.note = Note.objects.create(title='Test Note', description='This is a test note', created_by=self.user, updated_by=self.user)
+        self.url = reverse('note-batch')
+
+    def test_batch_create_update_delete(self):
+        shared = Note.objects.create(title='Shared', description='Body', created_by=self.other_user, updated_by=self.other_user)
+        shared.accessible_users.add(self.user)
+        data = {'operations': [
+            {'op': 'create', 'title': 'New Note', 'description': 'New body'},
+            {'op': 'update', 'id': self.note.id, 'description': 'Updated body'},
+            {'op': 'delete', 'id': shared.id},
+        ]}
+        response = self.client.post(self.url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        created_id = response.data['results'][0]['id']
+        self.assertEqual(Note.objects.get(pk=created_id).created_by, self.user)
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.description, 'Updated body')
+        self.assertFalse(Note.objects.filter(pk=shared.id).exists())
+        history, = decode_history(self.note, [History.objects.get(note=self.note)])
+        self.assertEqual(self.note.version, 2)
+        self.assertEqual((history.old_value, history.new_value), ('This is a test note', 'Updated body'))
+
+    def test_batch_rejects_forbidden_operations_atomically(self):
+        private = Note.objects.create(title='Private', description='Body', created_by=self.other_user, updated_by=self.other_user)
+        data = {'operations': [
+            {'op': 'update', 'id': self.note.id, 'title': 'Changed'},
+            {'op': 'update', 'id': private.id, 'title': 'Changed'},
+            {'op': 'delete', 'id': 0},
+        ]}
+        response = self.client.post(self.url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.title, 'Test Note')
+
+    def test_batch_query_count_does_not_grow_with_operations(self):
+        notes = Note.objects.bulk_create([
+            Note(title=f'Note {i}', description='Body', created_by=self.user, updated_by=self.user)
+            for i in range(100)
+        ])
+        operations = [{'op': 'update', 'id': note.id, 'description': f'Body {note.id}'} for note in notes]
+        operations += [{'op': 'create', 'title': f'New {i}', 'description': 'Body'} for i in range(100)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, {'operations': operations}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertLess(len(queries), 15)
+        self.assertEqual(History.objects.filter(note__in=notes).count(), 100)
+
+    def test_batch_conflicts_with_a_concurrent_save(self):
+        other = Note.objects.create(title='Other', description='Body', created_by=self.user, updated_by=self.user)
+        data = {'operations': [
+            {'op': 'create', 'title': 'New Note', 'description': 'New body'},
+            {'op': 'update', 'id': other.id, 'title': 'Batched'},
+            {'op': 'update', 'id': self.note.id, 'description': 'Batched body'},
+        ]}
+        check_operations = NoteBatchView.check_operations
+
+        def save_concurrently(view, operations, notes, user):
+            # Another request saves the note after the batch read it
+            concurrent = Note.objects.get(pk=self.note.pk)
+            concurrent.description = 'Concurrent body'
+            concurrent.save()
+            return check_operations(view, operations, notes, user)
+
+        with mock.patch.object(NoteBatchView, 'check_operations', autospec=True, side_effect=save_concurrently):
+            response = self.client.post(self.url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual([error['index'] for error in response.data['errors']], [2])
+        # Nothing of the batch was written. The concurrent save ran on the
+        # same connection here, inside the batch transaction, so it is
+        # rolled back with it.
+        self.note.refresh_from_db()
+        other.refresh_from_db()
+        self.assertNotEqual(self.note.description, 'Batched body')
+        self.assertEqual((other.title, other.version), ('Other', 1))
+        self.assertFalse(Note.objects.filter(title='New Note').exists())
+        self.assertFalse(History.objects.filter(note=other).exists())
+
+
+
+class DeltaTestCase(TestCase):
+    """
+        The below code tests diffing and applying the compact text deltas used by History.
+    """
+    def test_roundtrip(self):
+        pairs = [
+            ('', 'new text'),
+            ('old text', ''),
+            ('The quick brown fox', 'The quick red fox jumps'),
+            ('héllo wörld ✓', 'hello wörld ✗!'),
+            ('a' * 5000 + 'b' + 'a' * 5000, 'a' * 5000 + 'c' + 'a' * 5000),
+        ]
+        for source, target in pairs:
+            ops = delta.loads(delta.dumps(delta.diff(source, target)))
+            self.assertEqual(delta.apply(ops, source), target)
+
+    def test_small_edit_gives_small_delta(self):
+        source = 'x' * 100_000
+        target = source[:50_000] + 'y' + source[50_000:]
+        self.assertLess(len(delta.dumps(delta.diff(target, source))), 32)
+
+    def test_apply_rejects_wrong_source(self):
+        ops = delta.diff('abc', 'abd')
+        with self.assertRaises(ValueError):
+            delta.apply(ops, 'abcdef')
+
+    def test_invert(self):
+        pairs = [
+            ('', 'new text'),
+            ('old text', ''),
+            ('The quick brown fox', 'The quick red fox jumps'),
+            ('héllo wörld ✓', 'hello wörld ✗!'),
+        ]
+        for source, target in pairs:
+            inverse = delta.invert(delta.diff(source, target), source)
+            self.assertEqual(inverse, delta.diff(target, source))
+            self.assertEqual(delta.apply(inverse, target), source)
+        with self.assertRaises(ValueError):
+            delta.invert([5, 'x'], 'abc')
+
+
+@override_settings(NOTES_HISTORY_SNAPSHOT_INTERVAL=3)
+class HistoryDeltaEncodingTestCase(TestCase):
+    """
+        The below code tests that description history is delta encoded and still reads back in full.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.note = Note.objects.create(title='Title 1', description='Description 1', created_by=self.user, updated_by=self.user)
+        self.states = [('Title 1', 'Description 1')]
+        for i in range(2, 9):
+            if i % 4 == 0:
+                self.note.title = f'Title {i}'
+            self.note.description = f'Description {i} ' + 'body ' * i
+            self.note.save()
+            self.states.append((self.note.title, self.note.description))
+
+    def test_description_rows_are_deltas_between_snapshots(self):
+        rows = History.objects.filter(note=self.note, field='description').order_by('version')
+        self.assertEqual(
+            [(row.version, row.encoding) for row in rows],
+            [(v, History.FULL if v % 3 == 0 else History.DELTA) for v in range(2, 9)],
+        )
+        self.assertTrue(all(row.new_value == '' for row in rows if row.encoding == History.DELTA))
+
+    def test_decode_history_restores_full_values(self):
+        entries = decode_history(self.note, list(History.objects.filter(note=self.note, field='description').order_by('version')))
+        for entry in entries:
+            old_description = self.states[entry.version - 2][1]
+            new_description = self.states[entry.version - 1][1]
+            self.assertEqual((entry.old_value, entry.new_value), (old_description, new_description))
+            self.assertTrue(entry.activity.endswith(f'from {old_description} to {new_description}'))
+
+    def test_note_at_version(self):
+        for version, (title, description) in enumerate(self.states, start=1):
+            state = note_at_version(self.note, version)
+            self.assertEqual((state['title'], state['description']), (title, description))
+        with self.assertRaises(ValueError):
+            note_at_version(self.note, len(self.states) + 1)
+
+    def test_version_history_view_returns_full_values(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.get(reverse('get-history', kwargs={'id': self.note.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        descriptions = [entry for entry in response.data['results'] if 'updated description' in entry['activity']]
+        self.assertEqual([entry['new_value'] for entry in descriptions], [state[1] for state in self.states[1:]])
+
+    def test_benchmark_history_storage_command(self):
+        out = StringIO()
+        call_command('benchmark_history_storage', size=2000, edits=20, interval=5, stdout=out)
+        self.assertIn('delta format', out.getvalue())
+
+    def test_unconditional_save_of_stale_instance_keeps_chain(self):
+        first = Note.objects.get(pk=self.note.pk)
+        second = Note.objects.get(pk=self.note.pk)
+        first.description = 'First writer'
+        first.save()
+        second.description = 'Second writer'
+        second.save()
+
+        self.assertEqual(second.version, 10)
+        self.assertEqual(Note.objects.get(pk=self.note.pk).description, 'Second writer')
+        rows = History.objects.filter(note=self.note, field='description').order_by('version')
+        self.assertEqual([row.version for row in rows], list(range(2, 11)))
+        self.assertFalse(History.objects.filter(note=self.note, field='updated_at').exists())
+        self.assertEqual(note_at_version(second, 9)['description'], 'First writer')
+        entries = decode_history(second, list(rows))
+        self.assertEqual((entries[-1].old_value, entries[-1].new_value), ('First writer', 'Second writer'))
+
+    def test_reads_leave_out_saves_committed_after_the_note(self):
+        for version in (9, 10):
+            self.note.description = f'Description {version}'
+            self.note.save()
+        stale = Note.objects.get(pk=self.note.pk)
+        self.note.description = 'Committed after the read'
+        self.note.save()
+
+        rows = History.objects.filter(note=self.note, field='description', version__lte=stale.version).order_by('version')
+        entries = decode_history(stale, list(rows))
+        self.assertEqual((entries[-1].old_value, entries[-1].new_value), ('Description 9', 'Description 10'))
+        self.assertEqual(note_at_version(stale, 9)['description'], 'Description 9')
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        with mock.patch.object(NoteVersionHistoryView, 'get_object', return_value=stale):
+            response = client.get(reverse('get-history', kwargs={'id': self.note.id}), {'page_size': 50})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(max(entry['version'] for entry in response.data['results']), 10)
+
+    def test_stale_saves_of_different_fields_keep_both(self):
+        first = Note.objects.get(pk=self.note.pk)
+        second = Note.objects.get(pk=self.note.pk)
+        first.title = 'First writer'
+        first.save()
+        second.description = 'Second writer'
+        second.save()
+
+        note = Note.objects.get(pk=self.note.pk)
+        self.assertEqual((note.title, note.description, note.version), ('First writer', 'Second writer', 10))
+        self.assertEqual((second.title, second.version), ('First writer', 10))
+        self.assertEqual(note_at_version(note, 9)['title'], 'First writer')
+        self.assertEqual(note_at_version(note, 10), {'version': 10, 'title': 'First writer', 'description': 'Second writer'})
+
+
+class NoteAccessQueryTestCase(TestCase):
+    """
+        The below code tests that note access is resolved in a single query, whatever the number of shared users.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(username='owner', password='password123', email='owner@example.com')
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.note = Note.objects.create(title='Test Note', description='This is a test note', created_by=self.owner, updated_by=self.owner)
+        others = User.objects.bulk_create([
+            User(username=f'user{i}', email=f'user{i}@example.com') for i in range(200)
+        ])
+        self.note.accessible_users.add(*others)
+
+    def test_shared_user_retrieves_note_in_one_query(self):
+        self.note.accessible_users.add(self.user)
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('get-edit-note', kwargs={'id': self.note.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_stranger_is_forbidden_in_one_query(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('get-edit-note', kwargs={'id': self.note.id}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_missing_note_is_not_found(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('get-edit-note', kwargs={'id': self.note.id + 1000}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_version_history_requires_access(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('get-history', kwargs={'id': self.note.id}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_delete_requires_shared_access(self):
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.delete(reverse('get-edit-note', kwargs={'id': self.note.id}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.note.accessible_users.add(self.user)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.delete(reverse('get-edit-note', kwargs={'id': self.note.id}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Note.objects.filter(pk=self.note.id).exists())
+
+
+
+class NoteVersionHistoryViewTestCase(TestCase):
+    """
+        The below code tests paginating, filtering and streaming the version history of a note.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.editor = User.objects.create_user(username='editor', password='password123', email='editor@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.note = Note.objects.create(title='Test Note', description='Description 0', created_by=self.user, updated_by=self.user)
+        self.note.accessible_users.add(self.editor)
+        for i in range(1, 8):
+            self.note.updated_by = self.editor if i % 2 else self.user
+            self.note.description = f'Description {i}'
+            self.note.save()
+        self.url = reverse('get-history', kwargs={'id': self.note.id})
+
+    def test_history_is_cursor_paginated_in_order(self):
+        versions = []
+        response = self.client.get(self.url, {'page_size': 3})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            versions.extend(entry['version'] for entry in response.data['results'])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(versions, list(range(2, 9)))
+
+    def test_history_filters(self):
+        response = self.client.get(self.url, {'updated_by': self.editor.id})
+        self.assertEqual([entry['new_value'] for entry in response.data['results']], ['Description 1', 'Description 3', 'Description 5', 'Description 7'])
+
+        middle = History.objects.get(note=self.note, version=5).created_at
+        response = self.client.get(self.url, {'since': middle.isoformat().replace('+00:00', 'Z')})
+        self.assertEqual([entry['version'] for entry in response.data['results']], [5, 6, 7, 8])
+
+        response = self.client.get(self.url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_history_ndjson_stream(self):
+        response = self.client.get(self.url, {'stream': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        entries = [json.loads(line) for line in lines]
+        self.assertEqual([entry['new_value'] for entry in entries], [f'Description {i}' for i in range(1, 8)])
+
+
+
+class NoteConditionalRequestTestCase(TestCase):
+    """
+        The below code tests ETag based conditional GET and PUT on a note.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.note = Note.objects.create(title='Test Note', description='This is a test note', created_by=self.user, updated_by=self.user)
+        self.url = reverse('get-edit-note', kwargs={'id': self.note.id})
+
+    def test_get_returns_etag_and_304_when_unchanged(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(etag, f'"{self.note.id}-1"')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        self.client.put(self.url, {'description': 'Changed'})
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['description'], 'Changed')
+        self.assertEqual(response['ETag'], f'"{self.note.id}-2"')
+
+    def test_put_with_stale_if_match_is_rejected(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.put(self.url, {'description': 'First'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.put(self.url, {'description': 'Second'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.description, 'First')
+
+    def test_conditional_save_detects_concurrent_write(self):
+        stale = Note.objects.get(pk=self.note.pk)
+        self.note.description = 'Concurrent'
+        self.note.save()
+
+        stale.description = 'Stale'
+        with self.assertRaises(StaleVersionError):
+            stale.save(expected_version=1)
+        self.assertEqual(stale.version, 1)
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.description, 'Concurrent')
+        self.assertEqual(History.objects.filter(note=self.note).count(), 1)
+
+
+
+class NoteCacheTestCase(TransactionTestCase):
+    """
+        The below code tests the read-through note cache and that it never serves a stale note or ACL.
+        It runs outside of a test transaction because notes read inside one are not cached.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(username='owner', password='password123', email='owner@example.com')
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.note = Note.objects.create(title='Test Note', description='This is a test note', created_by=self.owner, updated_by=self.owner)
+        self.url = reverse('get-edit-note', kwargs={'id': self.note.id})
+        self.cache = get_note_cache()
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+
+    def get_as(self, user):
+        self.client.force_authenticate(user=user)
+        return self.client.get(self.url)
+
+    def test_second_read_is_served_from_cache(self):
+        self.get_as(self.owner)
+        with self.assertNumQueries(0):
+            response = self.get_as(self.owner)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['title'], 'Test Note')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_sparse_fields_are_served_from_the_full_entry(self):
+        self.client.force_authenticate(user=self.owner)
+        self.client.get(self.url, {'fields': 'title'})
+        # Partial representations are not cached
+        self.assertIsNone(self.cache.get(self.note.id))
+        self.get_as(self.owner)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'fields': 'description'})
+        self.assertEqual(response.data, {'description': 'This is a test note'})
+
+    def test_never_serves_stale_acl(self):
+        self.assertEqual(self.get_as(self.owner).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_as(self.user).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.post(reverse('note-share'), {'note_id': self.note.id, 'users': [self.user.id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_as(self.user).status_code, status.HTTP_200_OK)
+
+        self.user.accessible_notes.remove(self.note)
+        self.assertEqual(self.get_as(self.user).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.note.accessible_users.add(self.user)
+        self.get_as(self.user)
+        self.note.accessible_users.clear()
+        self.assertEqual(self.get_as(self.user).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_save_and_delete_invalidate(self):
+        self.get_as(self.owner)
+        self.note.description = 'Changed'
+        self.note.save()
+        response = self.get_as(self.owner)
+        self.assertEqual(response.data['description'], 'Changed')
+        self.assertEqual(response['ETag'], f'"{self.note.id}-2"')
+
+        self.note.delete()
+        self.assertEqual(self.get_as(self.owner).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_batch_update_invalidates(self):
+        self.get_as(self.owner)
+        self.client.post(reverse('note-batch'), {'operations': [{'op': 'update', 'id': self.note.id, 'title': 'Batched'}]}, format='json')
+        self.assertEqual(self.get_as(self.owner).data['title'], 'Batched')
+
+    @override_settings(NOTES_CACHE={'BACKEND': 'notes.cache.DjangoCacheBackend', 'OPTIONS': {'alias': 'default'}})
+    def test_django_cache_backend(self):
+        cache = get_note_cache()
+        self.addCleanup(cache.clear)
+        self.get_as(self.owner)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_as(self.owner).status_code, status.HTTP_200_OK)
+        self.note.accessible_users.add(self.user)
+        self.assertEqual(self.get_as(self.user).status_code, status.HTTP_200_OK)
+
+
+    def test_note_loaded_before_an_invalidation_is_not_served(self):
+        other = Note.objects.create(title='Other', description='Other note', created_by=self.owner, updated_by=self.owner)
+        for backend in (LRUCacheBackend(), DjangoCacheBackend()):
+            cache = NoteCache(backend)
+            self.addCleanup(cache.clear)
+            cache.set(other, {'title': 'Other'}, cache.epoch(other.pk))
+            epoch = cache.epoch(self.note.pk)
+            # The invalidation lands after the last epoch check of the reader
+            with mock.patch.object(backend, 'epoch', return_value=epoch):
+                cache.invalidate(self.note.pk)
+                cache.set(self.note, {'title': 'Stale'}, epoch)
+            self.assertIsNone(cache.get(self.note.pk))
+            self.assertEqual(cache.get(other.pk).data, {'title': 'Other'})
+
+class NoteBulkShareViewTestCase(TestCase):
+    """
+        The below code tests sharing and unsharing many notes with many users in one request.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.notes = Note.objects.bulk_create([
+            Note(title=f'Note {i}', description='Body', created_by=self.user, updated_by=self.user)
+            for i in range(3)
+        ])
+        self.users = User.objects.bulk_create([
+            User(username=f'user{i}', email=f'user{i}@example.com') for i in range(300)
+        ])
+        self.url = reverse('note-bulk-share')
+        self.through = Note.accessible_users.through
+
+    def test_bulk_share_and_unshare(self):
+        data = {'note_ids': [note.id for note in self.notes], 'user_ids': [user.id for user in self.users]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Including the read of the existing pairs and the change feed rows of the 900 shares
+        self.assertLess(len(queries), 13)
+        self.assertEqual(self.through.objects.filter(note__in=self.notes).count(), 900)
+
+        # Sharing again is a no-op instead of an integrity error
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        data = {'action': 'unshare', 'note_ids': [self.notes[0].id], 'user_ids': [user.id for user in self.users[:100]]}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.through.objects.filter(note=self.notes[0]).count(), 200)
+
+    def test_unshare_records_only_the_removed_pairs(self):
+        self.through.objects.create(note=self.notes[0], user=self.users[0])
+        data = {'action': 'unshare', 'note_ids': [note.id for note in self.notes], 'user_ids': [self.users[0].id, self.users[1].id]}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(self.through.objects.exists())
+        self.assertEqual(
+            list(NoteChange.objects.filter(action=NoteChange.UNSHARE).values_list('note_id', 'user_id')),
+            [(self.notes[0].id, self.users[0].id)],
+        )
+
+    def test_share_records_only_the_inserted_pairs(self):
+        self.through.objects.create(note=self.notes[0], user=self.users[0])
+        data = {'note_ids': [self.notes[0].id, self.notes[1].id], 'user_ids': [self.users[0].id, self.users[1].id]}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.through.objects.count(), 4)
+        self.assertEqual(
+            list(NoteChange.objects.filter(action=NoteChange.SHARE).order_by('seq').values_list('note_id', 'user_id')),
+            [(self.notes[0].id, self.users[1].id), (self.notes[1].id, self.users[0].id), (self.notes[1].id, self.users[1].id)],
+        )
+
+        # Sharing again records nothing
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(NoteChange.objects.filter(action=NoteChange.SHARE).count(), 3)
+
+    def test_bulk_share_requires_ownership_of_every_note(self):
+        other = User.objects.create_user(username='otheruser', password='password123', email='otheruser@example.com')
+        foreign = Note.objects.create(title='Foreign', description='Body', created_by=other, updated_by=other)
+        data = {'note_ids': [self.notes[0].id, foreign.id], 'user_ids': [self.users[0].id]}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data['note_ids'], [foreign.id])
+        self.assertFalse(self.through.objects.exists())
+
+    def test_bulk_share_rejects_unknown_users(self):
+        data = {'note_ids': [self.notes[0].id], 'user_ids': [self.users[0].id, 0]}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_share_view_validates_users_in_one_query_and_checks_owner(self):
+        data = {'note_id': self.notes[0].id, 'users': [user.id for user in self.users]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('note-share'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertLess(len(queries), 10)
+
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.post(reverse('note-share'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class SeedLoadDataCommandTestCase(TestCase):
+    """
+        The below code tests the synthetic data generator used for load testing.
+    """
+    def seed(self, **options):
+        call_command('seed_load_data', users=6, notes_per_user=3, share_fanout=2, edits_per_note=4, seed=7, stdout=StringIO(), **options)
+
+    def test_seed_creates_consistent_dataset(self):
+        self.seed()
+        users = User.objects.filter(username__startswith='load7_')
+        self.assertEqual(users.count(), 6)
+        self.assertEqual(len(set(users.values_list('password', flat=True))), 1)
+        self.assertTrue(users.first().check_password('Test@1234'))
+
+        notes = Note.objects.filter(created_by__in=users)
+        self.assertEqual(notes.count(), 18)
+        self.assertEqual(Note.accessible_users.through.objects.filter(note__in=notes).count(), 36)
+        self.assertFalse(Note.accessible_users.through.objects.filter(note__in=notes, user=models.F('note__created_by')).exists())
+
+        note = notes.first()
+        entries = decode_history(note, list(History.objects.filter(note=note).order_by('version')))
+        self.assertEqual([entry.version for entry in entries], [2, 3, 4, 5])
+        self.assertEqual(entries[-1].new_value, note.description)
+        for previous, entry in zip(entries, entries[1:]):
+            self.assertEqual(previous.new_value, entry.old_value)
+
+    def test_seed_is_deterministic_across_processes(self):
+        self.seed(processes=2, prefix='multi')
+        self.seed(prefix='single')
+        multi = list(Note.objects.filter(created_by__username__startswith='multi').order_by('id').values_list('title', 'description'))
+        single = list(Note.objects.filter(created_by__username__startswith='single').order_by('id').values_list('title', 'description'))
+        self.assertEqual(multi, single)
+
+
+@override_settings(ALLOWED_HOSTS=['127.0.0.1'])
+class EndpointBenchmarkTestCase(TransactionTestCase):
+    """
+        The below code tests the in-process endpoint load benchmark.
+    """
+    def test_every_route_has_a_scenario(self):
+        self.assertIn('notes:create-user', benchmarking.route_names())
+        self.assertIn('users:create-user', benchmarking.route_names())
+        self.assertEqual(benchmarking.uncovered_routes(), [])
+
+    def test_summarize_and_compare(self):
+        results = [(index / 1000, 200) for index in range(1, 101)] + [(0.5, 500)]
+        summary = benchmarking.summarize(results, 2.0, 202, (200,))
+        self.assertEqual(summary['requests'], 101)
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(summary['p50_ms'], 51.0)
+        self.assertEqual(summary['p99_ms'], 100.0)
+        self.assertEqual(summary['queries_per_request'], 2.0)
+
+        baseline = {'endpoints': {'note-list': summary}}
+        self.assertEqual(benchmarking.compare(baseline, baseline, 0.1), [])
+        slower = {'endpoints': {'note-list': dict(summary, p95_ms=summary['p95_ms'] * 2, queries_per_request=3.0)}}
+        regressions = benchmarking.compare(slower, baseline, 0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('note-list: p95'))
+
+    def test_run_benchmark_through_both_interfaces(self):
+        dataset = benchmarking.Dataset(SeedOptions(users=4, notes_per_user=2, share_fanout=1, edits_per_note=2, prefix='bench'))
+        scenarios = {scenario.name: scenario for scenario in benchmarking.SCENARIOS}
+        for driver in benchmarking.DRIVERS.values():
+            with self.subTest(driver=driver.name):
+                report = benchmarking.run_benchmark(driver(2), dataset, 3, 1, [scenarios['note-retrieve'], scenarios['note-list']])
+                self.assertEqual(report['note-retrieve']['requests'], 3)
+                self.assertEqual(report['note-retrieve']['errors'], 0)
+                self.assertGreater(report['note-list']['queries_per_request'], 0)
+
+        # Every note was shared once, so only 8 notes can be deleted
+        report = benchmarking.run_benchmark(benchmarking.WSGIDriver(1), dataset, 20, 1, [scenarios['note-delete']])
+        self.assertEqual(report['note-delete']['requests'], 8)
+        self.assertEqual(report['note-delete']['errors'], 0)
+
+    def test_concurrent_writes_on_the_default_backend(self):
+        scenarios = {scenario.name: scenario for scenario in benchmarking.SCENARIOS}
+        names = ['note-batch', 'note-share', 'async-note-share', 'note-bulk-share']
+        with benchmarking.temporary_database():
+            self.assertEqual(connection.settings_dict['ENGINE'], 'django.db.backends.sqlite3')
+            dataset = benchmarking.Dataset(SeedOptions(users=20, notes_per_user=5, share_fanout=1, edits_per_note=1, prefix='bench'))
+            report = benchmarking.run_benchmark(benchmarking.WSGIDriver(4), dataset, 40, 1, [scenarios[name] for name in names])
+        self.assertEqual({name: report[name]['errors'] for name in names}, dict.fromkeys(names, 0))
+        self.assertEqual(Note.objects.count(), 0)
+
+
+@override_settings(
+    MIDDLEWARE=['notes_management.middleware.SQLInstrumentationMiddleware', *settings.MIDDLEWARE],
+    SQL_INSTRUMENTATION={'ENABLED': True, 'SLOW_REQUEST_MS': 10000, 'MAX_QUERIES': 50, 'DUPLICATE_THRESHOLD': 3},
+)
+class SQLInstrumentationMiddlewareTestCase(TestCase):
+    """
+        The below code tests the per-request SQL instrumentation middleware.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+        self.note = Note.objects.create(title='Note', description='Text', created_by=self.user, updated_by=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql('SELECT  "id" FROM "notes_note"\n WHERE "id" IN (%s, %s, %s) AND "title" = \'a\' LIMIT 21'),
+            'SELECT "id" FROM "notes_note" WHERE "id" IN (...) AND "title" = ? LIMIT ?',
+        )
+        self.assertEqual(normalize_sql('WHERE "id" IN (%s)'), normalize_sql('WHERE "id" IN (%s, %s)'))
+
+    def test_server_timing_header(self):
+        with self.assertNoLogs('notes_management.sql'):
+            response = self.client.get(reverse('get-edit-note', kwargs={'id': self.note.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+$')
+
+    @override_settings(SQL_INSTRUMENTATION={'MAX_QUERIES': 0})
+    def test_logs_requests_over_query_threshold(self):
+        with self.assertLogs('notes_management.sql', 'WARNING') as logs:
+            self.client.get(reverse('get-edit-note', kwargs={'id': self.note.id}))
+        self.assertIn(f'GET /notes/{self.note.id}/ -> 200', logs.output[0])
+        self.assertIn('FROM "notes_note"', logs.output[0])
+
+    def test_detects_repeated_queries(self):
+        def get_response(request):
+            for note_id in (self.note.id, self.note.id, self.note.id):
+                Note.objects.filter(pk=note_id).first()
+            return HttpResponse()
+
+        middleware = SQLInstrumentationMiddleware(get_response)
+        with self.assertLogs('notes_management.sql', 'WARNING') as logs:
+            response = middleware(RequestFactory().get('/notes/'))
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+        self.assertIn('[N+1?]', logs.output[0])
+        self.assertEqual(len(logs.records[0].duplicates), 1)
+
+
+class AsyncNoteViewsTestCase(TransactionTestCase):
+    """
+        The below code tests the async note views. The synchronous parts run in a thread pool with
+        their own database connections, so the data has to be committed.
+    """
+    def setUp(self):
+        get_note_cache().clear()
+        token_cache.clear()
+        user_cache.clear()
+        self.owner = User.objects.create_user(username='owner', password='password123', email='owner@example.com')
+        self.shared_user = User.objects.create_user(username='shared', password='password123', email='shared@example.com')
+        self.stranger = User.objects.create_user(username='stranger', password='password123', email='stranger@example.com')
+        self.note = Note.objects.create(title='Title', description='First', created_by=self.owner, updated_by=self.owner)
+        self.note.accessible_users.add(self.shared_user)
+
+    def headers(self, user, **headers):
+        return {'Authorization': f'Bearer {AccessToken.for_user(user)}', **headers}
+
+    async def test_retrieve_matches_sync_view(self):
+        url = reverse('async-get-edit-note', kwargs={'id': self.note.id})
+        response = await self.async_client.get(url, headers=self.headers(self.shared_user))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'title': 'Title', 'description': 'First'})
+        self.assertEqual(response['ETag'], f'"{self.note.id}-1"')
+
+        # Served from the note cache, then as a conditional read
+        response = await self.async_client.get(url, headers=self.headers(self.owner))
+        self.assertEqual(response.json(), {'title': 'Title', 'description': 'First'})
+        self.assertEqual(get_note_cache().stats()['hits'], 1)
+        response = await self.async_client.get(url, headers=self.headers(self.owner, if_none_match=response['ETag']))
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    async def test_authentication_and_permissions(self):
+        url = reverse('async-get-edit-note', kwargs={'id': self.note.id})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+        response = await self.async_client.get(url, headers=self.headers(self.stranger))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = await self.async_client.get(reverse('async-get-edit-note', kwargs={'id': 0}), headers=self.headers(self.owner))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = await self.async_client.delete(url, headers=self.headers(self.owner))
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    async def test_create_and_update(self):
+        response = await self.async_client.post(
+            reverse('async-create-note'), {'title': 'New', 'description': 'Body'},
+            content_type='application/json', headers=self.headers(self.owner),
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(await Note.objects.filter(title='New', created_by=self.owner).aexists())
+
+        url = reverse('async-get-edit-note', kwargs={'id': self.note.id})
+        response = await self.async_client.put(
+            url, {'description': 'Second'}, content_type='application/json',
+            headers=self.headers(self.shared_user, if_match=f'"{self.note.id}-1"'),
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['ETag'], f'"{self.note.id}-2"')
+        response = await self.async_client.put(
+            url, {'description': 'Third'}, content_type='application/json',
+            headers=self.headers(self.owner, if_match=f'"{self.note.id}-1"'),
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        note = await Note.objects.aget(pk=self.note.id)
+        self.assertEqual((note.description, note.version), ('Second', 2))
+
+    async def test_patch(self):
+        url = reverse('async-get-edit-note', kwargs={'id': self.note.id})
+        response = await self.async_client.patch(
+            url, {'base_version': 1, 'patch': [5, ' and second']}, content_type='application/json',
+            headers=self.headers(self.shared_user),
+        )
+        self.assertEqual((response.status_code, response.json()), (status.HTTP_200_OK, {'version': 2}))
+        self.assertEqual(response['ETag'], f'"{self.note.id}-2"')
+        response = await self.async_client.patch(
+            url, {'base_version': 1, 'patch': [5, '!']}, content_type='application/json',
+            headers=self.headers(self.owner),
+        )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.json()['version'], 2)
+        note = await Note.objects.aget(pk=self.note.id)
+        self.assertEqual((note.description, note.version), ('First and second', 2))
+
+    async def test_share(self):
+        response = await self.async_client.post(
+            reverse('async-note-share'), {'note_id': self.note.id, 'users': [self.stranger.id]},
+            content_type='application/json', headers=self.headers(self.owner),
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(await self.note.accessible_users.filter(pk=self.stranger.pk).aexists())
+
+        response = await self.async_client.post(
+            reverse('async-note-share'), {'note_id': self.note.id, 'users': [self.owner.id]},
+            content_type='application/json', headers=self.headers(self.shared_user),
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = await self.async_client.post(
+            reverse('async-note-share'), {'note_id': self.note.id, 'users': [0]},
+            content_type='application/json', headers=self.headers(self.owner),
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_history_matches_sync_view(self):
+        for i in range(2, 6):
+            self.note.description = f'Description {i}'
+            self.note.save()
+        client = APIClient()
+        client.force_authenticate(user=self.shared_user)
+        expected = client.get(reverse('get-history', kwargs={'id': self.note.id}), {'page_size': 2})
+
+        url = reverse('async-get-history', kwargs={'id': self.note.id})
+        response = async_to_sync(self.async_client.get)(url, {'page_size': 2}, headers=self.headers(self.shared_user))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['results'], json.loads(json.dumps(expected.data['results'])))
+        self.assertIn('/notes/async/version-history/', response.json()['next'])
+
+        async def stream():
+            response = await self.async_client.get(url, {'stream': 'ndjson'}, headers=self.headers(self.shared_user))
+            return response, b''.join([chunk async for chunk in response.streaming_content])
+
+        response, content = async_to_sync(stream)()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([line['new_value'] for line in lines], [f'Description {i}' for i in range(2, 6)])
+
+    def test_sparse_fields(self):
+        self.note.description = 'Second'
+        self.note.save()
+        get = async_to_sync(self.async_client.get)
+        url = reverse('async-get-edit-note', kwargs={'id': self.note.id})
+        response = get(url, {'fields': 'title'}, headers=self.headers(self.owner))
+        self.assertEqual(response.json(), {'title': 'Title'})
+        response = get(url, {'fields': 'nope'}, headers=self.headers(self.owner))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        url = reverse('async-get-history', kwargs={'id': self.note.id})
+        response = get(url, {'fields': 'version'}, headers=self.headers(self.owner))
+        self.assertEqual(response.json()['results'], [{'version': 2}])
+        response = get(url, {'fields': 'version,old_value'}, headers=self.headers(self.owner))
+        self.assertEqual(response.json()['results'], [{'old_value': 'First', 'version': 2}])
+
+    def test_every_async_route_is_benchmarked(self):
+        self.assertIn('notes:async-get-edit-note', benchmarking.route_names())
+        self.assertEqual(benchmarking.uncovered_routes(), [])
+
+
+class SQLiteProductionModeTestCase(TestCase):
+    """
+        The below code tests the SQLite production mode backend: connection pragmas and the writer queue.
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.settings_dict = {
+            **connection.settings_dict,
+            'ENGINE': 'notes_management.sqlite',
+            'NAME': os.path.join(self.directory.name, 'production.sqlite3'),
+            'OPTIONS': {'timeout': 0.2},
+        }
+
+    def connect(self):
+        wrapper = sqlite_backend.DatabaseWrapper(dict(self.settings_dict), alias='production-test')
+        wrapper.ensure_connection()
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_connection_pragmas(self):
+        wrapper = self.connect()
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)
+        self.assertEqual(self.pragma(wrapper, 'busy_timeout'), 20000)
+        self.assertEqual(self.pragma(wrapper, 'cache_size'), -64 * 1024)
+
+    def test_writes_wait_for_the_open_write_transaction(self):
+        first = self.connect()
+        with first.cursor() as cursor:
+            cursor.execute('CREATE TABLE item (value INTEGER)')
+        first._start_transaction_under_autocommit()
+        with first.cursor() as cursor:
+            cursor.execute('INSERT INTO item VALUES (1)')
+
+        results = []
+
+        def write():
+            second = sqlite_backend.DatabaseWrapper(dict(self.settings_dict, OPTIONS={'timeout': 5}), alias='production-test')
+            try:
+                with second.cursor() as cursor:
+                    cursor.execute('INSERT INTO item VALUES (2)')
+                    cursor.execute('SELECT value FROM item ORDER BY value')
+                    results.extend(row[0] for row in cursor.fetchall())
+            finally:
+                second.close()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join(0.1)
+        # The second writer waits in the queue instead of failing
+        self.assertTrue(thread.is_alive())
+        first.commit()
+        thread.join()
+        self.assertEqual(results, [1, 2])
+
+    def test_read_transactions_do_not_wait_for_the_writer_queue(self):
+        first = self.connect()
+        with first.cursor() as cursor:
+            cursor.execute('CREATE TABLE item (value INTEGER)')
+        first._start_transaction_under_autocommit()
+        self.assertFalse(first.holds_writer_queue)
+        with first.cursor() as cursor:
+            cursor.execute('INSERT INTO item VALUES (1)')
+        # Taken by the first write, until the transaction ends
+        self.assertTrue(first.holds_writer_queue)
+
+        second = self.connect()
+        second._start_transaction_under_autocommit()
+        with second.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM item')
+            self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertFalse(second.holds_writer_queue)
+        second.commit()
+        first.commit()
+        self.assertFalse(first.holds_writer_queue)
+
+    def test_writer_queue_is_fifo_and_times_out(self):
+        queue = sqlite_backend.WriterQueue()
+        queue.acquire()
+        order = []
+
+        def wait(name):
+            queue.acquire()
+            order.append(name)
+            queue.release()
+
+        threads = []
+        for name in ('first', 'second'):
+            threads.append(threading.Thread(target=wait, args=(name,)))
+            threads[-1].start()
+            time.sleep(0.05)
+        with self.assertRaises(OperationalError):
+            queue.acquire(timeout=0.05)
+        queue.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['first', 'second'])
+        # The abandoned turn is skipped
+        queue.acquire(timeout=1)
+        queue.release()
+
+
+
+class StressSQLiteCommandTestCase(TransactionTestCase):
+    """
+        The below code tests the concurrent SQLite read/write stress command.
+    """
+    def test_production_mode_has_no_lock_errors(self):
+        out = StringIO()
+        call_command('stress_sqlite', mode='production', writers=4, readers=4, seconds=0.5, notes=20, stdout=out)
+        lines = {line.split()[1]: line.split() for line in out.getvalue().splitlines()[1:]}
+        self.assertEqual(sorted(lines), ['read', 'write'])
+        self.assertEqual([lines['read'][-1], lines['write'][-1]], ['0', '0'])
+        self.assertEqual(User.objects.filter(username__startswith='stress').count(), 0)
+
+
+class HistoryWriteBehindTestCase(TransactionTestCase):
+    """
+        The below code tests the write-behind History writer and its spool.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', password='password123')
+        self.note = Note.objects.create(title='Title', description='Version 1', created_by=self.user, updated_by=self.user)
+        self.spool_dir = tempfile.mkdtemp()
+
+    def write_behind(self, **options):
+        return override_settings(NOTES_HISTORY_WRITE_BEHIND={'ENABLED': True, 'SPOOL_DIR': self.spool_dir, **options})
+
+    def test_save_leaves_history_to_the_writer(self):
+        with self.write_behind():
+            with CaptureQueriesContext(connection) as queries:
+                self.note.description = 'Version 2'
+                self.note.save()
+            self.assertFalse([query for query in queries if 'notes_history' in query['sql']])
+            self.assertTrue(get_history_writer().flush())
+            self.assertEqual(note_at_version(self.note, 1)['description'], 'Version 1')
+            self.assertEqual(History.objects.get(note=self.note).version, 2)
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_concurrent_saves_keep_versions_ordered(self):
+        def edit(writer):
+            index = 0
+            while index < 5:
+                try:
+                    note = Note.objects.get(pk=self.note.pk)
+                    note.description = f'{writer} edit {index}'
+                    note.save()
+                except OperationalError:
+                    # The in-memory test database locks whole tables
+                    continue
+                index += 1
+            connection.close()
+
+        with self.write_behind(BATCH_SIZE=3, FLUSH_INTERVAL=0.01):
+            threads = [threading.Thread(target=edit, args=(writer,)) for writer in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wait_for_history()
+
+            self.note.refresh_from_db()
+            self.assertEqual(self.note.version, 21)
+            self.assertEqual(
+                sorted(History.objects.filter(note=self.note).values_list('version', flat=True)),
+                list(range(2, 22)),
+            )
+            states = [note_at_version(self.note, version)['description'] for version in range(1, 22)]
+        self.assertEqual(states[0], 'Version 1')
+        self.assertEqual(states[-1], self.note.description)
+
+    def test_spool_is_replayed_once(self):
+        self.note.description = 'Version 2'
+        self.note.save()
+        written = history_row(History.objects.get(note=self.note))
+        # Left by a writer that is gone
+        os.makedirs(os.path.join(self.spool_dir, '1-gone'))
+        with open(os.path.join(self.spool_dir, '1-gone', '000000000001.jsonl'), 'w') as spool:
+            spool.write(json.dumps(written) + '\n')
+            spool.write(json.dumps({**written, 'version': 3, 'encoding': History.FULL, 'delta': ''}) + '\n')
+            spool.write('{"note_id": ')
+        live = Spool(os.path.join(self.spool_dir, '2-live'))
+        self.assertTrue(live.claim())
+        live.append([{**written, 'version': 4, 'encoding': History.FULL, 'delta': ''}])
+
+        out = StringIO()
+        call_command('replay_history_spool', spool_dir=self.spool_dir, stdout=out)
+        self.assertIn('Replayed 2 History rows', out.getvalue())
+        self.assertEqual(list(History.objects.filter(note=self.note).values_list('version', flat=True).order_by('version')), [2, 3])
+        self.assertEqual(sorted(os.listdir(self.spool_dir)), ['2-live', '2-live.lock'])
+
+        live.close()
+        live.release()
+        call_command('replay_history_spool', spool_dir=self.spool_dir, stdout=out)
+        self.assertEqual(list(History.objects.filter(note=self.note).values_list('version', flat=True).order_by('version')), [2, 3, 4])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_writer_advances_the_history_version(self):
+        with self.write_behind():
+            self.note.description = 'Version 2'
+            self.note.save()
+            self.assertTrue(get_history_writer().flush())
+            note = Note.objects.get(pk=self.note.pk)
+            self.assertEqual(note.history_version, 2)
+            with self.assertNumQueries(0):
+                check_history_written(note)
+
+        # A save of a note read before the watermark moved leaves it alone
+        Note.objects.filter(pk=self.note.pk).update(history_version=5)
+        note.title = 'Renamed'
+        note.save()
+        self.assertEqual(Note.objects.get(pk=self.note.pk).history_version, 5)
+
+    def test_writer_replays_outside_of_the_transaction_starting_it(self):
+        row = {**history_row(self.note.build_history('title', 'Title', 'Renamed')), 'version': 2}
+        os.makedirs(os.path.join(self.spool_dir, '1-gone'))
+        with open(os.path.join(self.spool_dir, '1-gone', '000000000001.jsonl'), 'w') as spool:
+            spool.write(json.dumps(row) + '\n')
+        with self.write_behind():
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    writer = get_history_writer()
+                    raise ValueError('rolled back')
+            self.assertTrue(writer.flush())
+        self.assertEqual(list(History.objects.filter(note=self.note).values_list('field', 'version')), [('title', 2)])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_writers_spool_to_their_own_directory(self):
+        with self.write_behind():
+            writer = get_history_writer()
+            self.note.description = 'Version 2'
+            self.note.save()
+            name = os.path.basename(writer.spool.directory)
+            self.assertEqual(sorted(os.listdir(self.spool_dir)), [name, f'{name}.lock'])
+            # Another process starting does not take the spool of a running writer
+            call_command('replay_history_spool', spool_dir=self.spool_dir, stdout=StringIO())
+            self.assertTrue(os.path.isdir(writer.spool.directory))
+            self.assertFalse(Spool(writer.spool.directory).claim())
+            self.assertTrue(writer.flush())
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_rows_keep_the_time_of_their_save(self):
+        with self.write_behind():
+            writer = get_history_writer()
+            write = writer.write
+            inserted = []
+
+            def late_write(batch, **kwargs):
+                time.sleep(0.1)
+                inserted.append(timezone.now())
+                write(batch, **kwargs)
+
+            with mock.patch.object(writer, 'write', late_write):
+                saved = timezone.now()
+                self.note.description = 'Version 2'
+                self.note.save()
+                self.assertTrue(writer.flush())
+        entry = History.objects.get(note=self.note)
+        self.assertLessEqual(saved, entry.created_at)
+        self.assertLess(entry.created_at, inserted[0])
+
+        # And so do the rows replayed from a spool
+        row = {**history_row(entry), 'version': 3, 'created_at': (saved - timedelta(hours=1)).isoformat()}
+        os.makedirs(os.path.join(self.spool_dir, '1-gone'))
+        with open(os.path.join(self.spool_dir, '1-gone', '000000000001.jsonl'), 'w') as spool:
+            spool.write(json.dumps(row) + '\n')
+        call_command('replay_history_spool', spool_dir=self.spool_dir, stdout=StringIO())
+        self.assertEqual(History.objects.get(note=self.note, version=3).created_at, saved - timedelta(hours=1))
+
+    def test_synchronous_errors_are_logged(self):
+        with mock.patch.object(Note, 'build_history', side_effect=ValueError('broken')):
+            with self.assertLogs('notes.history', 'ERROR'):
+                self.note.description = 'Version 2'
+                self.note.save()
+        self.assertEqual(Note.objects.get(pk=self.note.pk).version, 2)
+
+
+@override_settings(NOTES_HISTORY_SNAPSHOT_INTERVAL=5)
+class NoteAsOfViewTestCase(TestCase):
+    """
+        The below code tests reading a note as of a version or a timestamp.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.note = Note.objects.create(title='Title 1', description='Description 1', created_by=self.user, updated_by=self.user)
+        self.created = timezone.now() - timedelta(days=1)
+        Note.objects.filter(pk=self.note.pk).update(created_at=self.created)
+        self.note.refresh_from_db()
+        self.states = {1: ('Title 1', 'Description 1')}
+        for version in range(2, 13):
+            if version % 3 == 0:
+                self.note.title = f'Title {version}'
+            self.note.description = f'Description {version} ' + 'body ' * version
+            self.note.save()
+            self.states[version] = (self.note.title, self.note.description)
+            # One version per minute after creation
+            History.objects.filter(note=self.note, version=version).update(created_at=self.created + timedelta(minutes=version))
+        self.url = reverse('note-as-of', kwargs={'id': self.note.id})
+
+    def test_as_of_version(self):
+        for version, (title, description) in self.states.items():
+            response = self.client.get(self.url, {'version': version})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                response.data,
+                {'id': self.note.id, 'version': version, 'title': title, 'description': description},
+            )
+            self.assertEqual(response['ETag'], f'"{self.note.id}-{version}"')
+
+    def test_as_of_timestamp(self):
+        response = self.client.get(self.url, {'timestamp': (self.created + timedelta(minutes=7, seconds=30)).isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['version'], response.data['description']), (7, self.states[7][1]))
+
+        response = self.client.get(self.url, {'timestamp': (self.created + timedelta(seconds=30)).isoformat()})
+        self.assertEqual((response.data['version'], response.data['title']), (1, 'Title 1'))
+
+        response = self.client.get(self.url, {'timestamp': (self.created - timedelta(seconds=1)).isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(self.url, {'version': 2, 'timestamp': self.created.isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {'version': 13}).status_code, status.HTTP_404_NOT_FOUND)
+
+        self.client.force_authenticate(user=User.objects.create_user(username='stranger', password='password123'))
+        self.assertEqual(self.client.get(self.url, {'version': 2}).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_lookups_use_the_snapshot_and_created_indexes(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, {'timestamp': (self.created + timedelta(minutes=3)).isoformat()})
+        plans = []
+        for query in queries:
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN QUERY PLAN {query['sql']}")
+                plans.append(' '.join(str(row) for row in cursor.fetchall()))
+        self.assertTrue(any('history_note_created_idx' in plan for plan in plans))
+        self.assertTrue(any('history_snapshot_idx' in plan for plan in plans))
+
+    def test_history_not_written_yet(self):
+        # As another process sees a note whose rows are still pending
+        History.objects.filter(note=self.note, version=12).delete()
+        with override_settings(NOTES_HISTORY_WRITE_BEHIND={'ENABLED': True}):
+            response = self.client.get(self.url, {'version': 3})
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response['Retry-After'], '1')
+            response = self.client.get(reverse('get-history', kwargs={'id': self.note.id}))
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            # Values are not needed to list the versions
+            response = self.client.get(reverse('get-history', kwargs={'id': self.note.id}), {'fields': 'version,updated_by'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            record, = export_records(self.user, include_history=True)
+        history = {(entry['version'], entry['field']): entry for entry in record['history']}
+        # Decoded from the snapshot of version 10 down, left encoded above it
+        self.assertEqual(history[(11, 'description')]['old_value'], '')
+        for version in range(2, 11):
+            self.assertEqual(history[(version, 'description')]['old_value'], self.states[version - 1][1])
+            self.assertEqual(history[(version, 'description')]['new_value'], self.states[version][1])
+
+    def test_history_version_catches_up_with_rows_written_directly(self):
+        # Saved without write-behind, which leaves the watermark behind
+        self.assertEqual(self.note.history_version, 1)
+        with override_settings(NOTES_HISTORY_WRITE_BEHIND={'ENABLED': True}):
+            check_history_written(self.note)
+            note = Note.objects.get(pk=self.note.pk)
+            self.assertEqual(note.history_version, 12)
+            with self.assertNumQueries(0):
+                check_history_written(note)
+
+
+class NoteSoftDeleteTestCase(TestCase):
+    """
+        The below code tests that deleting tombstones notes and that the purge command removes them in chunks.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(username='owner', password='password123', email='owner@example.com')
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.notes = []
+        for i in range(3):
+            note = Note.objects.create(title=f'Note {i}', description='Version 1', created_by=self.owner, updated_by=self.owner)
+            note.accessible_users.add(self.owner, self.user)
+            for version in range(2, 5):
+                note.description = f'Version {version}'
+                note.save()
+            self.notes.append(note)
+
+    def test_delete_tombstones_the_note(self):
+        note = self.notes[0]
+        self.client.force_authenticate(user=self.user)
+        self.client.get(reverse('get-edit-note', kwargs={'id': note.id}))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(reverse('get-edit-note', kwargs={'id': note.id}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse([query for query in queries if query['sql'].startswith('DELETE')])
+
+        self.assertFalse(Note.objects.filter(pk=note.id).exists())
+        self.assertIsNotNone(Note.all_objects.get(pk=note.id).deleted_at)
+        self.assertEqual(History.objects.filter(note_id=note.id).count(), 3)
+        self.assertEqual(self.user.accessible_notes.count(), 2)
+        for name in ('get-edit-note', 'get-history'):
+            response = self.client.get(reverse(name, kwargs={'id': note.id}))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(self.client.get(reverse('list-notes')).data['results']), 2)
+
+    def test_batch_delete_tombstones_the_note(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(
+            reverse('note-batch'), {'operations': [{'op': 'delete', 'id': self.notes[1].id}]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(Note.objects.filter(pk=self.notes[1].id).exists())
+        self.assertTrue(Note.all_objects.filter(pk=self.notes[1].id).exists())
+
+    def test_purge_removes_deleted_notes_in_chunks(self):
+        kept = self.notes[2]
+        for note in self.notes[:2]:
+            note.delete()
+
+        out = StringIO()
+        call_command('purge_deleted_notes', older_than=60, stdout=out)
+        self.assertIn('Purged 0 notes', out.getvalue())
+        self.assertEqual(Note.all_objects.count(), 3)
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('purge_deleted_notes', chunk_size=1, batch_size=2, json=True, stdout=out)
+        metrics = json.loads(out.getvalue())
+        self.assertEqual(
+            {key: metrics[key] for key in ('notes', 'history', 'shares', 'chunks')},
+            {'notes': 2, 'history': 6, 'shares': 4, 'chunks': 2},
+        )
+        self.assertIn('rows_per_second', metrics)
+        history_deletes = [query for query in queries if query['sql'].startswith('DELETE FROM "notes_history" WHERE "notes_history"."id" IN')]
+        self.assertEqual(len(history_deletes), 4)
+
+        self.assertEqual(list(Note.all_objects.values_list('pk', flat=True)), [kept.pk])
+        self.assertEqual(set(History.objects.values_list('note_id', flat=True)), {kept.pk})
+        self.assertEqual(set(Note.accessible_users.through.objects.values_list('note_id', flat=True)), {kept.pk})
+
+
+class NoteExportViewTestCase(TestCase):
+    """
+        The below code tests streaming the notes of a user in every export format.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.other = User.objects.create_user(username='other', password='password123', email='other@example.com')
+        self.user.user_permissions.add(Permission.objects.get(codename='download_Note'))
+        self.client.force_authenticate(user=self.user)
+        self.notes = []
+        for i in range(5):
+            note = Note.objects.create(title=f'Note {i}', description='Version 1', created_by=self.user, updated_by=self.user)
+            for version in range(2, 4):
+                note.description = f'Version {version}, "quoted"\nline'
+                note.save()
+            self.notes.append(note)
+        shared = Note.objects.create(title='Shared', description='Shared note', created_by=self.other, updated_by=self.other)
+        shared.accessible_users.add(self.user)
+        self.notes.append(shared)
+        Note.objects.create(title='Private', description='Not exported', created_by=self.other, updated_by=self.other)
+        self.notes[1].delete()
+        self.url = reverse('note-export')
+
+    def read(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def test_requires_download_permission(self):
+        self.client.force_authenticate(user=self.other)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_ndjson_with_history(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url, {'history': 'true', 'output': 'ndjson'})
+            records = [json.loads(line) for line in self.read(response).decode().splitlines()]
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        expected = [note.pk for note in self.notes if note.pk != self.notes[1].pk]
+        self.assertEqual([record['id'] for record in records], expected)
+        history = records[0]['history']
+        self.assertEqual([entry['version'] for entry in history], [2, 3])
+        self.assertEqual(history[0]['old_value'], 'Version 1')
+        self.assertEqual(history[1]['new_value'], records[0]['description'])
+        self.assertEqual(history[1]['old_value'], history[0]['new_value'])
+
+    def test_resume_after_cursor(self):
+        response = self.client.get(self.url, {'after': self.notes[2].pk})
+        records = [json.loads(line) for line in self.read(response).decode().splitlines()]
+        self.assertEqual([record['id'] for record in records], [note.pk for note in self.notes[3:]])
+        self.assertNotIn('history', records[0])
+
+    def test_csv(self):
+        response = self.client.get(self.url, {'output': 'csv', 'history': 'true'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="notes.csv"')
+        rows = list(csv.DictReader(StringIO(self.read(response).decode())))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['description'], self.notes[0].description)
+        self.assertEqual(len(json.loads(rows[0]['history'])), 2)
+
+    def test_zip(self):
+        response = self.client.get(self.url, {'output': 'zip'})
+        with zipfile.ZipFile(BytesIO(self.read(response))) as archive:
+            self.assertEqual(archive.namelist(), ['notes.ndjson'])
+            lines = archive.read('notes.ndjson').decode().splitlines()
+        self.assertEqual(json.loads(lines[-1])['title'], 'Shared')
+        self.assertEqual(len(lines), 5)
+
+    def test_memory_does_not_grow_with_the_number_of_notes(self):
+        Note.objects.bulk_create([
+            Note(title=f'Bulk {i}', description='x' * 1000, created_by=self.user, updated_by=self.user)
+            for i in range(3000)
+        ])
+        request = APIRequestFactory().get(self.url)
+        force_authenticate(request, user=self.user)
+        response = NoteExportView.as_view(stream_chunk_size=100)(request)
+        tracemalloc.start()
+        try:
+            # Peak memory over the first 500 notes, then over the next 2400
+            peaks = []
+            for index, _ in enumerate(response.streaming_content):
+                if index in (500, 2900):
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                    tracemalloc.reset_peak()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+
+
+class NoteImportTestCase(TestCase):
+    """
+        The below code tests importing notes from NDJSON and CSV through the endpoint and the command.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.other = User.objects.create_user(username='other', password='password123', email='other@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('note-import')
+
+    def test_ndjson_import_reports_row_errors(self):
+        rows = [
+            json.dumps({'title': 'First', 'description': 'One', 'shared_with': [self.other.pk]}),
+            '{"title": "Broken"',
+            json.dumps({'title': '', 'description': 'No title'}),
+            '',
+            json.dumps({'title': 'Unknown user', 'description': 'Two', 'shared_with': [self.other.pk + 100]}),
+            json.dumps({'title': 'Second', 'description': 'Three'}),
+            json.dumps(['not', 'an', 'object']),
+        ]
+        response = self.client.post(self.url, '\n'.join(rows) + '\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['failed'], response.data['shares']), (2, 4, 1))
+        self.assertEqual([error['line'] for error in response.data['errors']], [2, 3, 5, 7])
+        self.assertIn('title', response.data['errors'][1]['errors'])
+
+        first = Note.objects.get(title='First')
+        self.assertEqual((first.created_by, first.updated_by), (self.user, self.user))
+        self.assertEqual(list(first.accessible_users.all()), [self.other])
+        self.assertTrue(Note.objects.filter(title='Second', description='Three').exists())
+
+    def test_csv_import(self):
+        body = (
+            'title,description,shared_with\n'
+            f'First,"Multi\nline, ""quoted""","{self.other.pk}"\n'
+            f'Second,Plain,"[{self.other.pk}, {self.user.pk}]"\n'
+            'Third,Bad share,abc\n'
+        )
+        # User check, then the notes, shares and change feed INSERTs in a savepoint
+        with self.assertNumQueries(6):
+            response = self.client.post(f'{self.url}?input=csv', body, content_type='text/csv')
+        self.assertEqual((response.data['created'], response.data['failed'], response.data['shares']), (2, 1, 3))
+        self.assertEqual(response.data['errors'][0]['errors'], {'shared_with': ['Expected a list of user ids.']})
+        self.assertEqual(Note.objects.get(title='First').description, 'Multi\nline, "quoted"')
+
+    def test_import_notes_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'notes.ndjson')
+        with open(path, 'w') as source:
+            for i in range(5):
+                source.write(json.dumps({'title': f'Note {i}', 'description': 'Imported', 'created_by': self.other.pk}) + '\n')
+            source.write(json.dumps({'title': 'Orphan', 'description': 'No owner'}) + '\n')
+
+        out = StringIO()
+        call_command('import_notes', path, batch_size=2, stdout=out)
+        self.assertIn('Imported 5 notes and 0 shares', out.getvalue())
+        self.assertIn('1 rows rejected', out.getvalue())
+        self.assertIn('line 6: {"created_by"', out.getvalue())
+        self.assertEqual(Note.objects.filter(created_by=self.other, description='Imported').count(), 5)
+
+        call_command('import_notes', path, owner='testuser', stdout=StringIO())
+        self.assertEqual(Note.objects.filter(created_by=self.user).count(), 6)
+
+
+class CompressedTextFieldTestCase(TestCase):
+    """The below code tests the compressed storage of descriptions and History values"""
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='Test@1234', email='test@gmail.com')
+        self.long_text = ' '.join(f'line {i} of a long meeting note' for i in range(200))
+
+    def stored(self, table, column, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {column} FROM {table} WHERE id = %s', [pk])
+            return cursor.fetchone()[0]
+
+    def test_long_values_are_stored_compressed(self):
+        note = Note.objects.create(title='Long', description=self.long_text, created_by=self.user, updated_by=self.user)
+        short = Note.objects.create(title='Short', description='Short text', created_by=self.user, updated_by=self.user)
+
+        stored = self.stored('notes_note', 'description', note.pk)
+        self.assertTrue(stored.startswith(MARKER))
+        self.assertLess(len(stored), len(self.long_text) / 2)
+        self.assertEqual(self.stored('notes_note', 'description', short.pk), 'Short text')
+        self.assertEqual(Note.objects.get(pk=note.pk).description, self.long_text)
+        self.assertEqual(Note.objects.values_list('description', flat=True).get(pk=note.pk), self.long_text)
+
+        # Snapshot rows keep the full texts, compressed like the note
+        note.description = self.long_text + ' and one more line'
+        with override_settings(NOTES_HISTORY_SNAPSHOT_INTERVAL=1):
+            note.save()
+        entry = History.objects.get(note=note, field='description')
+        for column in ('old_value', 'new_value', 'activity'):
+            self.assertTrue(self.stored('notes_history', column, entry.pk).startswith(MARKER))
+        self.assertEqual((entry.old_value, entry.new_value), (self.long_text, note.description))
+
+        Note.objects.filter(pk=short.pk).update(description=self.long_text)
+        self.assertTrue(self.stored('notes_note', 'description', short.pk).startswith(MARKER))
+
+    def test_plain_and_marker_values_round_trip(self):
+        marked = MARKER + 'not compressed'
+        note = Note.objects.create(title='Marked', description=marked, created_by=self.user, updated_by=self.user)
+        self.assertEqual(Note.objects.get(pk=note.pk).description, marked)
+        # Incompressible text stays plain
+        noise = ''.join(chr(0x4e00 + (i * 7919) % 20000) for i in range(2000))
+        self.assertEqual(compress(noise, threshold=10), noise)
+
+        with override_settings(NOTES_COMPRESSION_THRESHOLD=None):
+            plain = Note.objects.create(title='Plain', description=self.long_text, created_by=self.user, updated_by=self.user)
+        self.assertEqual(self.stored('notes_note', 'description', plain.pk), self.long_text)
+        self.assertEqual(Note.objects.get(pk=plain.pk).description, self.long_text)
+
+    def test_compress_existing_rows(self):
+        with override_settings(NOTES_COMPRESSION_THRESHOLD=None):
+            notes = [
+                Note.objects.create(title=f'Note {i}', description=self.long_text + str(i), created_by=self.user, updated_by=self.user)
+                for i in range(5)
+            ]
+            Note.objects.create(title='Short', description='Short text', created_by=self.user, updated_by=self.user)
+
+        self.assertEqual(compress_existing(Note, ['description'], chunk_size=2), 5)
+        self.assertEqual(compress_existing(Note, ['description'], chunk_size=2), 0)
+        for note in notes:
+            self.assertTrue(self.stored('notes_note', 'description', note.pk).startswith(MARKER))
+            self.assertEqual(Note.objects.get(pk=note.pk).description, note.description)
+
+        self.assertEqual(decompress_existing(Note, ['description'], chunk_size=2), 5)
+        self.assertEqual(self.stored('notes_note', 'description', notes[0].pk), notes[0].description)
+
+
+class FastJSONRendererTestCase(TestCase):
+    """
+        The below code tests that FastJSONRenderer renders the same JSON as JSONRenderer, with and without orjson.
+    """
+    def setUp(self):
+        self.data = {
+            'title': 'Caf\u00e9 \u2603 "quoted" \\ slash',
+            'separators': 'line\u2028paragraph\u2029end',
+            'created_at': timezone.now(),
+            'day': timezone.now().date(),
+            'amount': Decimal('1.50'),
+            'id': uuid.UUID(int=1),
+            'lazy': gettext_lazy('Note does not exist'),
+            'errors': {'title': [ErrorDetail('This field is required.', code='required')]},
+            'nested': [{'version': 1, 'flag': True, 'none': None, 'ratio': 0.5}, ('a', 'b')],
+            # Written `1e-7` and `1e16` by orjson, `1e-07` and `1e+16` by the stdlib
+            'floats': [0.1, 1e-7, 1e16, -2.5],
+        }
+
+    def test_same_json_as_json_renderer(self):
+        expected = JSONRenderer().render(self.data)
+        rendered = FastJSONRenderer().render(self.data)
+        self.assertIn(b'\\u2028', rendered)
+        self.assertEqual(json.loads(rendered), json.loads(expected))
+        # The stdlib encoder renders the same bytes, with or without orjson
+        with mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(FastJSONRenderer().render(self.data), expected)
+        huge = {**self.data, 'huge': 2 ** 70}
+        self.assertEqual(FastJSONRenderer().render(huge), JSONRenderer().render(huge))
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+        indented = 'application/json; indent=4'
+        self.assertEqual(FastJSONRenderer().render(self.data, indented), JSONRenderer().render(self.data, indented))
+
+    def test_note_endpoint_uses_fast_renderer(self):
+        user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        note = Note.objects.create(title='Title', description='Line\u2028break', created_by=user, updated_by=user)
+        client = APIClient()
+        client.force_authenticate(user=user)
+        response = client.get(reverse('get-edit-note', kwargs={'id': note.id}))
+        self.assertIsInstance(response.accepted_renderer, FastJSONRenderer)
+        self.assertEqual(response.content, b'{"title":"Title","description":"Line\\u2028break"}')
+
+
+class CompressionMiddlewareTestCase(TestCase):
+    """
+        The below code tests the negotiated gzip/deflate compression of responses.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.note = Note.objects.create(title='Title', description='word ' * 2000, created_by=self.user, updated_by=self.user)
+
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding('gzip, deflate, br'), 'gzip')
+        self.assertEqual(negotiate_encoding('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(negotiate_encoding('br, *;q=0.1'), 'gzip')
+        self.assertIsNone(negotiate_encoding('gzip;q=0, identity'))
+        self.assertIsNone(negotiate_encoding(''))
+        self.assertIsNone(negotiate_encoding(None))
+
+    def test_compresses_large_responses(self):
+        url = reverse('get-edit-note', kwargs={'id': self.note.id})
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', plain['Vary'])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['ETag'], f"W/{plain['ETag']}")
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertLess(len(response.content), len(plain.content) / 10)
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='deflate')
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.content), plain.content)
+
+        # Small bodies are sent as they are
+        response = self.client.get(reverse('list-notes'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        with override_settings(RESPONSE_COMPRESSION={'ENABLED': False}):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_weak_etag_of_compressed_bodies_is_still_accepted(self):
+        url = reverse('get-edit-note', kwargs={'id': self.note.id})
+        etag = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        self.assertEqual(etag, f'W/"{self.note.id}-1"')
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.put(url, {'description': 'Changed'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(url, {'description': 'Again'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_compresses_streams(self):
+        for i in range(20):
+            self.note.description = f'word {i} ' * 2000
+            self.note.save()
+        url = reverse('get-history', kwargs={'id': self.note.id})
+        plain = b''.join(self.client.get(url, {'stream': 'ndjson'}).streaming_content)
+        response = self.client.get(url, {'stream': 'ndjson'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), plain)
+
+        # Zip exports are already compressed
+        response = self.client.get(reverse('note-export'), {'output': 'zip'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_async_streams(self):
+        async def lines():
+            for i in range(100):
+                yield f'line {i}\n'.encode()
+
+        async def get_response(request):
+            return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+        async def consume(response):
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        middleware = CompressionMiddleware(get_response)
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='deflate')
+        response = async_to_sync(middleware)(request)
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        content = zlib.decompress(async_to_sync(consume)(response))
+        self.assertEqual(content, b''.join(f'line {i}\n'.encode() for i in range(100)))
+
+
+class SparseFieldsTestCase(TestCase):
+    """
+        The below code tests `?fields=` on the note and history endpoints and the columns they read.
+    """
+    def setUp(self):
+        get_note_cache().clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.note = Note.objects.create(title='Title', description='First', created_by=self.user, updated_by=self.user)
+        for i in range(2, 5):
+            self.note.description = f'Description {i}'
+            self.note.save()
+
+    def selected(self, queries, column):
+        return [query['sql'] for query in queries if query['sql'].startswith('SELECT') and f'."{column}"' in query['sql'].split(' FROM ')[0]]
+
+    def test_note_fields(self):
+        url = reverse('get-edit-note', kwargs={'id': self.note.id})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'fields': 'title'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'title': 'Title'})
+        self.assertEqual(response['ETag'], f'"{self.note.id}-4"')
+        self.assertEqual(self.selected(queries, 'description'), [])
+
+        response = self.client.get(url, {'fields': 'description,title'})
+        self.assertEqual(response.data, {'title': 'Title', 'description': 'Description 4'})
+
+        response = self.client.get(url, {'fields': 'title,secret'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {'fields': ['Unknown fields: secret.']})
+
+    def test_history_fields(self):
+        url = reverse('get-history', kwargs={'id': self.note.id})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'fields': 'version,updated_by'})
+        self.assertEqual(response.data['results'], [{'updated_by': self.user.id, 'version': v} for v in range(2, 5)])
+        for column in ('description', 'old_value', 'new_value', 'activity', 'delta'):
+            self.assertEqual(self.selected(queries, column), [])
+
+        response = self.client.get(url, {'fields': 'version,new_value'})
+        self.assertEqual(
+            response.data['results'],
+            [{'new_value': f'Description {v}', 'version': v} for v in range(2, 5)],
+        )
+
+        response = self.client.get(url, {'fields': 'version', 'stream': 'ndjson'})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(lines, [{'version': v} for v in range(2, 5)])
+
+    def test_saving_a_partially_loaded_note(self):
+        before = Note.objects.get(pk=self.note.pk).updated_at
+        note = Note.objects.only('id', 'title', 'version').get(pk=self.note.pk)
+        note.title = 'Renamed'
+        note.updated_by = self.user
+        with CaptureQueriesContext(connection) as queries:
+            note.save()
+        self.assertEqual(self.selected(queries, 'description'), [])
+        self.assertEqual(self.selected(queries, 'updated_at'), [])
+        self.assertEqual(note.get_deferred_fields() & {'description'}, {'description'})
+
+        stored = Note.objects.get(pk=self.note.pk)
+        self.assertEqual((stored.title, stored.description, stored.version), ('Renamed', 'Description 4', 5))
+        self.assertGreater(stored.updated_at, before)
+        self.assertEqual(History.objects.get(note=self.note, field='title').new_value, 'Renamed')
+
+    def test_title_only_batch_does_not_read_descriptions(self):
+        data = {'operations': [{'op': 'update', 'id': self.note.id, 'title': 'Batched'}]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('note-batch'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.selected(queries, 'description'), [])
+        self.note.refresh_from_db()
+        self.assertEqual((self.note.title, self.note.description, self.note.version), ('Batched', 'Description 4', 5))
+
+
+class NoteSyncViewTestCase(TestCase):
+    """The below code tests the change feed and the incremental sync endpoint"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(username='owner', password='password123', email='owner@example.com')
+        self.user = User.objects.create_user(username='reader', password='password123', email='reader@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.note = Note.objects.create(title='Shared', description='One', created_by=self.owner, updated_by=self.owner)
+        self.private = Note.objects.create(title='Private', description='Secret', created_by=self.owner, updated_by=self.owner)
+        self.url = reverse('note-sync')
+
+    def sync(self, since=0, **params):
+        response = self.client.get(self.url, {'since': since, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_only_the_visible_changes_are_returned(self):
+        self.assertEqual(self.sync()['results'], [])
+        self.note.accessible_users.add(self.user)
+        self.note.description = 'Two'
+        self.note.save()
+        self.private.description = 'Changed'
+        self.private.save()
+
+        data = self.sync()
+        # The share and the update of the same note collapse into the last change
+        self.assertEqual([(entry['note_id'], entry['action'], entry['version']) for entry in data['results']], [(self.note.pk, 'update', 2)])
+        self.assertEqual(data['results'][0]['note'], {'title': 'Shared', 'description': 'Two'})
+        self.assertEqual(data['cursor'], NoteChange.objects.latest('seq').seq)
+        self.assertIsNone(data['next'])
+
+        # Nothing changed since
+        self.assertEqual(self.sync(data['cursor'])['results'], [])
+        self.assertEqual(self.sync(data['cursor'])['cursor'], data['cursor'])
+
+    def test_unshare_and_delete(self):
+        self.note.accessible_users.add(self.user)
+        other = Note.objects.create(title='Other', description='Body', created_by=self.owner, updated_by=self.owner)
+        other.accessible_users.add(self.user)
+        cursor = self.sync()['cursor']
+
+        self.note.accessible_users.remove(self.user)
+        other.delete()
+        data = self.sync(cursor)
+        self.assertEqual(
+            [(entry['note_id'], entry['action'], entry['note']) for entry in data['results']],
+            [(self.note.pk, 'unshare', None), (other.pk, 'delete', None)],
+        )
+        # Changes after the unshare are not visible any more
+        self.note.title = 'Renamed'
+        self.note.save()
+        self.assertEqual(self.sync(data['cursor'])['results'], [])
+        # Removing a user the note was never shared with records nothing
+        self.private.accessible_users.remove(self.user)
+        self.user.accessible_notes.remove(self.private)
+        self.assertEqual(self.sync(data['cursor'])['results'], [])
+        # The owner sees the delete too
+        self.assertIn(
+            (other.pk, 'delete'),
+            NoteChange.objects.for_user(self.owner.pk).values_list('note_id', 'action'),
+        )
+
+    def test_pages_follow_the_cursor(self):
+        notes = [
+            Note.objects.create(title=f'Note {i}', description='Body', created_by=self.user, updated_by=self.user)
+            for i in range(5)
+        ]
+        seen, since, pages = [], 0, 0
+        while True:
+            data = self.sync(since, page_size=2)
+            seen += [entry['note_id'] for entry in data['results']]
+            since, pages = data['cursor'], pages + 1
+            if data['next'] is None:
+                break
+            self.assertIn(f'since={since}', data['next'])
+        self.assertEqual(seen, [note.pk for note in notes])
+        self.assertEqual(pages, 3)
+
+    def test_sync_cost_does_not_depend_on_the_number_of_notes(self):
+        Note.objects.bulk_create([
+            Note(title=f'Note {i}', description='Body', created_by=self.user, updated_by=self.user)
+            for i in range(200)
+        ])
+        Note.objects.create(title='New', description='Body', created_by=self.user, updated_by=self.user)
+        # The oldest entry, the head of the feed, the page and the current notes
+        with self.assertNumQueries(4):
+            data = self.sync()
+        self.assertEqual([entry['note']['title'] for entry in data['results']], ['New'])
+
+    def test_batch_bulk_share_and_import_are_recorded(self):
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.post(reverse('note-bulk-share'), {'note_ids': [self.private.pk], 'user_ids': [self.user.pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('note-batch'), {'operations': [
+            {'op': 'update', 'id': self.private.pk, 'title': 'Batched'},
+            {'op': 'create', 'title': 'Created', 'description': 'Body'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = json.dumps({'title': 'Imported', 'description': 'Body', 'shared_with': [self.user.pk]}) + '\n'
+        self.client.post(reverse('note-import'), body, content_type='application/x-ndjson')
+        imported = Note.objects.get(title='Imported')
+
+        self.client.force_authenticate(user=self.user)
+        results = self.sync()['results']
+        self.assertEqual(
+            [(entry['note_id'], entry['action']) for entry in results],
+            [(self.private.pk, 'update'), (imported.pk, 'create')],
+        )
+        self.assertEqual(results[0]['note']['title'], 'Batched')
+
+    def test_invalid_since(self):
+        for since in ('abc', '-1'):
+            response = self.client.get(self.url, {'since': since})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_one_entry_per_change_whatever_the_number_of_shares(self):
+        readers = [
+            User.objects.create_user(username=f'reader{i}', password='password123', email=f'reader{i}@example.com')
+            for i in range(20)
+        ]
+        self.note.accessible_users.add(self.user, *readers)
+        cursor = self.sync()['cursor']
+        self.note.description = 'Two'
+        self.note.save()
+        self.assertEqual(list(NoteChange.objects.filter(seq__gt=cursor).values_list('user_id', 'action')), [(None, 'update')])
+        for user in (self.owner, self.user, readers[-1]):
+            self.client.force_authenticate(user=user)
+            self.assertEqual([entry['action'] for entry in self.sync(cursor)['results']], ['update'])
+
+    def test_purge_records_the_delete_for_every_user(self):
+        self.note.accessible_users.add(self.user)
+        cursor = self.sync()['cursor']
+        self.note.delete()
+        call_command('purge_deleted_notes', stdout=StringIO())
+        self.assertFalse(Note.all_objects.filter(pk=self.note.pk).exists())
+        # The share is gone, the delete still reaches the former readers and the owner
+        self.assertEqual([(entry['note_id'], entry['action']) for entry in self.sync(cursor)['results']], [(self.note.pk, 'delete')])
+        self.assertIn((self.note.pk, 'delete'), NoteChange.objects.for_user(self.owner.pk).values_list('note_id', 'action'))
+
+    def test_prune_keeps_the_newest_entry_and_pruned_cursors_are_gone(self):
+        self.note.accessible_users.add(self.user)
+        for description in ('Two', 'Three'):
+            self.note.description = description
+            self.note.save()
+        cursor = self.sync()['cursor']
+        head, count = NoteChange.objects.latest('seq').seq, NoteChange.objects.count()
+        self.assertEqual(NoteChange.objects.prune(timedelta(0), batch_size=2), count - 1)
+        self.assertEqual(NoteChange.objects.oldest_seq(), head)
+        # A client that had read everything goes on
+        self.assertEqual(self.sync(cursor)['results'], [])
+
+        response = self.client.get(self.url, {'since': 0})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        self.assertEqual(response.data['cursor'], head)
+        self.note.title = 'Renamed'
+        self.note.save()
+        self.assertEqual([entry['version'] for entry in self.sync(response.data['cursor'])['results']], [4])
+        # Nothing recent is pruned
+        self.assertEqual(NoteChange.objects.prune(timedelta(hours=1)), 0)
+
+
+@override_settings(NOTES_EVENTS={'HEARTBEAT': 0.2, 'POLL_TIMEOUT': 5})
+class NoteEventsTestCase(TransactionTestCase):
+    """
+        The below code tests the push of note changes. Changes are published once their
+        transaction commits, so the data has to be committed.
+    """
+    def setUp(self):
+        get_note_cache().clear()
+        token_cache.clear()
+        user_cache.clear()
+        self.owner = User.objects.create_user(username='owner', password='password123', email='owner@example.com')
+        self.reader = User.objects.create_user(username='reader', password='password123', email='reader@example.com')
+        self.note = Note.objects.create(title='Title', description='First', created_by=self.owner, updated_by=self.owner)
+        self.note.accessible_users.add(self.reader)
+        self.url = reverse('async-note-events')
+
+    def headers(self, user, **headers):
+        return {'Authorization': f'Bearer {AccessToken.for_user(user)}', **headers}
+
+    def edit(self, description):
+        note = Note.objects.get(pk=self.note.pk)
+        note.description = description
+        note.updated_by = self.owner
+        note.save()
+        return note
+
+    async def poll(self, user, **params):
+        response = await self.async_client.get(self.url, params, headers=self.headers(user))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    async def test_long_poll_returns_the_pending_changes_at_once(self):
+        data = await self.poll(self.reader, since=0, timeout=0)
+        self.assertEqual([(event['note_id'], event['action']) for event in data['results']], [(self.note.pk, 'create'), (self.note.pk, 'share')])
+        self.assertEqual(data['cursor'], data['results'][-1]['seq'])
+        # Nothing new
+        data = await self.poll(self.reader, since=data['cursor'], timeout=0)
+        self.assertEqual(data['results'], [])
+
+    async def test_long_poll_waits_for_the_next_change(self):
+        cursor = (await self.poll(self.reader, timeout=0))['cursor']
+        started = time.perf_counter()
+        waiting = asyncio.ensure_future(self.poll(self.reader, since=cursor, timeout=5))
+        await asyncio.sleep(0.2)
+        await sync_to_async(self.edit, thread_sensitive=False)('Second')
+        data = await waiting
+        self.assertLess(time.perf_counter() - started, 4)
+        self.assertEqual([(event['action'], event['version']) for event in data['results']], [('update', 2)])
+        self.assertEqual(get_event_hub().stats()['subscribers'], 0)
+
+    async def test_event_stream(self):
+        """
+            Through the ASGI application, up to the client disconnecting.
+        """
+        from notes_management.asgi import application
+
+        received, sent = asyncio.Queue(), asyncio.Queue()
+        await received.put({'type': 'http.request', 'body': b'', 'more_body': False})
+        scope = self.stream_scope(f'Bearer {AccessToken.for_user(self.reader)}')
+
+        async def body():
+            message = await asyncio.wait_for(sent.get(), 5)
+            self.assertEqual(message['type'], 'http.response.body')
+            return message['body']
+
+        with override_settings(ALLOWED_HOSTS=['localhost']):
+            task = asyncio.ensure_future(application(scope, received.get, sent.put))
+            start = await asyncio.wait_for(sent.get(), 5)
+            headers = dict(start['headers'])
+            self.assertEqual((start['status'], headers[b'Content-Type']), (200, b'text/event-stream'))
+            self.assertNotIn(b'Content-Encoding', headers)
+            self.assertEqual(await body(), b': connected\n\n')
+            # The create and the share of the note, replayed from the change feed
+            self.assertRegex(await body(), rb'^id: \d+\ndata: \{.*"action":"create".*\}\n\nid: \d+\ndata: \{.*"action":"share".*\}\n\n$')
+
+            await sync_to_async(self.edit, thread_sensitive=False)('Second')
+            chunks = []
+            while not any(b'"update"' in chunk for chunk in chunks):
+                chunks.append(await body())
+            event = json.loads(b''.join(chunks).split(b'data: ')[-1])
+            self.assertEqual((event['note_id'], event['action'], event['version']), (self.note.pk, 'update', 2))
+            # Heartbeats while idle
+            self.assertEqual(await body(), b': keep-alive\n\n')
+            self.assertEqual(get_event_hub().stats()['subscribers'], 1)
+
+            await received.put({'type': 'http.disconnect'})
+            await asyncio.wait_for(task, 5)
+        self.assertEqual(get_event_hub().stats()['subscribers'], 0)
+
+    def stream_scope(self, authorization, query_string=b'since=0'):
+        return {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': self.url, 'raw_path': self.url.encode(), 'query_string': query_string, 'root_path': '',
+            'headers': [
+                (b'host', b'localhost'),
+                (b'accept', b'text/event-stream'),
+                (b'accept-encoding', b'gzip'),
+                (b'authorization', authorization.encode()),
+            ],
+            'client': ('127.0.0.1', 1234), 'server': ('localhost', 80),
+        }
+
+    async def test_invalid_event_stream_requests_are_answered_by_django(self):
+        from notes_management.asgi import application
+
+        token = f'Bearer {AccessToken.for_user(self.reader)}'
+        cases = [
+            (self.stream_scope('Bearer invalid'), 401),
+            (self.stream_scope(''), 401),
+            (self.stream_scope(token, query_string=b'since=-1'), 400),
+        ]
+        with override_settings(ALLOWED_HOSTS=['localhost']):
+            for scope, expected_status in cases:
+                received, sent = asyncio.Queue(), asyncio.Queue()
+                await received.put({'type': 'http.request', 'body': b'', 'more_body': False})
+                await asyncio.wait_for(application(scope, received.get, sent.put), 5)
+                self.assertEqual((await sent.get())['status'], expected_status)
+        self.assertEqual(get_event_hub().stats()['subscribers'], 0)
+
+    async def test_other_users_changes_are_not_pushed(self):
+        stranger = await sync_to_async(User.objects.create_user)(username='stranger', password='password123', email='stranger@example.com')
+        waiting = asyncio.ensure_future(self.poll(stranger, timeout=0.5))
+        await asyncio.sleep(0.1)
+        await sync_to_async(self.edit, thread_sensitive=False)('Second')
+        self.assertEqual((await waiting)['results'], [])
+
+    async def test_change_feed_broker(self):
+        with override_settings(NOTES_EVENTS={'BACKEND': 'notes.events.ChangeFeedBroker', 'OPTIONS': {'interval': 0.05}}):
+            cursor = (await self.poll(self.reader, timeout=0))['cursor']
+            waiting = asyncio.ensure_future(self.poll(self.reader, since=cursor, timeout=5))
+            await asyncio.sleep(0.2)
+            # Written without publishing, as another process would
+            await sync_to_async(NoteChange.objects.bulk_create)([
+                NoteChange(note_id=self.note.pk, action=NoteChange.UPDATE, version=7)
+            ])
+            data = await waiting
+            self.assertEqual([(event['action'], event['version']) for event in data['results']], [('update', 7)])
+
+    def test_slow_subscriber_resyncs(self):
+        async def run():
+            hub = EventHub(LocalBroker(), max_queue=2)
+            subscriber = hub.subscribe(self.reader.pk, 0)
+            hub.dispatch([(self.reader.pk, {'seq': seq}) for seq in range(1, 6)])
+            events, resync = await subscriber.wait(1)
+            hub.unsubscribe(subscriber)
+            return events, resync
+        events, resync = async_to_sync(run)()
+        self.assertEqual((events, resync), ([{'seq': 1}, {'seq': 2}], True))
+
+    def test_memory_of_idle_subscribers(self):
+        """
+            Thousands of connections waiting for events, each with its task, subscriber and
+            waiter, cost a bounded amount of memory, and an event still reaches all of them.
+        """
+        count = 5000
+
+        async def run():
+            hub = EventHub(LocalBroker())
+            started = asyncio.Event()
+
+            async def connection(user_id):
+                subscriber = hub.subscribe(user_id, 0)
+                try:
+                    if hub.stats()['subscribers'] == count:
+                        started.set()
+                    return await subscriber.wait(60)
+                finally:
+                    hub.unsubscribe(subscriber)
+
+            before = tracemalloc.get_traced_memory()[0]
+            tasks = [asyncio.ensure_future(connection(index % 100)) for index in range(count)]
+            await started.wait()
+            await asyncio.sleep(0)
+            per_connection = (tracemalloc.get_traced_memory()[0] - before) / count
+            # One event for every user, published from another thread
+            await asyncio.to_thread(hub.dispatch, [(user_id, {'seq': 1}) for user_id in range(100)])
+            results = await asyncio.wait_for(asyncio.gather(*tasks), 10)
+            return per_connection, results, hub.stats()
+
+        tracemalloc.start()
+        try:
+            per_connection, results, stats = async_to_sync(run)()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(per_connection, 4096)
+        self.assertEqual(results, [([{'seq': 1}], False)] * count)
+        self.assertEqual(stats, {'users': 0, 'subscribers': 0})
+
+
+@override_settings(NOTES_HISTORY_SNAPSHOT_INTERVAL=3)
+class NotePatchTestCase(TestCase):
+    """
+        The below code tests PATCH updates of a note description with a text delta against a base version.
+    """
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', email='testuser@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.description = 'lorem ipsum ' * 20000
+        self.note = Note.objects.create(title='Large', description=self.description, created_by=self.user, updated_by=self.user)
+        self.url = reverse('get-edit-note', kwargs={'id': self.note.id})
+
+    def patch(self, base_version, ops, **headers):
+        return self.client.patch(self.url, {'base_version': base_version, 'patch': ops}, format='json', **headers)
+
+    def test_patch_applies_the_delta(self):
+        response = self.patch(1, [6, -5, 'IPSUM', len(self.description) - 11])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'version': 2})
+        self.assertEqual(response['ETag'], f'"{self.note.id}-2"')
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.description, 'lorem IPSUM ' + self.description[12:])
+
+        row = History.objects.get(note=self.note, field='description')
+        self.assertEqual((row.version, row.encoding), (2, History.DELTA))
+        self.assertEqual(delta.loads(row.delta), [6, -5, 'ipsum', len(self.description) - 11])
+        self.assertEqual(note_at_version(self.note, 1)['description'], self.description)
+        self.assertEqual(NoteChange.objects.filter(note_id=self.note.pk, action=NoteChange.UPDATE).count(), 1)
+
+    def test_patch_is_not_diffed(self):
+        with mock.patch('notes.delta.diff') as diff:
+            self.patch(1, [len(self.description), '!'])
+        diff.assert_not_called()
+
+    def test_snapshot_version_keeps_full_values(self):
+        self.patch(1, [len(self.description), '!'])
+        self.patch(2, [len(self.description) + 1, '?'])
+        row = History.objects.get(note=self.note, field='description', version=3)
+        self.assertEqual((row.encoding, row.new_value), (History.FULL, self.description + '!?'))
+
+    def test_stale_base_version_is_a_conflict(self):
+        self.assertEqual(self.patch(1, [len(self.description), '!']).status_code, status.HTTP_200_OK)
+        response = self.patch(1, [len(self.description), '?'])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['version'], 2)
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.description, self.description + '!')
+
+    def test_concurrent_write_is_a_conflict(self):
+        def save_concurrently(note, **kwargs):
+            Note.objects.filter(pk=note.pk).update(version=5)
+            return original_save(note, **kwargs)
+
+        original_save = Note.save
+        with mock.patch.object(Note, 'save', autospec=True, side_effect=save_concurrently):
+            response = self.patch(1, [len(self.description), '!'])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['version'], 5)
+        self.assertFalse(History.objects.filter(note=self.note).exists())
+
+    def test_stale_if_match_is_rejected(self):
+        response = self.patch(1, [len(self.description), '!'], HTTP_IF_MATCH=f'"{self.note.id}-2"')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_invalid_patches_are_rejected(self):
+        for ops in ([5, 'x'], [len(self.description) + 1], [-len(self.description)], [len(self.description), 1.5], 'text'):
+            response = self.patch(1, ops)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, ops)
+            self.assertIn('patch', response.data)
+        response = self.client.patch(self.url, {'patch': [len(self.description)]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.version, 1)
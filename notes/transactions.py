@@ -0,0 +1,42 @@
+'''
+    Write transactions that start over when SQLite refuses them its lock.
+
+    A default (deferred) SQLite transaction that reads before it writes
+    holds a read lock when it first writes. If a concurrent transaction
+    took the write lock in the meantime, the upgrade fails at once with
+    "database is locked" instead of waiting for the busy timeout, as
+    waiting could deadlock. Rolling back and running the transaction
+    again lets the other one commit first. The production backend
+    (`notes_management.sqlite`) takes the write lock up front and never
+    gets there.
+'''
+import random
+import time
+
+from django.db import OperationalError, transaction
+
+# Attempts of a transaction failing with "database is locked"
+LOCKED_ATTEMPTS = 10
+
+
+def atomic_with_retry(function, *args, **kwargs):
+    '''
+        Runs `function(*args, **kwargs)` in `transaction.atomic()` and
+        returns its result, running it again after a short random backoff
+        when the transaction fails to get the database lock. Inside an
+        outer transaction it runs once, the outer one is what has to start
+        over.
+    '''
+    for attempt in range(LOCKED_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                return function(*args, **kwargs)
+        except OperationalError as error:
+            retry = (
+                'database is locked' in str(error)
+                and attempt < LOCKED_ATTEMPTS - 1
+                and not transaction.get_connection().in_atomic_block
+            )
+            if not retry:
+                raise
+            time.sleep(random.uniform(0, min(0.01 * 2 ** attempt, 0.2)))
@@ -1,15 +1,45 @@
 from django.urls.conf import path
 from notes.views import (
     CreateNotes,
+    NotesListView,
     NotesRetrieveUpdateView,
     NoteShareView,
-    NoteVersionHistoryView
+    NoteVersionHistoryView,
+    NoteBatchView,
+    NoteBulkShareView,
+    NoteAsOfView,
+    NoteExportView,
+    NoteImportView,
+    NoteSyncView,
+    )
+from notes.async_views import (
+    AsyncCreateNoteView,
+    AsyncNoteDetailView,
+    AsyncNoteEventsView,
+    AsyncNoteShareView,
+    AsyncNoteVersionHistoryView,
     )
 
 
 urlpatterns = [
+    path("", NotesListView.as_view(), name='list-notes'),
     path("create/", CreateNotes.as_view(), name='create-user'),
     path("<int:id>/", NotesRetrieveUpdateView.as_view(), name='get-edit-note'),
     path("share/", NoteShareView.as_view(), name='note-share'),
-    path("version-history/<int:id>/", NoteVersionHistoryView.as_view(), name='get-history')
+    path("share/bulk/", NoteBulkShareView.as_view(), name='note-bulk-share'),
+    path("batch/", NoteBatchView.as_view(), name='note-batch'),
+    path("version-history/<int:id>/", NoteVersionHistoryView.as_view(), name='get-history'),
+    path("<int:id>/as-of/", NoteAsOfView.as_view(), name='note-as-of'),
+    path("export/", NoteExportView.as_view(), name='note-export'),
+    path("import/", NoteImportView.as_view(), name='note-import'),
+    path("sync/", NoteSyncView.as_view(), name='note-sync'),
+]
+
+#ENDPOINTS served natively by the ASGI application
+urlpatterns += [
+    path("async/create/", AsyncCreateNoteView.as_view(), name='async-create-note'),
+    path("async/<int:id>/", AsyncNoteDetailView.as_view(), name='async-get-edit-note'),
+    path("async/share/", AsyncNoteShareView.as_view(), name='async-note-share'),
+    path("async/version-history/<int:id>/", AsyncNoteVersionHistoryView.as_view(), name='async-get-history'),
+    path("async/events/", AsyncNoteEventsView.as_view(), name='async-note-events'),
 ]
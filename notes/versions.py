@@ -0,0 +1,185 @@
+'''
+    Reading back delta-encoded History.
+
+    Description changes are stored as reverse deltas (new -> old). The text
+    after a given version is rebuilt from the nearest full text above it:
+    either the next snapshot row or, when there is none, the note itself.
+    The walk is therefore bounded by `NOTES_HISTORY_SNAPSHOT_INTERVAL`
+    versions, whatever the total length of the history is. Snapshots are
+    found through the partial `history_snapshot_idx` index and timestamps
+    are resolved to versions through `history_note_created_idx`.
+
+    The walk needs every row between that full text and the versions read.
+    With write-behind History (see `notes.history_writer`) a note is
+    committed before its rows are written, so readers call
+    `check_history_written()`, which raises HistoryNotWritten while the
+    history of the note is behind its version.
+'''
+from notes import delta
+from notes.history_writer import advance_history_versions, wait_for_history, write_behind_settings
+from notes.models import History
+
+TRACKED_FIELDS = ("title", "description")
+
+
+class VersionNotFound(ValueError):
+    '''
+        Raised for a version a note never had.
+    '''
+
+
+class HistoryNotWritten(Exception):
+    '''
+        Raised when History rows of a note are not written yet.
+    '''
+
+
+def check_history_written(note):
+    '''
+        Raises HistoryNotWritten unless every version of `note` has its
+        History rows, as told by its `history_version` watermark. Without a
+        query when the watermark read with the note is up to date. A
+        watermark left behind by rows written outside the History writer
+        (batches, or saves before write-behind was enabled) is caught up
+        from the rows above it. A no-op without write-behind, where the
+        rows are written in the save's transaction.
+    '''
+    if not write_behind_settings()['ENABLED'] or note.history_version >= note.version:
+        return
+    if advance_history_versions([note.pk]).get(note.pk, 0) < note.version:
+        raise HistoryNotWritten(f"The history of note {note.pk} is not written yet, retry shortly.")
+
+
+def description_states(note, low, high):
+    '''
+        Returns `{version: (old_value, new_value)}` for the description
+        changes of `note` with `low <= version <= high`.
+
+        Rows above `note.version`, written by saves committed after `note`
+        was read, are left out: the chain is unwound from `note.description`.
+    '''
+    rows = History.objects.filter(note=note, field="description", version__lte=note.version)
+    snapshot = (
+        rows.filter(version__gte=high, encoding=History.FULL)
+        .order_by('version')
+        .values_list('version', flat=True)
+        .first()
+    )
+    chain = rows.filter(version__gte=low)
+    if snapshot is not None:
+        chain = chain.filter(version__lte=snapshot)
+    chain = chain.order_by('-version').only('version', 'encoding', 'old_value', 'new_value', 'delta')
+
+    states = {}
+    for row, old_value, new_value in unwind(chain, note.description):
+        if row.version <= high:
+            states[row.version] = (old_value, new_value)
+    return states
+
+
+def unwind(rows, current):
+    '''
+        Yields `(row, old_value, new_value)` for description `rows` ordered
+        by descending version, `current` being the text after the first.
+    '''
+    for row in rows:
+        if row.encoding == History.FULL:
+            old_value, new_value = row.old_value, row.new_value
+        else:
+            old_value, new_value = delta.apply(delta.loads(row.delta), current), current
+        current = old_value
+        yield row, old_value, new_value
+
+
+def decode_history(note, entries):
+    '''
+        Fills `old_value`, `new_value` and `activity` of the delta-encoded
+        `entries` of `note` in place, so they read exactly like full rows.
+        The entries are not meant to be saved afterwards, nor above
+        `note.version`.
+    '''
+    encoded = [entry for entry in entries if entry.encoding == History.DELTA]
+    if not encoded:
+        return entries
+    versions = [entry.version for entry in encoded]
+    states = description_states(note, min(versions), max(versions))
+    for entry in encoded:
+        entry.old_value, entry.new_value = states[entry.version]
+        entry.activity = f"{entry.activity} from {entry.old_value} to {entry.new_value}"
+    return entries
+
+
+def decode_complete_history(description, entries, version=None):
+    '''
+        Same as `decode_history` for `entries` holding the complete history
+        of a note whose current description is `description`: the whole
+        delta chain is in `entries`, so it is walked without any query.
+
+        Given the `version` of the note, versions missing from `entries`
+        (see `check_history_written()`) break the chain: the delta rows
+        below a gap are decoded from the next snapshot down, and left
+        encoded until then.
+    '''
+    descriptions = sorted(
+        (entry for entry in entries if entry.field == "description"),
+        key=lambda entry: entry.version,
+        reverse=True,
+    )
+    written = {entry.version for entry in entries}
+    missing = [number for number in range(version or 1, 1, -1) if number not in written]
+    current = description
+    for entry in descriptions:
+        while missing and missing[0] > entry.version:
+            missing.pop(0)
+            current = None
+        if entry.encoding == History.FULL:
+            current = entry.old_value
+        elif current is not None:
+            entry.old_value, entry.new_value = delta.apply(delta.loads(entry.delta), current), current
+            entry.activity = f"{entry.activity} from {entry.old_value} to {entry.new_value}"
+            current = entry.old_value
+    return entries
+
+
+def note_at_version(note, version):
+    '''
+        Returns `{"version", "title", "description"}` of `note` as it was
+        right after `version` (1 is the note as created). Raises
+        VersionNotFound for versions the note never had and
+        HistoryNotWritten while its history is not written.
+    '''
+    if not 1 <= version <= note.version:
+        raise VersionNotFound(f"Note {note.pk} has no version {version}.")
+    wait_for_history()
+    check_history_written(note)
+
+    state = {"version": version}
+    for field in TRACKED_FIELDS:
+        rows = History.objects.filter(note=note, field=field, version__lte=note.version)
+        entry = rows.filter(version__lte=version).order_by('-version').first()
+        use_new_value = entry is not None
+        if entry is None:
+            entry = rows.filter(version__gt=version).order_by('version').first()
+        if entry is None:
+            state[field] = getattr(note, field)
+            continue
+        decode_history(note, [entry])
+        state[field] = entry.new_value if use_new_value else entry.old_value
+    return state
+
+
+def version_at(note, timestamp):
+    '''
+        Returns the version `note` had at `timestamp`, or None if it did not
+        exist yet. One index lookup on (note, created_at).
+    '''
+    if timestamp < note.created_at:
+        return None
+    wait_for_history()
+    latest = (
+        History.objects.filter(note=note, created_at__lte=timestamp)
+        .order_by('-created_at', '-id')
+        .values_list('version', flat=True)
+        .first()
+    )
+    return latest or 1
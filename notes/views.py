@@ -1,25 +1,50 @@
 from rest_framework.generics import (
     CreateAPIView, 
     GenericAPIView,
-    RetrieveAPIView,
+    ListAPIView,
     )
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework import mixins
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import Case, Max, Value, When
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 
+from notes.cache import get_note_cache
+from notes.export import CONTENT_TYPES, export_records, export_stream
+from notes.history_writer import wait_for_history
+from notes.importer import import_notes, read_rows
+from notes.conditional import match, none_match
+from notes.pagination import ChangeFeedPagination, HistoryPagination, KeysetPagination
 from notes.serializers import (
     NotesSerializer,
+    NoteListSerializer,
     HistorySerializer,
     NoteShareSerializer,
-    NoteUpdateSerializer
+    NoteUpdateSerializer,
+    NotePatchSerializer,
+    NoteBatchSerializer,
+    HistoryFilterSerializer,
+    NoteBulkShareSerializer,
+    NoteAsOfSerializer,
+    NoteExportSerializer,
+    NoteImportSerializer,
+    NoteChangeSerializer,
+    parse_fields,
     )
 from notes.models import (
     Note,
-    History
+    History,
+    NoteChange,
+    StaleVersionError,
     )
+from notes.streaming import iter_chunks, ndjson_line
+from notes.transactions import atomic_with_retry
+from notes.versions import HistoryNotWritten, VersionNotFound, check_history_written, decode_history, note_at_version, version_at
 from notes.permissions import (
+    CanDownloadNotes,
     IsOwnerOrSharedUser,
     IsOwner
     )
@@ -34,6 +59,30 @@ class CreateNotes(CreateAPIView):
     def perform_create(self, serializer):
         return serializer.save(created_by=self.request.user, updated_by=self.request.user)
 
+class NotesListView(ListAPIView):
+    '''
+        View for listing the notes owned by or shared with the logged in
+        user, newest first, using keyset pagination on (updated_at, id).
+        `description` is only loaded when `?include_description=true`.
+    '''
+    serializer_class = NoteListSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+
+    def include_description(self):
+        return self.request.query_params.get('include_description', '').lower() in ('1', 'true')
+
+    def get_queryset(self):
+        columns = ['id', 'title', 'created_by', 'updated_at']
+        if self.include_description():
+            columns.append('description')
+        return Note.objects.accessible_to(self.request.user).only(*columns)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['include_description'] = self.include_description()
+        return context
+
 class NoteShareView(CreateAPIView):
     '''
         View for Sharing notes
@@ -49,15 +98,86 @@ class NoteShareView(CreateAPIView):
         users = serializer.validated_data['users']
 
         try:
-            note = Note.objects.get(id=note_id)
+            note = Note.objects.only('id', 'created_by').get(id=note_id)
         except Note.DoesNotExist:
             return Response({"message": "Note does not exist"}, status=status.HTTP_404_NOT_FOUND)
+        self.check_object_permissions(request, note)
 
-        # Share the note with the specified users
-        note.accessible_users.add(*users)
+        # Share the note with the specified users; the add reads the
+        # existing shares before writing
+        atomic_with_retry(note.accessible_users.add, *users)
 
         return Response({"message": "Note shared successfully"}, status=status.HTTP_200_OK)
 
+class NoteBulkShareView(GenericAPIView):
+    '''
+        View for sharing (or unsharing) many notes with many users at once.
+
+        User ids and note ownership are each checked with one IN query and
+        the `accessible_users` rows are written with a single
+        existing pairs are read first, so that only the pairs actually
+        shared (inserted with a single `bulk_create`) or unshared (removed
+        by id) are recorded in the change feed, with one more INSERT, and
+        only their notes are invalidated in the cache. This runs in a
+        transaction that starts over if SQLite refuses it the write lock.
+        Only the owner of every listed note may do this.
+    '''
+    serializer_class = NoteBulkShareSerializer
+    permission_classes = [IsAuthenticated]
+    batch_size = 5000
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        note_ids = serializer.validated_data['note_ids']
+        user_ids = serializer.validated_data['user_ids']
+
+        owners = dict(Note.objects.filter(pk__in=note_ids).values_list('pk', 'created_by_id'))
+        missing = [note_id for note_id in note_ids if note_id not in owners]
+        if missing:
+            return Response({"message": "Note does not exist", "note_ids": missing}, status=status.HTTP_404_NOT_FOUND)
+        forbidden = [note_id for note_id, owner_id in owners.items() if owner_id != request.user.pk]
+        if forbidden:
+            return Response(
+                {"error": "You do not have the permission to perform this action.", "note_ids": sorted(forbidden)},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+
+        atomic_with_retry(self.write_shares, serializer.validated_data['action'], note_ids, user_ids)
+        return Response(
+            {"message": f"Notes {serializer.validated_data['action']}d successfully", "notes": len(note_ids), "users": len(user_ids)},
+            status=status.HTTP_200_OK,
+        )
+
+    def write_shares(self, action, note_ids, user_ids):
+        through = Note.accessible_users.through
+        rows = list(
+            through.objects.filter(note_id__in=note_ids, user_id__in=user_ids)
+            .order_by('note_id', 'user_id').values_list('pk', 'note_id', 'user_id')
+        )
+        if action == 'share':
+            # Only the pairs that were not shared yet are inserted and
+            # recorded, sharing a note again changes nothing
+            shared = {(note_id, user_id) for _, note_id, user_id in rows}
+            pairs = [
+                (note_id, user_id) for note_id in note_ids for user_id in user_ids
+                if (note_id, user_id) not in shared
+            ]
+            through.objects.bulk_create(
+                [through(note_id=note_id, user_id=user_id) for note_id, user_id in pairs],
+                batch_size=self.batch_size,
+                ignore_conflicts=True,
+            )
+        else:
+            # Only the pairs that were shared are unshared, users who
+            # never had access must not see the notes in their feed
+            for start in range(0, len(rows), self.batch_size):
+                through.objects.filter(pk__in=[row[0] for row in rows[start:start + self.batch_size]]).delete()
+            pairs = [(note_id, user_id) for _, note_id, user_id in rows]
+        # The through rows are written directly, so no m2m_changed signal
+        NoteChange.objects.record_shares(NoteChange.SHARE if action == 'share' else NoteChange.UNSHARE, pairs)
+        get_note_cache().invalidate_many(list(dict.fromkeys(note_id for note_id, _ in pairs)))
+
 class NotesRetrieveUpdateView(
     mixins.RetrieveModelMixin,
     mixins.UpdateModelMixin,
@@ -67,46 +187,526 @@ class NotesRetrieveUpdateView(
     '''
         View for updating ,reading and deleting a particular note
         based on the provided permissions
+
+        Responses carry a strong `ETag` derived from the note version.
+        `GET` with a matching `If-None-Match` returns 304 without
+        serializing the note, and `PUT` with an `If-Match` that is not the
+        current version returns 412. The `If-Match` check is repeated by
+        the UPDATE itself, so a write racing in between is also rejected
+        without holding a row lock.
+
+        `GET ?fields=title` (comma separated) returns only the listed
+        fields and only reads their columns.
+
+        `PATCH` with `{"base_version": <n>, "patch": <delta>}` applies a
+        text delta (see `notes.delta`) to the description of version `n`
+        and returns `{"version": <new version>}`, so a small edit of a
+        large note neither uploads nor downloads the whole text. If the
+        note is no longer at `base_version` nothing is written and 409
+        returns the current `version`; the client rebases its patch on it.
     '''
-    queryset = Note.objects.all()
     serializer_class = NotesSerializer
     permission_classes = [IsAuthenticated, IsOwnerOrSharedUser]
     lookup_url_kwarg = 'id'
+    # Read for the ETag and the permission checks whatever the fields
+    required_columns = ('id', 'version', 'created_by')
+
+    def get_fields(self):
+        if self.request.method != 'GET':
+            return None
+        return parse_fields(self.request.query_params.get('fields'), NotesSerializer.Meta.fields)
+
+    def get_queryset(self):
+        # `is_shared` is resolved in the same query as the note, so the
+        # permission checks never load `accessible_users`.
+        queryset = Note.objects.with_share_flag(self.request.user)
+        fields = self.get_fields()
+        if fields is not None:
+            queryset = queryset.only(*self.required_columns, *fields)
+        if self.request.method == 'GET' and 'If-None-Match' in self.request.headers:
+            # Most conditional reads end in a 304, which needs no description.
+            queryset = queryset.defer('description')
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.get_fields()
+        return context
 
     def get_serializer_class(self):
         if self.request.method == 'PUT':
             return NoteUpdateSerializer
+        if self.request.method == 'PATCH':
+            return NotePatchSerializer
         return self.serializer_class
 
-    def perform_update(self, serializer):
-        serializer.save(updated_by=self.request.user)
+    def perform_update(self, serializer, expected_version=None):
+        serializer.save(updated_by=self.request.user, expected_version=expected_version)
     
     def get(self, request, *args, **kwargs):
-        return self.retrieve(request, *args, **kwargs)
+        fields = self.get_fields()
+        cache = get_note_cache()
+        cached = cache.get(kwargs[self.lookup_url_kwarg])
+        if cached is not None:
+            self.check_object_permissions(request, cached.for_user(request.user))
+            if none_match(request.headers.get('If-None-Match'), cached.etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': cached.etag})
+            return Response(cached.subset(fields), headers={'ETag': cached.etag})
+
+        epoch = cache.epoch(kwargs[self.lookup_url_kwarg])
+        instance = self.get_object()
+        if none_match(request.headers.get('If-None-Match'), instance.etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': instance.etag})
+        serializer = self.get_serializer(instance)
+        if fields is None:
+            cache.set(instance, serializer.data, epoch)
+        return Response(serializer.data, headers={'ETag': instance.etag})
     
     def put(self, request, *args, **kwargs):
-        return self.update(request, *args, **kwargs)
+        instance = self.get_object()
+        if_match = request.headers.get('If-Match')
+        if not match(if_match, instance.etag):
+            return self.precondition_failed()
+        serializer = self.get_serializer(instance, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            self.perform_update(serializer, expected_version=instance.version if if_match is not None else None)
+        except StaleVersionError:
+            return self.precondition_failed()
+        return Response(serializer.data, headers={'ETag': instance.etag})
+
+    def patch(self, request, *args, **kwargs):
+        instance = self.get_object()
+        if not match(request.headers.get('If-Match'), instance.etag):
+            return self.precondition_failed()
+        serializer = self.get_serializer(instance, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if serializer.validated_data['base_version'] != instance.version:
+            return self.version_conflict(instance.version)
+        try:
+            serializer.save(updated_by=request.user)
+        except StaleVersionError:
+            return self.version_conflict(Note.objects.filter(pk=instance.pk).values_list('version', flat=True).first())
+        return Response(serializer.data, headers={'ETag': instance.etag})
+
+    def precondition_failed(self):
+        return Response(
+            {"error" : "The note has been modified since it was read."},
+            status = status.HTTP_412_PRECONDITION_FAILED
+            )
+
+    def version_conflict(self, version):
+        return Response(
+            {"error" : "The note is no longer at base_version.", "version" : version},
+            status = status.HTTP_409_CONFLICT
+            )
 
     def delete(self, request, *args, **kwargs):
-        if self.request.user in self.get_object().accessible_users.all():
-            return super().destroy(request, *args, **kwargs)
+        instance = self.get_object()
+        if instance.is_shared:
+            self.perform_destroy(instance)
+            return Response(status=status.HTTP_204_NO_CONTENT)
         else:
             return Response(
                 {"error" : "You do not have the permission to perform this action."},
                 status = status.HTTP_403_FORBIDDEN
                 )
 
-class NoteVersionHistoryView(RetrieveAPIView):
+class NoteVersionHistoryView(GenericAPIView):
     '''
         View for fetching the history changes of a particular note
         There are permissions applied here for checking if the
         logged in user can access the note or not
+
+        Entries are ordered by (created_at, id) and keyset paginated. They
+        can be filtered with `since`/`until` (ISO 8601 datetimes) and
+        `updated_by` (user id). With `?stream=ndjson` every matching entry
+        is streamed as newline delimited JSON instead, reading the rows in
+        chunks with `.iterator()`.
+
+        `?fields=version,updated_by` (comma separated) returns only the
+        listed fields. Without any of `old_value`, `new_value` and
+        `activity`, neither those columns nor the note description are
+        read and no delta is decoded.
     '''
     serializer_class = HistorySerializer
     permission_classes = [IsAuthenticated, IsOwnerOrSharedUser]
+    pagination_class = HistoryPagination
+    lookup_url_kwarg = 'id'
+    stream_chunk_size = 500
+    # Columns only needed to return the old and new values
+    value_columns = ('old_value', 'new_value', 'activity', 'delta')
+
+    def get_fields(self):
+        return parse_fields(self.request.query_params.get('fields'), HistorySerializer.Meta.fields)
+
+    def needs_values(self, fields):
+        return fields is None or any(field in self.value_columns for field in fields)
+
+    def get_queryset(self):
+        queryset = Note.objects.with_share_flag(self.request.user)
+        if not self.needs_values(self.get_fields()):
+            queryset = queryset.defer('description')
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.get_fields()
+        return context
+
+    def get(self, request, *args, **kwargs):
+        note = self.get_object()
+        filters = HistoryFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        wait_for_history()
+        # Rows of saves committed after the note was read are left out,
+        # they do not decode against its description
+        history_entries = History.objects.filter(note=note, version__lte=note.version)
+        history_entries = self.filter_history(history_entries, filters.validated_data)
+        values = self.needs_values(self.get_fields())
+        if values:
+            # Checked before a stream starts, it cannot turn into an error
+            try:
+                check_history_written(note)
+            except HistoryNotWritten as e:
+                return self.history_not_written(e)
+        else:
+            history_entries = history_entries.defer(*self.value_columns)
+
+        if filters.validated_data.get('stream') == 'ndjson':
+            return StreamingHttpResponse(
+                self.stream_history(note, history_entries, values),
+                content_type='application/x-ndjson',
+            )
+
+        page = self.paginate_queryset(history_entries)
+        if values:
+            decode_history(note, page)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def history_not_written(self, error):
+        '''
+            The rows are written within moments, the client is told to
+            retry instead of getting a history decoded from a broken chain.
+        '''
+        return Response(
+            {"error": str(error)},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={'Retry-After': '1'},
+            )
+
+    def filter_history(self, queryset, filters):
+        if 'since' in filters:
+            queryset = queryset.filter(created_at__gte=filters['since'])
+        if 'until' in filters:
+            queryset = queryset.filter(created_at__lt=filters['until'])
+        if 'updated_by' in filters:
+            queryset = queryset.filter(updated_by_id=filters['updated_by'])
+        return queryset
+
+    def stream_history(self, note, history_entries, values=True):
+        rows = history_entries.order_by(*self.pagination_class.ordering).iterator(chunk_size=self.stream_chunk_size)
+        for chunk in iter_chunks(rows, self.stream_chunk_size):
+            if values:
+                decode_history(note, chunk)
+            for record in self.get_serializer(chunk, many=True).data:
+                yield ndjson_line(record)
+
+class NoteAsOfView(GenericAPIView):
+    '''
+        View returning the title and description of a note as they were at
+        `?timestamp=` (ISO 8601 datetime) or right after `?version=`.
+
+        The version is resolved with one lookup on the History (note,
+        created_at) index and rebuilt from the nearest description
+        snapshot, so the cost does not grow with the length of the history.
+    '''
+    permission_classes = [IsAuthenticated, IsOwnerOrSharedUser]
+    lookup_url_kwarg = 'id'
+
+    history_not_written = NoteVersionHistoryView.history_not_written
+
+    def get_queryset(self):
+        return Note.objects.with_share_flag(self.request.user)
+
+    def get(self, request, *args, **kwargs):
+        note = self.get_object()
+        params = NoteAsOfSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        version = params.validated_data.get('version')
+        if version is None:
+            version = version_at(note, params.validated_data['timestamp'])
+            if version is None:
+                return Response(
+                    {"error": "The note did not exist at that time."},
+                    status=status.HTTP_404_NOT_FOUND
+                    )
+        try:
+            state = note_at_version(note, version)
+        except VersionNotFound as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except HistoryNotWritten as e:
+            return self.history_not_written(e)
+        return Response({"id": note.pk, **state}, headers={'ETag': f'"{note.pk}-{version}"'})
+
+class NoteExportView(GenericAPIView):
+    '''
+        View streaming every note the user can access, for users with the
+        `download_Note` permission.
+
+        `?output=ndjson|csv|zip` selects the format and `?history=true`
+        adds the decoded history of every note. Notes come in id order and
+        are read in chunks with `.iterator()`, so memory stays flat
+        whatever the number of notes; `?after=<id>` resumes an interrupted
+        export after the last note received.
+    '''
+    permission_classes = [IsAuthenticated, CanDownloadNotes]
+    stream_chunk_size = 500
+
+    def get(self, request, *args, **kwargs):
+        params = NoteExportSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        output = params.validated_data['output']
+        include_history = params.validated_data['history']
+        records = export_records(
+            request.user,
+            after=params.validated_data.get('after'),
+            include_history=include_history,
+            chunk_size=self.stream_chunk_size,
+        )
+        response = StreamingHttpResponse(
+            export_stream(records, output, include_history),
+            content_type=CONTENT_TYPES[output],
+        )
+        response['Content-Disposition'] = f'attachment; filename="notes.{output}"'
+        return response
+
+class NoteImportView(GenericAPIView):
+    '''
+        View importing notes owned by the user from an NDJSON (default) or
+        `?input=csv` request body.
+
+        The body is parsed line by line as it is read, the rows validated
+        like `CreateNotes` input in batches and inserted with
+        `bulk_create`, with their `shared_with` users. Invalid rows are
+        skipped and reported with their line number.
+    '''
+    permission_classes = [IsAuthenticated]
+    import_batch_size = 1000
+
+    def post(self, request, *args, **kwargs):
+        params = NoteImportSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        rows = read_rows(request.stream or [], params.validated_data['input'])
+        result = import_notes(rows, owner=request.user, batch_size=self.import_batch_size)
+        return Response(result.as_dict(), status=status.HTTP_200_OK)
+
+class NoteSyncView(GenericAPIView):
+    '''
+        View returning what changed since `?since=<seq>` in the notes the
+        logged in user can see: creates, updates, deletes, and the notes
+        shared with or unshared from them.
+
+        The entries are the changes of the notes the user owns or that are
+        shared with them at the time of the sync, and their own share and
+        unshare entries (see `NoteChange`), in `seq` order and paginated,
+        with one index probe per note and no scan of the entries of other
+        users. Only the last change of every note in a page is returned, with the
+        current note when it is still accessible; the current notes are
+        read with one query. Clients store the `cursor` of the response and
+        send it as `since`.
+
+        When the entries after `since` have been pruned the response is 410
+        with the current `cursor`: the client reloads its notes and syncs
+        from there.
+    '''
+    serializer_class = NoteChangeSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = ChangeFeedPagination
+
+    def get_queryset(self):
+        return NoteChange.objects.for_user(self.request.user.pk)
+
+    def get(self, request, *args, **kwargs):
+        since = self.paginator.decode_cursor(request) or 0
+        oldest = NoteChange.objects.oldest_seq()
+        if oldest is not None and oldest > since + 1:
+            head = NoteChange.objects.aggregate(head=Max('seq'))['head']
+            return Response(
+                {"error": "The changes since this cursor were pruned, reload the notes", "cursor": head},
+                status=status.HTTP_410_GONE,
+            )
+        page = self.paginate_queryset(self.get_queryset())
+        latest = {}
+        for entry in page:
+            # Re-inserted so the entries stay in `seq` order
+            latest.pop(entry.note_id, None)
+            latest[entry.note_id] = entry
+        live = [note_id for note_id, entry in latest.items() if entry.action not in (NoteChange.DELETE, NoteChange.UNSHARE)]
+        notes = Note.objects.accessible_to(request.user).in_bulk(live) if live else {}
+        for note_id, entry in latest.items():
+            entry.note = notes.get(note_id)
+        serializer = self.get_serializer(list(latest.values()), many=True)
+        return self.get_paginated_response(serializer.data)
+
+class NoteBatchView(GenericAPIView):
+    '''
+        View for applying a list of create/update/delete operations on
+        notes in one transaction.
+
+        Permissions for every referenced note are resolved with a single
+        query, creates go through `bulk_create`, updates through
+        `bulk_update` and the History and change feed rows through one
+        `bulk_create` each. As `bulk_update` sends no signals the updated
+        notes are evicted from the note cache here.
+        Deleting follows the same rule as `NotesRetrieveUpdateView.delete`:
+        the note has to be shared with the requesting user.
+
+        If any operation references a missing or forbidden note nothing is
+        written and the errors are returned with the operation index. The
+        notes are read before the transaction, which only writes (so on
+        SQLite it never has to upgrade a read lock held by a concurrent
+        batch), and only written while they are still at the versions
+        read; if another save got there first the batch is rolled back and
+        409 lists the operations on those notes.
+    '''
+    serializer_class = NoteBatchSerializer
+    permission_classes = [IsAuthenticated]
+    update_fields = ('title', 'description')
+    update_chunk_size = 500
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data['operations']
+        user = request.user
+
+        ids = {operation['id'] for operation in operations if 'id' in operation}
+        # Only the fields some update sets are loaded and written back
+        written_fields = [
+            field for field in self.update_fields
+            if any(operation['op'] == 'update' and field in operation for operation in operations)
+        ]
+        loaded = Note.objects.filter(pk__in=ids).with_share_flag(user)
+        loaded = loaded.defer(*(field for field in self.update_fields if field not in written_fields))
+        notes = {note.pk: note for note in loaded}
+        # The writes only apply while the notes are still at these versions
+        read_versions = {pk: note.version for pk, note in notes.items()}
+
+        errors = self.check_operations(operations, notes, user)
+        if errors:
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            with transaction.atomic():
+                results = self.apply_operations(operations, notes, read_versions, written_fields, user)
+        except StaleVersionError as error:
+            stale = error.args[1]
+            return Response(
+                {"errors": [
+                    {"index": index, "error": "The note was modified concurrently, nothing was written."}
+                    for index, operation in enumerate(operations)
+                    if operation.get('id') in stale
+                ]},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        return Response(
+            {"results": [{"op": op, "id": note.pk} for op, note in results]},
+            status=status.HTTP_200_OK,
+        )
+
+    def apply_operations(self, operations, notes, read_versions, written_fields, user):
+        '''
+            Writes the operations and returns the `(op, note)` pairs of the
+            results. Raises StaleVersionError, with the ids of the stale
+            notes as second argument, if an updated note is no longer at its
+            read version; the caller's transaction is then rolled back.
+        '''
+        now = timezone.now()
+        created, updated, changed, deleted, histories, results = [], {}, {}, set(), [], []
+        for operation in operations:
+            op = operation['op']
+            if op == 'create':
+                note = Note(
+                    title=operation['title'],
+                    description=operation['description'],
+                    created_by=user,
+                    updated_by=user,
+                )
+                created.append(note)
+            elif op == 'update':
+                note = notes[operation['id']]
+                note.updated_by = user
+                note.updated_at = now
+                changed_fields = [
+                    field for field in written_fields
+                    if field in operation and operation[field] != getattr(note, field)
+                ]
+                if changed_fields:
+                    note.version += 1
+                    changed[note.pk] = note
+                for field in changed_fields:
+                    histories.append(note.build_history(field, getattr(note, field), operation[field]))
+                    setattr(note, field, operation[field])
+                updated[note.pk] = note
+            else:
+                note = notes[operation['id']]
+                deleted.add(note.pk)
+            results.append((op, note))
+
+        Note.objects.bulk_create(created)
+        self.update_notes(
+            [note for pk, note in updated.items() if pk not in deleted],
+            read_versions,
+            [*written_fields, 'version', 'updated_by', 'updated_at'],
+        )
+        History.objects.bulk_create([entry for entry in histories if entry.note.pk not in deleted])
+        NoteChange.objects.record(NoteChange.CREATE, created)
+        NoteChange.objects.record(NoteChange.UPDATE, [note for pk, note in changed.items() if pk not in deleted])
+        if deleted:
+            Note.objects.filter(pk__in=deleted).soft_delete()
+        get_note_cache().invalidate_many(updated)
+        return results
+
+    def update_notes(self, notes, read_versions, fields):
+        '''
+            `bulk_update` of `notes` guarded by their read versions, with a
+            flat `version = CASE WHEN id = ... END` condition per chunk, so
+            the number of queries does not grow with the batch.
+        '''
+        for start in range(0, len(notes), self.update_chunk_size):
+            chunk = notes[start:start + self.update_chunk_size]
+            guard = Case(*(When(pk=note.pk, then=Value(read_versions[note.pk])) for note in chunk), default=Value(None))
+            try:
+                with transaction.atomic():
+                    if Note.objects.filter(version=guard).bulk_update(chunk, fields=fields) != len(chunk):
+                        raise StaleVersionError("Notes were modified during the batch.")
+            except StaleVersionError:
+                # The writes of the chunk are rolled back, so every version
+                # that differs from the read one was written by someone else
+                current = dict(Note.objects.filter(pk__in=[note.pk for note in chunk]).values_list('pk', 'version'))
+                stale = {note.pk for note in chunk if current.get(note.pk) != read_versions[note.pk]}
+                raise StaleVersionError("Notes were modified during the batch.", stale)
 
-    def retrieve(self, request, id):
-        note = get_object_or_404(Note, id=id)
-        history_entries = History.objects.filter(note=note)
-        serializer = self.get_serializer(history_entries, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+    def check_operations(self, operations, notes, user):
+        '''
+            Returns the list of errors for operations referencing notes that
+            do not exist, that the user cannot access, or that were deleted
+            earlier in the same batch.
+        '''
+        errors = []
+        deleted = set()
+        for index, operation in enumerate(operations):
+            if operation['op'] == 'create':
+                continue
+            note = notes.get(operation['id'])
+            if note is None or note.pk in deleted:
+                errors.append({"index": index, "error": "Note does not exist"})
+            elif operation['op'] == 'delete':
+                if not note.is_shared:
+                    errors.append({"index": index, "error": "You do not have the permission to perform this action."})
+                deleted.add(note.pk)
+            elif not (note.created_by_id == user.pk or note.is_shared):
+                errors.append({"index": index, "error": "You do not have the permission to perform this action."})
+        return errors
@@ -3,6 +3,11 @@ ASGI config for notes_management project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Besides the async note views, it serves the server-sent event stream of
+``notes/async/events/``, whose idle connections wait on the event loop
+instead of holding a worker thread: ``EventStreamApplication`` answers
+them ahead of Django's handler (see ``notes_management.event_stream``).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
@@ -13,4 +18,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notes_management.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the apps are loaded
+from notes_management.event_stream import EventStreamApplication  # noqa: E402
+
+application = EventStreamApplication(django_application)
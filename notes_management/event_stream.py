@@ -0,0 +1,147 @@
+'''
+    Server-sent event streams served ahead of Django's ASGI handler.
+
+    Django runs every ASGI request with a thread of its own for the
+    synchronous parts of the request cycle (signal receivers, ...), kept
+    until the response is complete. That is nothing for a short request,
+    but an open event stream would hold an idle thread for as long as the
+    client stays connected. `EventStreamApplication` therefore answers
+    `GET notes/async/events/` with `Accept: text/event-stream` itself: the
+    bearer token is checked with `CachedJWTAuthentication`, the stream is
+    `AsyncNoteEventsView.event_stream()`, whose change feed reads run in
+    the bounded pool of `notes.async_views`, and an idle connection is one
+    coroutine waiting on its `notes.events.Subscriber`.
+
+    Every other request, and every stream request it does not serve as is
+    (missing or invalid token, invalid `since`, host not allowed), goes to
+    Django, which answers it through the middleware and the view.
+'''
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.http.request import split_domain_port, validate_host
+from django.urls import reverse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+
+from notes.async_views import AsyncNoteEventsView, run_sync
+from notes.events import events_settings
+from users.authentication import CachedJWTAuthentication, auser_epoch, cached_user
+
+logger = logging.getLogger('notes.events')
+
+
+def allowed_hosts():
+    '''
+        `ALLOWED_HOSTS` as `HttpRequest.get_host()` applies it.
+    '''
+    hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not hosts:
+        return ['.localhost', '127.0.0.1', '[::1]']
+    return hosts
+
+
+class EventStreamApplication:
+    '''
+        ASGI application serving the event streams of `AsyncNoteEventsView`
+        and handing everything else to `application`.
+    '''
+    def __init__(self, application):
+        self.application = application
+        self._path = None
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = reverse('async-note-events')
+        return self._path
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == self.path:
+            stream = await self.open_stream(scope)
+            if stream is not None:
+                return await self.serve(stream, receive, send)
+        return await self.application(scope, receive, send)
+
+    async def open_stream(self, scope):
+        '''
+            Returns the event stream of the request, or None when Django
+            has to answer it.
+        '''
+        headers = {}
+        for name, value in scope['headers']:
+            headers.setdefault(name.decode('latin-1').lower(), value)
+        if b'text/event-stream' not in headers.get('accept', b''):
+            return None
+        domain, _ = split_domain_port(headers.get('host', b'').decode('latin-1'))
+        if not domain or not validate_host(domain, allowed_hosts()):
+            return None
+
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        since = query.get('since', [headers.get('last-event-id', b'').decode('latin-1')])[-1]
+        if since and not since.isdigit():
+            return None
+
+        user_id = await self.authenticate(headers.get('authorization'))
+        if user_id is None:
+            return None
+        view = AsyncNoteEventsView()
+        since = int(since) if since else await view.feed_head()
+        return view.event_stream(user_id, since, events_settings()['HEARTBEAT'])
+
+    async def authenticate(self, header):
+        '''
+            Returns the id of the active user of the bearer token in
+            `header`, or None.
+        '''
+        if header is None:
+            return None
+        authentication = CachedJWTAuthentication()
+        raw_token = authentication.get_raw_token(header)
+        if raw_token is None:
+            return None
+        try:
+            validated_token = authentication.get_validated_token(raw_token)
+            user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+            user = cached_user(user_id, await auser_epoch(user_id))
+            if user is None:
+                user = await run_sync(authentication.get_user, validated_token)
+        except (InvalidToken, TokenError, AuthenticationFailed):
+            return None
+        return user.pk
+
+    async def serve(self, stream, receive, send):
+        '''
+            Sends `stream` until the client disconnects.
+        '''
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'Content-Type', b'text/event-stream'),
+                (b'Cache-Control', b'no-cache'),
+                (b'X-Accel-Buffering', b'no'),
+            ],
+        })
+
+        async def pump():
+            async for chunk in stream:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(disconnected())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.warning("Event stream ended with %r", result)
+            await stream.aclose()
@@ -0,0 +1,285 @@
+'''
+    Project middleware: per-request SQL instrumentation and response
+    compression.
+
+    `SQLInstrumentationMiddleware` counts the queries and database time of
+    every request through the connection execute wrappers, reports them in
+    a `Server-Timing` header and logs, on the `notes_management.sql`
+    logger, the requests over the configured thresholds together with
+    their normalized SQL and the queries repeated within the request
+    (the usual sign of an N+1 access pattern).
+
+    It is enabled with the `SQL_INSTRUMENTATION` setting:
+
+        SQL_INSTRUMENTATION = {
+            'ENABLED': True,
+            'SLOW_REQUEST_MS': 500,
+            'MAX_QUERIES': 50,
+            'DUPLICATE_THRESHOLD': 3,
+        }
+
+    Queries run while a streaming response is consumed happen after the
+    middleware returned and are not counted.
+
+    `CompressionMiddleware` compresses response bodies with gzip or deflate
+    as negotiated through `Accept-Encoding` (see its docstring), configured
+    with the `RESPONSE_COMPRESSION` setting.
+'''
+import logging
+import re
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.utils.cache import patch_vary_headers
+
+logger = logging.getLogger('notes_management.sql')
+
+DEFAULT_SQL_INSTRUMENTATION = {
+    'ENABLED': False,
+    'SLOW_REQUEST_MS': 500,
+    'MAX_QUERIES': 50,
+    'DUPLICATE_THRESHOLD': 3,
+}
+
+DEFAULT_RESPONSE_COMPRESSION = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,
+    'LEVEL': 6,
+    'EXCLUDE_CONTENT_TYPES': ('application/zip', 'application/gzip', 'image/', 'video/', 'audio/', 'text/event-stream'),
+}
+
+# zlib window bits of the container formats
+ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+_PLACEHOLDER_LIST = re.compile(r'\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)')
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def instrumentation_settings():
+    return {**DEFAULT_SQL_INSTRUMENTATION, **getattr(settings, 'SQL_INSTRUMENTATION', {})}
+
+
+def compression_settings():
+    return {**DEFAULT_RESPONSE_COMPRESSION, **getattr(settings, 'RESPONSE_COMPRESSION', {})}
+
+
+def normalize_sql(sql):
+    '''
+        Returns `sql` with its literals replaced by `?` and placeholder lists
+        of any length collapsed, so the same query with other parameters
+        normalizes to the same string.
+    '''
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _PLACEHOLDER_LIST.sub('(...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryRecorder:
+    '''
+        Execute wrapper recording the SQL and duration of every query.
+    '''
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - started))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration in self.queries)
+
+    def grouped(self):
+        '''
+            Returns {normalized sql: [count, total seconds]} in first
+            execution order.
+        '''
+        groups = OrderedDict()
+        for sql, duration in self.queries:
+            group = groups.setdefault(normalize_sql(sql), [0, 0.0])
+            group[0] += 1
+            group[1] += duration
+        return groups
+
+    def duplicates(self, threshold):
+        return {sql: group for sql, group in self.grouped().items() if group[0] >= threshold}
+
+
+class SQLInstrumentationMiddleware:
+    '''
+        Adds `Server-Timing: db;dur=..;desc="N queries", app;dur=..` to every
+        response and logs the slow or query heavy requests.
+    '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = instrumentation_settings()
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        response['Server-Timing'] = (
+            f'db;dur={recorder.duration * 1000:.2f};desc="{recorder.count} queries", '
+            f'app;dur={elapsed * 1000:.2f}'
+        )
+        duplicates = recorder.duplicates(config['DUPLICATE_THRESHOLD'])
+        if (
+            recorder.count > config['MAX_QUERIES']
+            or elapsed * 1000 > config['SLOW_REQUEST_MS']
+            or duplicates
+        ):
+            self.log(request, response, recorder, elapsed, duplicates)
+        return response
+
+    def log(self, request, response, recorder, elapsed, duplicates):
+        lines = [
+            f'{request.method} {request.get_full_path()} -> {response.status_code}: '
+            f'{recorder.count} queries, {recorder.duration * 1000:.1f}ms in the database, {elapsed * 1000:.1f}ms total'
+        ]
+        for sql, (count, duration) in recorder.grouped().items():
+            marker = '  [N+1?]' if sql in duplicates else ''
+            lines.append(f'  {count:>4}x {duration * 1000:8.2f}ms  {sql}{marker}')
+        logger.warning('\n'.join(lines), extra={
+            'query_count': recorder.count,
+            'db_ms': recorder.duration * 1000,
+            'duplicates': {sql: count for sql, (count, _) in duplicates.items()},
+        })
+
+
+def negotiate_encoding(header):
+    '''
+        Returns the content coding of `ENCODINGS` the client prefers in an
+        Accept-Encoding `header` (gzip on a tie), or None.
+    '''
+    weights = {}
+    for item in (header or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        weight = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if coding:
+            weights[coding] = weight
+    wildcard = weights.get('*', 0.0)
+    candidates = [(weights.get(coding, wildcard), coding) for coding in ENCODINGS]
+    weight, coding = max(candidates, key=lambda candidate: (candidate[0], candidate[1] == 'gzip'))
+    return coding if weight > 0 else None
+
+
+def compress_chunks(chunks, encoding, level):
+    '''
+        Compresses the byte strings of `chunks` as one `encoding` stream,
+        yielding output as the compressor produces it.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def acompress_chunks(chunks, encoding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class CompressionMiddleware:
+    '''
+        Compresses responses with the coding negotiated from
+        `Accept-Encoding`: gzip or deflate (zlib format).
+
+        Bodies under `MIN_SIZE` bytes are sent as they are (which also keeps
+        token responses out of reach of BREACH style attacks), as are
+        responses already encoded, partial ones and the content types of
+        `EXCLUDE_CONTENT_TYPES` (including event streams, which the
+        compressor would hold back). Streaming responses (history and
+        export streams) are compressed as they are produced, whatever their
+        size, in one compressor of bounded memory.
+
+        A strong `ETag` of a compressed body is made weak (`W/"..."`), as
+        those bytes differ from the identity representation: caches and
+        Range requests comparing strong validators must not mix the two.
+        The note endpoints still recognise the weak form of their tags,
+        see `notes.conditional`.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    def process_response(self, request, response):
+        config = compression_settings()
+        if not config['ENABLED']:
+            return response
+        # The body depends on the header even when it is not compressed
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if response.has_header('Content-Encoding') or response.has_header('Content-Range'):
+            return response
+        content_type = response.get('Content-Type', '').lower()
+        if any(content_type.startswith(excluded) for excluded in config['EXCLUDE_CONTENT_TYPES']):
+            return response
+        encoding = negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = acompress_chunks(response.streaming_content, encoding, config['LEVEL'])
+            else:
+                response.streaming_content = compress_chunks(response.streaming_content, encoding, config['LEVEL'])
+            del response['Content-Length']
+        else:
+            if len(response.content) < config['MIN_SIZE']:
+                return response
+            compressed = b''.join(compress_chunks([response.content], encoding, config['LEVEL']))
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
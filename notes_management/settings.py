@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
 
@@ -46,6 +47,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'notes_management.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -134,11 +136,110 @@ AUTH_USER_MODEL = 'users.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
+    ],
+    # Same output as JSONRenderer, faster (orjson when installed)
+    'DEFAULT_RENDERER_CLASSES': [
+        'notes.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
     ],
 }
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=15),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
-}
\ No newline at end of file
+}
+
+# Verified tokens and users memoized by CachedJWTAuthentication. Tokens are
+# kept for at most the access token lifetime, users for USER_TTL: the longest
+# a deactivation or password change goes unseen by the other processes, or
+# after a QuerySet.update() (no signal). Set INVALIDATION_CACHE to a CACHES
+# alias shared by the processes (e.g. Redis) to have saving a user seen by all
+# of them on their next request, at the cost of one cache read per request.
+AUTH_TOKEN_CACHE = {
+    'MAX_ENTRIES': 10000,
+    'USER_TTL': timedelta(seconds=60),
+    'INVALIDATION_CACHE': None,
+}
+# Description changes in History are stored as deltas, with a full snapshot
+# every N versions (see notes.versions).
+NOTES_HISTORY_SNAPSHOT_INTERVAL = 50
+
+# Note descriptions and History values over this many UTF-8 bytes are
+# stored zlib compressed (see notes.fields); None stores new values plain.
+NOTES_COMPRESSION_THRESHOLD = 1024
+NOTES_COMPRESSION_LEVEL = 6
+
+# Write-behind History (see notes.history_writer): rows are spooled to disk
+# and written in batches by a background thread after the save commits.
+NOTES_HISTORY_WRITE_BEHIND = {
+    'ENABLED': False,
+    'MAX_QUEUE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 0.2,
+    'SPOOL_DIR': BASE_DIR / 'history-spool',
+    'FSYNC': False,
+}
+
+# Read-through cache of serialized notes and their ACL (see notes.cache).
+# Use 'notes.cache.DjangoCacheBackend' with OPTIONS {'alias': 'default',
+# 'timeout': 300} to share it between processes through CACHES.
+NOTES_CACHE = {
+    'BACKEND': 'notes.cache.LRUCacheBackend',
+    'OPTIONS': {'max_entries': 10000},
+}
+
+# gzip/deflate response bodies as negotiated through Accept-Encoding (see
+# notes_management.middleware.CompressionMiddleware). Streams are always
+# compressed, other bodies from MIN_SIZE bytes.
+RESPONSE_COMPRESSION = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,
+    'LEVEL': 6,
+    'EXCLUDE_CONTENT_TYPES': ('application/zip', 'application/gzip', 'image/', 'video/', 'audio/', 'text/event-stream'),
+}
+
+# Per-request query counts and database time in a Server-Timing header, and
+# a log of the requests over either threshold or repeating the same query
+# DUPLICATE_THRESHOLD times (see notes_management.middleware).
+SQL_INSTRUMENTATION = {
+    'ENABLED': False,
+    'SLOW_REQUEST_MS': 500,
+    'MAX_QUERIES': 50,
+    'DUPLICATE_THRESHOLD': 3,
+}
+if SQL_INSTRUMENTATION['ENABLED']:
+    MIDDLEWARE.insert(0, 'notes_management.middleware.SQLInstrumentationMiddleware')
+
+# Push of note changes by notes/async/events/ (see notes.events). Use
+# 'notes.events.ChangeFeedBroker' with OPTIONS {'interval': 1.0} when
+# several processes serve the API, so each of them polls the change feed.
+NOTES_EVENTS = {
+    'BACKEND': 'notes.events.LocalBroker',
+    'OPTIONS': {},
+    'MAX_QUEUE': 100,
+    'HEARTBEAT': 15,
+    'POLL_TIMEOUT': 25,
+}
+
+# Worker threads running the synchronous parts (saves, share writes, history
+# decoding) of the async note views in notes.async_views.
+NOTES_ASYNC_THREAD_POOL_SIZE = 8
+
+# SQLite production mode (see notes_management.sqlite): WAL and the pragmas
+# on every new connection, one write transaction at a time per process
+# through a FIFO queue (entered on the first write), and persistent
+# connections. Enabled with
+# SQLITE_PRODUCTION_MODE=1 in the environment. SQLITE_PRAGMAS only holds
+# overrides of notes_management.sqlite.base.DEFAULT_SQLITE_PRAGMAS, e.g.
+# {'synchronous': 'FULL'}.
+SQLITE_PRODUCTION_MODE = os.environ.get('SQLITE_PRODUCTION_MODE', '').lower() in ('1', 'true', 'yes', 'on')
+SQLITE_PRAGMAS = {}
+if SQLITE_PRODUCTION_MODE:
+    DATABASES['default'].update({
+        'ENGINE': 'notes_management.sqlite',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        # Seconds a write waits for its turn before "database is locked"
+        'OPTIONS': {'timeout': 20},
+    })
@@ -0,0 +1,20 @@
+'''
+    SQLite production mode.
+
+    `notes_management.sqlite` is a database ENGINE extending Django's
+    SQLite backend for serving concurrent requests from one database file:
+
+    - every new connection gets the pragmas of `DEFAULT_SQLITE_PRAGMAS`
+      (WAL journal, synchronous=NORMAL, mmap, page cache, busy timeout),
+      with the `SQLITE_PRAGMAS` setting overriding single values, from a
+      `connection_created` handler, so readers never wait for writers;
+    - writes of the process go through a single FIFO writer queue, so
+      threads wait their turn instead of racing for the database lock and
+      failing with "database is locked". A transaction enters the queue
+      with its first write and leaves it when it ends, read-only
+      transactions never wait for it.
+
+    It is enabled by setting `SQLITE_PRODUCTION_MODE=1` in the environment
+    (the `SQLITE_PRODUCTION_MODE` setting), which also keeps connections
+    open between requests (`CONN_MAX_AGE`).
+'''
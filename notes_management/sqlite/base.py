@@ -0,0 +1,140 @@
+import itertools
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.backends.sqlite3 import base
+from django.db.utils import OperationalError
+
+# Applied to every production mode connection, `SQLITE_PRAGMAS` overrides
+# single values
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'busy_timeout': 20000,
+    'temp_store': 'MEMORY',
+}
+
+WRITE_STATEMENT = re.compile(r'^\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.IGNORECASE)
+
+
+class WriterQueue:
+    '''
+        FIFO lock letting one write transaction at a time run against a
+        database file, in arrival order. A waiter that times out gives up
+        its turn and gets OperationalError, like SQLite's own busy timeout.
+    '''
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._tickets = itertools.count()
+        self._serving = 0
+        self._abandoned = set()
+
+    def acquire(self, timeout=None):
+        with self._condition:
+            ticket = next(self._tickets)
+            if not self._condition.wait_for(lambda: self._serving == ticket, timeout):
+                self._abandoned.add(ticket)
+                raise OperationalError('database is locked (timed out in the writer queue)')
+
+    def release(self):
+        with self._condition:
+            self._serving += 1
+            while self._serving in self._abandoned:
+                self._abandoned.discard(self._serving)
+                self._serving += 1
+            self._condition.notify_all()
+
+
+# One queue per database file
+writer_queues = defaultdict(WriterQueue)
+
+
+def sqlite_pragmas():
+    return {**DEFAULT_SQLITE_PRAGMAS, **getattr(settings, 'SQLITE_PRAGMAS', {})}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    '''
+        SQLite backend serializing the writes of the process through a
+        WriterQueue.
+
+        Transactions start deferred, which takes no lock, and enter the
+        queue with their first write statement, holding it until they
+        commit or roll back. Read-only transactions never wait for the
+        queue. A transaction writing first waits for its turn like with
+        `BEGIN IMMEDIATE`. One that reads first works from the snapshot of
+        that read, and its first write fails with "database is locked" if
+        another write committed in between: such transactions run through
+        `notes.transactions.atomic_with_retry`.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer_queue = writer_queues[str(self.settings_dict['NAME'])]
+        self.holds_writer_queue = False
+        self.execute_wrappers.append(self.serialize_write)
+
+    def writer_queue_timeout(self):
+        return self.settings_dict['OPTIONS'].get('timeout', 5)
+
+    def acquire_writer_queue(self):
+        self.writer_queue.acquire(self.writer_queue_timeout())
+        self.holds_writer_queue = True
+
+    def release_writer_queue(self):
+        if self.holds_writer_queue:
+            self.holds_writer_queue = False
+            self.writer_queue.release()
+
+    def _commit(self):
+        try:
+            return super()._commit()
+        finally:
+            self.release_writer_queue()
+
+    def _rollback(self):
+        try:
+            return super()._rollback()
+        finally:
+            self.release_writer_queue()
+
+    def _close(self):
+        try:
+            return super()._close()
+        finally:
+            self.release_writer_queue()
+
+    def serialize_write(self, execute, sql, params, many, context):
+        '''
+            Execute wrapper entering the writer queue for a write: until the
+            end of the transaction for the first write of a transaction, for
+            the statement alone outside of one.
+        '''
+        if self.holds_writer_queue or not WRITE_STATEMENT.match(sql):
+            return execute(sql, params, many, context)
+        self.acquire_writer_queue()
+        if self.connection.in_transaction:
+            # Released by the commit or rollback
+            return execute(sql, params, many, context)
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.release_writer_queue()
+
+
+def configure_connection(sender, connection, **kwargs):
+    '''
+        Applies `SQLITE_PRAGMAS` to every new production mode connection.
+    '''
+    if not isinstance(connection, DatabaseWrapper):
+        return
+    for name, value in sqlite_pragmas().items():
+        # Straight on the driver connection, outside the execute wrappers
+        connection.connection.execute(f'PRAGMA {name} = {value}')
+
+
+connection_created.connect(configure_connection, dispatch_uid='notes_management.sqlite.configure_connection')
@@ -0,0 +1,182 @@
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+
+class TTLCache:
+    '''
+        Bounded, thread safe LRU cache whose entries expire at a given time.
+    '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _auth_cache_setting(name, default):
+    return getattr(settings, 'AUTH_TOKEN_CACHE', {}).get(name, default)
+
+
+token_cache = TTLCache(_auth_cache_setting('MAX_ENTRIES', 10000))
+user_cache = TTLCache(_auth_cache_setting('MAX_ENTRIES', 10000))
+
+
+def user_ttl():
+    return _auth_cache_setting('USER_TTL', timedelta(seconds=60)).total_seconds()
+
+
+def invalidation_cache():
+    '''
+        Returns the Django cache shared by the processes that holds the
+        invalidation epoch of every user, or None when
+        `AUTH_TOKEN_CACHE['INVALIDATION_CACHE']` is not set.
+    '''
+    alias = _auth_cache_setting('INVALIDATION_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def _epoch_key(user_id):
+    return f'auth-epoch:{user_id}'
+
+
+def user_epoch(user_id):
+    '''
+        Returns the current invalidation epoch of `user_id`, changed by every
+        `invalidate_user()` of any process (None without a shared cache).
+    '''
+    cache = invalidation_cache()
+    return None if cache is None else cache.get(_epoch_key(user_id))
+
+
+async def auser_epoch(user_id):
+    cache = invalidation_cache()
+    return None if cache is None else await cache.aget(_epoch_key(user_id))
+
+
+def cached_user(user_id, epoch):
+    '''
+        Returns a copy of the cached user `user_id` if it was cached at the
+        invalidation `epoch`, else None.
+    '''
+    entry = user_cache.get(str(user_id))
+    if entry is None or entry[1] != epoch:
+        return None
+    # Every request gets its own copy, the cached one is never mutated
+    return copy.copy(entry[0])
+
+
+def invalidate_user(user_id):
+    '''
+        Forgets the cached user, so the next request loads it again with the
+        full JWTAuthentication checks (active user, revoked token). Other
+        processes see it on their next request when an invalidation cache is
+        configured, otherwise once their copy expires after `USER_TTL`.
+
+        Cached tokens are kept: they only memoize the signature check, the
+        checks depending on the user are made when it is loaded.
+    '''
+    user_cache.delete(str(user_id))
+    cache = invalidation_cache()
+    if cache is not None:
+        # Outlives every entry cached before it
+        cache.set(_epoch_key(user_id), uuid.uuid4().hex, timeout=user_ttl())
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    '''
+        JWTAuthentication that memoizes verified tokens and their users in
+        bounded in-process TTL caches, so a repeated token skips the
+        signature check and the `users.User` query.
+
+        Tokens are cached by their exact encoded value, which is what was
+        verified, until they expire or for at most the access token
+        lifetime. Users are cached by id for `USER_TTL` (60 seconds by
+        default). Saving or deleting a user (deactivation, password
+        change, ...) drops the cached user through the handlers in
+        `users.signals`, in every process when
+        `AUTH_TOKEN_CACHE['INVALIDATION_CACHE']` names a shared cache.
+        Without one, and for writes that send no signal (`QuerySet.update()`),
+        a change takes up to `USER_TTL` to be seen.
+    '''
+    def get_ttl(self):
+        lifetime = _auth_cache_setting('TTL', None) or api_settings.ACCESS_TOKEN_LIFETIME
+        return lifetime.total_seconds()
+
+    def get_validated_token(self, raw_token):
+        validated_token = token_cache.get(raw_token)
+        if validated_token is None:
+            validated_token = super().get_validated_token(raw_token)
+            expires_at = min(validated_token.get('exp', float('inf')), time.time() + self.get_ttl())
+            token_cache.set(raw_token, validated_token, expires_at)
+        return validated_token
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        # Read before loading the user, so an invalidation in between is
+        # seen on the next request
+        epoch = user_epoch(user_id)
+        user = cached_user(user_id, epoch)
+        if user is None:
+            user = super().get_user(validated_token)
+            user_cache.set(str(user_id), (user, epoch), time.time() + min(user_ttl(), self.get_ttl()))
+            user = copy.copy(user)
+        return user
+
+    async def aauthenticate(self, request):
+        '''
+            Async variant of `authenticate()` for the async views. Token
+            checks are CPU only and a cached user needs no query; a cache
+            miss loads the user (with the usual active check) off the event
+            loop.
+        '''
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        user = cached_user(user_id, await auser_epoch(user_id))
+        if user is None:
+            return await sync_to_async(self.get_user)(validated_token), validated_token
+        return user, validated_token
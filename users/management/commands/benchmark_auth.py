@@ -0,0 +1,56 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.authentication import CachedJWTAuthentication, token_cache, user_cache
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-request authentication overhead of JWTAuthentication and CachedJWTAuthentication'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000, help='Number of authenticated requests to simulate')
+
+    def handle(self, *args, **options):
+        '''
+            Authenticates the same access token `--requests` times with each
+            class and reports the mean time and queries per request. The
+            benchmark user is created in a transaction that is rolled back.
+        '''
+        with transaction.atomic():
+            user = User.objects.create_user(
+                username='benchmark-auth',
+                email='benchmark-auth@example.com',
+                password='Test@1234',
+            )
+            header = f'Bearer {AccessToken.for_user(user)}'
+            token_cache.clear()
+            user_cache.clear()
+
+            for authentication in (JWTAuthentication(), CachedJWTAuthentication()):
+                seconds, queries = self.measure(authentication, header, options['requests'])
+                self.stdout.write(
+                    f"{type(authentication).__name__:<26} "
+                    f"{seconds / options['requests'] * 1_000_000:8.1f} us/request  "
+                    f"{queries / options['requests']:.3f} queries/request"
+                )
+            transaction.set_rollback(True)
+
+    def measure(self, authentication, header, requests):
+        factory = APIRequestFactory()
+        request = Request(factory.get('/', HTTP_AUTHORIZATION=header))
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            for _ in range(requests):
+                authentication.authenticate(request)
+            seconds = time.perf_counter() - started
+        return seconds, len(captured)
@@ -0,0 +1,15 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from users.authentication import invalidate_user
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def invalidate_cached_authentication(sender, instance, **kwargs):
+    '''
+        Drops the cached tokens and user object whenever a user is saved
+        (deactivation, password change, ...) or deleted.
+    '''
+    invalidate_user(instance.pk)
@@ -1,9 +1,17 @@
+import time
+from unittest import mock
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
-from rest_framework.test import APIClient
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework import status
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from users.authentication import CachedJWTAuthentication, invalidate_user, token_cache, user_cache
 
 User = get_user_model()
 
@@ -67,4 +75,76 @@ class TokenEndpointsTestCase(TestCase):
         response = self.client.post(url, data)
         
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertIn('access', response.data)
\ No newline at end of file
+        self.assertIn('access', response.data)
+
+class CachedJWTAuthenticationTestCase(TestCase):
+    """
+        The below code tests that verified tokens and users are cached and dropped when the user changes.
+    """
+    def setUp(self):
+        token_cache.clear()
+        user_cache.clear()
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='Test@1234')
+        self.request = Request(APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}'))
+        self.authentication = CachedJWTAuthentication()
+
+    def test_repeated_token_skips_user_query(self):
+        user, _ = self.authentication.authenticate(self.request)
+        self.assertEqual(user, self.user)
+        with self.assertNumQueries(0):
+            user, _ = self.authentication.authenticate(self.request)
+        self.assertEqual(user, self.user)
+
+    def test_deactivated_user_is_rejected(self):
+        self.authentication.authenticate(self.request)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authentication.authenticate(self.request)
+
+    def test_password_change_invalidates_cache(self):
+        self.authentication.authenticate(self.request)
+        self.user.set_password('Changed@1234')
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.authentication.authenticate(self.request)
+
+    def test_user_updated_without_signal_is_seen_after_user_ttl(self):
+        self.authentication.authenticate(self.request)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        # No signal, the cached user is still used
+        self.authentication.authenticate(self.request)
+        with mock.patch('users.authentication.time.time', return_value=time.time() + 61):
+            with self.assertRaises(AuthenticationFailed):
+                self.authentication.authenticate(self.request)
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'auth-invalidation'}},
+        AUTH_TOKEN_CACHE={'INVALIDATION_CACHE': 'default'},
+    )
+    def test_invalidation_in_another_process_is_seen(self):
+        user_cache.clear()
+        self.authentication.authenticate(self.request)
+        with self.assertNumQueries(0):
+            self.authentication.authenticate(self.request)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        # Another process saving the user only changes the shared epoch
+        with mock.patch.object(user_cache, 'delete'):
+            invalidate_user(self.user.pk)
+        self.assertEqual(len(user_cache), 1)
+        with self.assertRaises(AuthenticationFailed):
+            self.authentication.authenticate(self.request)
+
+    def test_invalid_token_is_not_cached(self):
+        request = Request(APIRequestFactory().get('/', HTTP_AUTHORIZATION='Bearer not-a-token'))
+        for _ in range(2):
+            with self.assertRaises(InvalidToken):
+                self.authentication.authenticate(request)
+        self.assertEqual(len(token_cache), 0)
+
+    def test_api_uses_cached_authentication(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=self.request.META['HTTP_AUTHORIZATION'])
+        response = client.get(reverse('list-notes'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(user_cache), 1)